@@ -7,7 +7,6 @@ import random
 import hashlib
 
 from abc import ABC, abstractmethod
-from contextlib import contextmanager
 from types import GeneratorType
 
 # pandas
@@ -16,6 +15,11 @@ import pandas as pd
 # enlight
 import enlight.utils as utils
 
+from enlight.catalog import ImageCatalog
+from enlight.duplicates import DuplicateIndex
+
+DEFAULT_CHUNK_SIZE = 10000
+
 class EnlightCSVDataGenerator(ABC):
     """
     Generates data from the CSV file. Requires a text generator
@@ -32,114 +36,136 @@ class EnlightCSVDataGenerator(ABC):
     def __init__(self,
                  text_generator: GeneratorType,
                  img_folder: str,
-                 max_data: int = 256):
+                 max_data: int = 256,
+                 catalog: ImageCatalog = None,
+                 duplicates: DuplicateIndex = None):
         """
         text_generator: A generator that returns tuples of (quote_source:str, quote:str).
         img_folder: Folder to the image folder required by enlighten.
         max_data: max amount of sample quotes to generate.
+        catalog: Optional catalog of img_folder used instead of scanning the folder.
+        duplicates: Only sample one image of every group of near-duplicates.
         """
         self.text_generator = text_generator
         self.image_folder = img_folder
         self.max_data = max_data
+        self.catalog = catalog
+        self.duplicates = duplicates
 
-    def generate(self):
+    def iter_rows(self, start: int = 0, stop: int = None):
         """
-        Returns a list of tuples with generated data.
+        Yields each generated row as a dict of fields. Rows are produced
+        lazily so memory does not grow with max_data.
+
+        start, stop: Only yield rows with index in [start, stop). Rows only depend on
+        their own index, so ranges can be generated in parallel and concatenated.
         """
 
-        # grab image lists
-        img_names = utils.load_image_names(self.image_folder)
-        img_names = [os.path.split(p)[1] for p in img_names]
+        # grab image lists, sorted to be independent of file system order
+        if self.catalog is not None:
+            img_names = self.catalog.refresh().names()
+        else:
+            img_names = utils.load_image_names(self.image_folder)
+            img_names = sorted(os.path.split(p)[1] for p in img_names)
+        if self.duplicates is not None:
+            img_names = [n for n in img_names if self.duplicates.representative(n) == n]
         hash_lookup_img_names = {k: None for k in img_names}
 
-        results = []
+        stop = self.max_data + 1 if stop is None else min(stop, self.max_data + 1)
         for idx, (quote_source, quote) in enumerate(self.text_generator()):
-            if idx > self.max_data:
+            if idx >= stop:
                 break
+            if idx < start:
+                continue
 
-            image_name = self.image_select(img_names, quote_source, quote)
-            style = self.style_select(img_names, quote_source, quote)
+            rng = self.row_random(idx, quote_source, quote)
+            image_name = self.image_select(img_names, quote_source, quote, rng)
+            style = self.style_select(img_names, quote_source, quote, rng)
 
             if image_name is None:
-                image_name = img_names[random.randint(0, len(img_names) - 1)]
+                image_name = img_names[rng.randint(0, len(img_names) - 1)]
 
             assert image_name in hash_lookup_img_names, "Provided image is not a valid image name."
-            results.append(dict(zip(self.fields, (image_name, quote_source, quote, style))))
-        return pd.DataFrame.from_records(results)
+            yield dict(zip(self.fields, (image_name, quote_source, quote, style)))
+
+    def generate_chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE, start: int = 0, stop: int = None):
+        """
+        Yields DataFrames of at most chunk_size rows.
+        """
+        assert chunk_size > 0, "Chunk size must be positive."
+
+        chunk = []
+        for row in self.iter_rows(start, stop):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield pd.DataFrame.from_records(chunk, columns=self.fields)
+                chunk = []
+
+        if len(chunk) != 0:
+            yield pd.DataFrame.from_records(chunk, columns=self.fields)
 
-    def generate_csv(self, output_fpath):
+    def generate(self, start: int = 0, stop: int = None):
+        """
+        Returns a DataFrame with all generated data.
+        """
+        return pd.DataFrame.from_records(list(self.iter_rows(start, stop)))
+
+    def generate_csv(self, output_fpath, chunk_size: int = DEFAULT_CHUNK_SIZE, start: int = 0, stop: int = None):
         """
         Generates the csv file with max_data specified in class.
+        Rows are written in chunks of chunk_size as they are generated.
+        """
+        header = True
+        for chunk in self.generate_chunks(chunk_size, start, stop):
+            chunk.to_csv(output_fpath, index=False, header=header, mode="w" if header else "a")
+            header = False
+
+        if header:
+            pd.DataFrame(columns=self.fields).to_csv(output_fpath, index=False)
+
+    def row_random(self, idx: int, quote_source: str, quote: str) -> random.Random:
         """
-        result = self.generate()
-        result.to_csv(output_fpath, index=False)
+        Returns the random number generator used for a single row.
+        Each row gets its own instance so generation never touches global random state.
+        """
+        return random.Random()
 
     @abstractmethod
-    def image_select(self, img_list, quote_source, quote):
+    def image_select(self, img_list, quote_source, quote, rng: random.Random):
         """Select an image from the list of images given a quote."""
 
     @abstractmethod
-    def style_select(self, img_list, quote_source, quote):
+    def style_select(self, img_list, quote_source, quote, rng: random.Random):
         """Selects a style."""
 
 class PseudoRandomImageCSVDataGenerator(EnlightCSVDataGenerator):
     """
     Selects a random image given a quote.
-    Using the seed, a quote + quote source will always provide the same image.
+    Using the seed, a quote + quote source at a given row will always provide the same image.
 
-    Best use-case is to instantiate a new class instance every N generator data
-    with a new-seed to ensure true randomness.
+    Rows are seeded independently of each other, so generation is thread-safe and
+    any row range can be generated separately with identical results.
     """
 
     def __init__(self, seed: int, *args, **kwargs):
         super().__init__(*args, **kwargs)
-
-        # Starting seed
         self.seed = seed
-        self._internal_seed = seed
 
-    @contextmanager
-    def new_seed(self, seed=0):
+    def row_random(self, idx, quote_source, quote):
         """
-        Returns new seed and then updates internal state.
-        Can also seed the seed as it generates for more randomness.
+        Seeds a generator from a single hash of the row contents, row index and seed.
         """
-        random.seed(seed)
-        yield
-        # set the next state of the seed as part of the value
-        self._internal_seed = int(random.random() * 10**32)
-
-    def image_select(self, img_list, quote_source, quote):
-        """
-        Random selects an image
-        """
-
-        # The internal seed is from the prior random value
-        # this gurantees that a new generator class created
-        # will always be the same sequence of values for any given session.
-        final_str = quote_source + quote + str(self._internal_seed)
-
-        hash_val = hashlib.sha256(final_str.encode("utf-8")).hexdigest()
-
-        # Consistent hash across python instances
-        with self.new_seed(int(hash_val, 16) % 10 **32):
-            rand_index = random.randint(0, len(img_list) - 1)
-            selected_img = img_list[rand_index]
-
-        return selected_img
-
-    def style_select(self, img_list, quote_source, quote):
-        # The internal seed is from the prior random value
-        # this gurantees that a new generator class created
-        # will always be the same sequence of values for any given session.
-        final_str = quote_source + quote + str(self._internal_seed)
+        final_str = f"{quote_source}{quote}{self.seed}:{idx}"
 
         # Consistent hash across python instances
         hash_val = hashlib.sha256(final_str.encode("utf-8")).hexdigest()
+        return random.Random(int(hash_val, 16) % 10**32)
 
-        # Consistent hash across python instances
-        with self.new_seed(int(hash_val, 16) % 10 **32):
-            rand_index = random.randint(0, len(utils.RENDER_STYLE) - 2)
-            selected_style = utils.RENDER_STYLE[rand_index]
+    def image_select(self, img_list, quote_source, quote, rng):
+        """
+        Random selects an image
+        """
+        return img_list[rng.randint(0, len(img_list) - 1)]
 
-        return selected_style
+    def style_select(self, img_list, quote_source, quote, rng):
+        return utils.RENDER_STYLE[rng.randint(0, len(utils.RENDER_STYLE) - 2)]
@@ -2,44 +2,292 @@
 Infers a given feature.1
 """
 
+import os
+import copy
 import pickle
+import shutil
+import tarfile
+import zipfile
+import tempfile
+
+from hashlib import md5
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+# numpy
+import numpy as np
 
 # torch
 import torch
 
+# Pillow
+from PIL import Image
+
 # hugging_face
 from transformers import BeitFeatureExtractor, BeitModel
 
 # sklearn
 from sklearn import svm
+from sklearn.linear_model import SGDClassifier
 from sklearn.multioutput import MultiOutputClassifier
 from sklearn.preprocessing import MultiLabelBinarizer
 
+# enlight
+import enlight.image_tools as itools
+
+from enlight.utils import RENDER_STYLE
+from enlight.duplicates import DuplicateIndex
+
+DEFAULT_BEIT_MODEL = "microsoft/beit-base-patch16-224-pt22k"
+DEFAULT_FEATURE_BATCH_SIZE = 16
+
+def check_archive_members(names: list, archive_fpath: str):
+    """Rejects archive members that would be extracted outside the extraction folder."""
+    for name in names:
+        parts = name.replace("\\", "/").split("/")
+        if os.path.isabs(name) or name.startswith(("/", "\\")) or ".." in parts or os.path.splitdrive(name)[0]:
+            raise RuntimeError(f"Unsafe path {name} in model archive: {archive_fpath}")
+
+def unpack_model_archive(archive_fpath: str, extract_fpath: str = None) -> str:
+    """
+    Extracts a packed model archive (.tar, .tar.gz, .zip) once and returns the folder.
+    Folders are returned as-is. The extraction folder is keyed by the archive path,
+    size and modification time so a changed archive is extracted again.
+    """
+    if os.path.isdir(archive_fpath):
+        return archive_fpath
+
+    if extract_fpath is None:
+        stat = os.stat(archive_fpath)
+        key = f"{os.path.abspath(archive_fpath)}:{stat.st_size}:{stat.st_mtime_ns}"
+        extract_fpath = os.path.join(tempfile.gettempdir(), "enlight_models", md5(key.encode()).hexdigest())
+
+    if os.path.exists(extract_fpath):
+        return extract_fpath
+
+    # Extract next to the destination then rename so concurrent loaders never see a partial model.
+    parent = os.path.dirname(os.path.abspath(extract_fpath))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=parent)
+    try:
+        if zipfile.is_zipfile(archive_fpath):
+            with zipfile.ZipFile(archive_fpath) as f:
+                check_archive_members(f.namelist(), archive_fpath)
+                f.extractall(staging)
+        elif tarfile.is_tarfile(archive_fpath):
+            with tarfile.open(archive_fpath) as f:
+                check_archive_members(f.getnames(), archive_fpath)
+                # The data filter also rejects links and special files where available
+                if hasattr(tarfile, "data_filter"):
+                    f.extractall(staging, filter="data")
+                else:
+                    f.extractall(staging)
+        else:
+            raise RuntimeError(f"Unsupported model archive: {archive_fpath}")
+
+        # Archives of a single folder are unwrapped
+        contents = os.listdir(staging)
+        source = staging
+        if len(contents) == 1 and os.path.isdir(os.path.join(staging, contents[0])):
+            source = os.path.join(staging, contents[0])
+
+        try:
+            os.rename(source, extract_fpath)
+        except OSError:
+            if not os.path.exists(extract_fpath):
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return extract_fpath
+
+def save_model(model, fpath: str):
+    """Pickles a model atomically so running renders never load a partial file."""
+    tmp_fpath = fpath + ".tmp"
+    with open(tmp_fpath, "w+b") as f:
+        pickle.dump(model, f)
+    os.replace(tmp_fpath, fpath)
+
+class ModelWatcher:
+    """
+    Holds a pickled model and reloads it whenever the file changes,
+    allowing models to be hot-swapped under a running render.
+    """
+
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+        self._version = self._file_version()
+        with open(fpath, "r+b") as f:
+            self.model = pickle.load(f)
+
+    def _file_version(self):
+        # save_model replaces the file so the inode changes even if mtime does not
+        stat = os.stat(self.fpath)
+        return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    def get(self):
+        """Returns the latest model, keeping the current one if a reload fails."""
+        try:
+            version = self._file_version()
+            if version != self._version:
+                with open(self.fpath, "r+b") as f:
+                    self.model = pickle.load(f)
+                self._version = version
+        except Exception as e:
+            print(f"Unable to reload AI model: {str(e)}")
+        return self.model
+
+class FeatureBackbone(ABC):
+    """
+    Feature extractor used by the StyleInferer. Turns
+    an image into a flat feature vector.
+    """
+
+    # Backbones that load a model take its local folder or archive as model_fpath
+    loads_model = False
+
+    @abstractmethod
+    def extract(self, img: Image) -> np.ndarray:
+        """Returns a flat feature vector for the given image."""
+
+    def extract_batch(self, imgs: list) -> np.ndarray:
+        """Returns feature vectors of shape (len(imgs), features)."""
+        return np.stack([self.extract(img) for img in imgs])
+
+class BeitBackbone(FeatureBackbone):
+    """
+    Uses the last hidden state of a BEiT model from HG as features.
+    A local folder or packed archive is loaded without any hub lookups.
+    """
+
+    loads_model = True
+
+    def __init__(self, model_name: str = DEFAULT_BEIT_MODEL, model_fpath: str = None):
+        """
+        model_name: HG model name, downloaded from the hub unless cached.
+        model_fpath: Local model folder or archive loaded instead, never touching the hub.
+        """
+        local_files_only = model_fpath is not None
+        if local_files_only:
+            assert os.path.exists(model_fpath), f"Model not found: {model_fpath}"
+            model_name = unpack_model_archive(model_fpath)
+
+        self.feature_extractor = BeitFeatureExtractor.from_pretrained(model_name, local_files_only=local_files_only)
+        self.model = BeitModel.from_pretrained(model_name, local_files_only=local_files_only)
+        self.model.eval()
+
+    def save(self, fpath: str):
+        """Saves the extractor and model to a folder loadable offline."""
+        self.feature_extractor.save_pretrained(fpath)
+        self.model.save_pretrained(fpath)
+
+    def extract(self, img):
+        return self.extract_batch([img])[0]
+
+    def extract_batch(self, imgs):
+        """Runs every image through the model in a single forward pass."""
+        inputs = self.feature_extractor([img.convert("RGB") for img in imgs], return_tensors="pt")
+
+        with torch.no_grad():
+            return self.model(**inputs).last_hidden_state.numpy().reshape(len(imgs), -1)
+
+class RegionStatsBackbone(FeatureBackbone):
+    """
+    No deep learning backbone. Downscales the image and calculates the
+    luminance mean, variance and edge energy over each style overlay region.
+    """
+
+    def __init__(self, styles=RENDER_STYLE[:-1], size: tuple = (64, 64), percent: float = 0.05):
+        self.styles = styles
+        self.size = size
+        self.regions = itools.calculate_style_regions(itools.Box(0, 0, *size), styles, percent)
+
+    def extract(self, img):
+        small = img.resize(self.size, resample=Image.BILINEAR, reducing_gap=2.0).convert("L")
+        gray = np.asarray(small, dtype=np.float64) / 255.0
+        return itools.region_statistics(gray, self.regions).flatten()
+
+BACKBONES = {
+    "beit": BeitBackbone,
+    "region-stats": RegionStatsBackbone
+}
+
 class StyleInferer:
     """
-    Basic SVM based inferer for images using
-    models from HG for feature extraction.
+    Basic SVM based inferer for images using a
+    FeatureBackbone for feature extraction.
     """
 
-    def __init__(self, classes):
+    def __init__(self, classes, backbone="beit", backbone_fpath=None, duplicates: DuplicateIndex = None,
+                 batch_size: int = DEFAULT_FEATURE_BATCH_SIZE, max_cache_size: int = None):
+        """
+        classes: List of styles the model predicts.
+        backbone: Name in BACKBONES or a FeatureBackbone instance.
+        backbone_fpath: Local model folder or archive for a named backbone that loads a model, e.g. beit.
+        duplicates: Near-duplicate images share one cached feature vector per group.
+        batch_size: Max images the backbone extracts features of at once.
+        max_cache_size: Max feature vectors kept, least recently used first out. None keeps every one.
+        """
+        assert batch_size > 0, "Batch size must be positive."
+        assert max_cache_size is None or max_cache_size >= 0, "Max cache size must not be negative."
         self.classes = classes
         self.classes_encoded = {k: i for i, k in enumerate(classes)}
-        self._feature_cache = {}
+        self.duplicates = duplicates
+        self.batch_size = batch_size
+        self.max_cache_size = max_cache_size
+        self._feature_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
-        self.feature_extractor = BeitFeatureExtractor.from_pretrained("microsoft/beit-base-patch16-224-pt22k")
-        self.model = BeitModel.from_pretrained("microsoft/beit-base-patch16-224-pt22k")
+        if isinstance(backbone, str):
+            assert backbone in BACKBONES, f"Unknown backbone: {backbone}"
+            assert backbone_fpath is None or BACKBONES[backbone].loads_model, \
+                f"The {backbone} backbone does not load a model, a backbone fpath can not be used with it."
+            backbone = BACKBONES[backbone]() if backbone_fpath is None else BACKBONES[backbone](model_fpath=backbone_fpath)
+        self.backbone = backbone
+
+    def clear_cache(self):
+        """Drops every cached feature vector and resets the hit and miss counts."""
+        self._feature_cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def feature_cache_key(self, img) -> str:
+        if self.duplicates is not None and img.filename in self.duplicates:
+            return self.duplicates.representative(img.filename)
+        return img.filename
 
     def calculate_image_feature_vector(self, img):
-        if img.filename in self._feature_cache:
-            return self._feature_cache[img.filename]
+        return self.feature_vectors([img])[0]
 
-        # feature extract
-        inputs = self.feature_extractor(img.convert("RGB"), return_tensors="pt")
+    def feature_vectors(self, imgs) -> list:
+        """
+        Feature vectors of every image. Images missing from the cache are
+        extracted in batches of batch_size, each distinct cache key only once.
+        """
+        keys = [self.feature_cache_key(img) for img in imgs]
+        found = {}
+        missing = {}
+        for key, img in zip(keys, imgs):
+            if key in found or key in missing:
+                self.cache_hits += 1
+            elif key in self._feature_cache:
+                self.cache_hits += 1
+                self._feature_cache.move_to_end(key)
+                found[key] = self._feature_cache[key]
+            else:
+                self.cache_misses += 1
+                missing[key] = img
 
-        with torch.no_grad():
-            result = self.model(**inputs).last_hidden_state.numpy().flatten()
-            self._feature_cache[img.filename] = result
-            return result
+        missing = list(missing.items())
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            for (key, _), result in zip(batch, self.backbone.extract_batch([img for _, img in batch])):
+                found[key] = result
+                self._feature_cache[key] = result
+                if self.max_cache_size is not None and len(self._feature_cache) > self.max_cache_size:
+                    self._feature_cache.popitem(last=False)
+        return [found[key] for key in keys]
 
     def train(self, imgs, quote_srcs, quotes, styles, model=None, function_shape="ovo"):
         """Trains the given style."""
@@ -50,7 +298,7 @@ class StyleInferer:
         else:
             multilabel_classifier = model
 
-        X = [self.calculate_image_feature_vector(img) for img in imgs]
+        X = self.feature_vectors(imgs)
 
         if isinstance(styles[0], list):
             Y = [[self.classes_encoded[s] for s in ss] for ss in styles]
@@ -60,8 +308,62 @@ class StyleInferer:
 
         return multilabel_classifier.fit(X, Y)
 
+    def partial_train(self, imgs, quote_srcs, quotes, styles, model=None):
+        """
+        Folds new labels into an online linear model without refitting on
+        older labels. A new model is created when model is None.
+        """
+        if model is None:
+            model = MultiOutputClassifier(SGDClassifier(loss="hinge"))
+
+        X = self.feature_vectors(imgs)
+        Y = [[self.classes_encoded[s]] for s in styles]
+
+        return model.partial_fit(X, Y, classes=[np.arange(len(self.classes))])
+
     def infer(self, imgs, quote_srcs, quotes, model):
         """
         Infers a style given image metadata.
         """
-        return model.predict([self.calculate_image_feature_vector(img) for img in imgs])
+        return model.predict(self.feature_vectors(imgs))
+
+    def decision_scores(self, imgs, model):
+        """
+        Returns per style scores of shape (len(imgs), len(classes)) from a single
+        output model. Styles the model was never trained on are nan.
+        """
+        assert len(model.estimators_) == 1, "Only single output models are supported."
+        estimator = model.estimators_[0]
+
+        # Pairwise scores are not per style, use a shallow copy with one-vs-rest shape.
+        if getattr(estimator, "decision_function_shape", "ovr") != "ovr":
+            estimator = copy.copy(estimator)
+            estimator.decision_function_shape = "ovr"
+
+        X = self.feature_vectors(imgs)
+        decision = np.asarray(estimator.decision_function(X), dtype=np.float64)
+        if decision.ndim == 1:
+            # Binary classifiers score the second class
+            decision = np.stack([-decision, decision], axis=1)
+
+        scores = np.full((len(imgs), len(self.classes)), np.nan)
+        scores[:, estimator.classes_.astype(int)] = decision
+        return scores
+
+    def uncertainty(self, imgs, styles, model):
+        """
+        Margin between each style's score and the best other style for the image.
+        Lower is more uncertain. Styles the model was never trained on are 0.
+        """
+        scores = self.decision_scores(imgs, model)
+        style_idx = np.array([self.classes_encoded[s] for s in styles])
+        rows = np.arange(len(imgs))
+
+        style_scores = scores[rows, style_idx]
+        others = scores.copy()
+        others[rows, style_idx] = np.nan
+        best_other = np.full(len(imgs), np.nan)
+        has_other = ~np.all(np.isnan(others), axis=1)
+        best_other[has_other] = np.nanmax(others[has_other], axis=1)
+
+        return np.nan_to_num(np.abs(style_scores - best_other), nan=0.0)
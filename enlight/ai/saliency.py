@@ -0,0 +1,48 @@
+"""
+Heuristic style selection without an AI model.
+"""
+
+# numpy
+import numpy as np
+
+# Pillow
+from PIL import Image
+
+# enlight
+import enlight.image_tools as itools
+
+from enlight.utils import RENDER_STYLE
+
+class SaliencyStyleSelector:
+    """
+    Scores every style overlay region of an image in a single pass and picks
+    the calmest one, where calm means low luminance variance and edge energy.
+    """
+
+    def __init__(self,
+                 styles=RENDER_STYLE[:-1],
+                 size: tuple = (128, 128),
+                 percent: float = 0.05,
+                 variance_weight: float = 1.0,
+                 edge_weight: float = 4.0):
+        """
+        styles: Candidate styles to score.
+        size: Resolution the image is reduced to before scoring.
+        percent: Margin used for the overlay regions, same as render().
+        variance_weight: Weight of luminance variance in the score.
+        edge_weight: Weight of edge energy in the score.
+        """
+        self.styles = styles
+        self.size = size
+        self.weights = np.array([0.0, variance_weight, edge_weight])
+        self.regions = itools.calculate_style_regions(itools.Box(0, 0, *size), styles, percent)
+
+    def score(self, img: Image) -> np.ndarray:
+        """Returns a score per style, lower is calmer."""
+        small = img.resize(self.size, resample=Image.BILINEAR, reducing_gap=2.0).convert("L")
+        gray = np.asarray(small, dtype=np.float64) / 255.0
+        return itools.region_statistics(gray, self.regions) @ self.weights
+
+    def select(self, img: Image) -> str:
+        """Returns the calmest style for the image."""
+        return self.styles[int(np.argmin(self.score(img)))]
@@ -0,0 +1,93 @@
+"""
+Packed store of pre-decoded backgrounds shared between processes.
+"""
+
+import os
+import json
+import mmap
+
+from typing import List
+
+# Pillow
+from PIL import Image
+
+# enlight
+import enlight.image_tools as itools
+
+STORE_VERSION = 1
+INDEX_SUFFIX = ".index.json"
+
+# Pillow only maps 4 byte pixels without a copy, so pixels are stored as RGBA.
+STORE_MODE = "RGBA"
+STORE_ALIGNMENT = 4096
+
+class BackgroundStore:
+    """
+    Backgrounds decoded once, EXIF-normalised and packed into a single raw RGBA file
+    with an index of offsets. The file is memory-mapped read-only, so images are
+    built over the mapped buffer with no decoding and every process shares the
+    same page cache.
+    """
+
+    def __init__(self, store_fpath: str):
+        with open(store_fpath + INDEX_SUFFIX, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        assert data["version"] == STORE_VERSION, f"Unsupported background store version: {data['version']}"
+
+        self.store_fpath = store_fpath
+        self.index = data["images"]
+        self._file = open(store_fpath, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if len(self.index) != 0 else None
+
+    @staticmethod
+    def build(image_fpaths: List[str], store_fpath: str, max_size: int = None):
+        """
+        Decodes every image, optionally scaled to max_size, into a new store at store_fpath.
+        """
+        index = {}
+        tmp_fpath = store_fpath + ".tmp"
+        with open(tmp_fpath, "wb") as f:
+            for fpath in image_fpaths:
+                img = itools.open_image(fpath, max_size).convert(STORE_MODE)
+
+                # Align each image to a page so mappings never straddle two images
+                offset = f.tell()
+                if offset % STORE_ALIGNMENT != 0:
+                    offset += STORE_ALIGNMENT - offset % STORE_ALIGNMENT
+                    f.seek(offset)
+
+                f.write(img.tobytes())
+                index[os.path.split(fpath)[1]] = {
+                    "offset": offset,
+                    "width": img.size[0],
+                    "height": img.size[1]
+                }
+
+        with open(store_fpath + INDEX_SUFFIX + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"version": STORE_VERSION, "mode": STORE_MODE, "images": index}, f)
+
+        os.replace(tmp_fpath, store_fpath)
+        os.replace(store_fpath + INDEX_SUFFIX + ".tmp", store_fpath + INDEX_SUFFIX)
+        return BackgroundStore(store_fpath)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return os.path.split(name)[1] in self.index
+
+    def names(self):
+        return sorted(self.index.keys())
+
+    def get(self, name: str) -> Image:
+        """Returns a read-only image backed by the mapped store."""
+        entry = self.index[os.path.split(name)[1]]
+        size = (entry["width"], entry["height"])
+        length = size[0] * size[1] * len(STORE_MODE)
+        buffer = memoryview(self._mmap)[entry["offset"]:entry["offset"] + length]
+        return Image.frombuffer(STORE_MODE, size, buffer, "raw", STORE_MODE, 0, 1)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
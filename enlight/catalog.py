@@ -0,0 +1,147 @@
+"""
+Persistent catalog of an image folder.
+"""
+
+import os
+import json
+
+from hashlib import md5
+
+# Pillow
+from PIL import Image
+
+# enlight
+from enlight.utils import SUPPORTED_IMAGE_FORMATS
+
+CATALOG_VERSION = 1
+CATALOG_SUFFIX = ".catalog.json"
+EXIF_ORIENTATION = 0x0112
+
+def default_catalog_fpath(images_fpath: str) -> str:
+    """Catalog path of an image folder in the user cache folder, keyed by the folder path."""
+    cache_fpath = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    key = md5(os.path.normpath(os.path.abspath(images_fpath)).encode()).hexdigest()
+    return os.path.join(cache_fpath, "enlight", "catalogs", key + CATALOG_SUFFIX)
+
+def file_hash(fpath: str) -> str:
+    """Content hash of a file."""
+    h = md5()
+    with open(fpath, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class ImageCatalog:
+    """
+    Index of the images in a folder with their file size, modification time,
+    content hash, pixel dimensions and EXIF orientation. Saved at catalog_fpath,
+    or in the user cache folder, and refreshed incrementally, so only new or
+    changed images have their headers read and contents hashed.
+    """
+
+    def __init__(self, images_fpath: str, catalog_fpath: str = None, supported_formats=SUPPORTED_IMAGE_FORMATS):
+        self.images_fpath = images_fpath
+        # Stored outside the folder, writing the catalog would otherwise change the folder mtime
+        if catalog_fpath is None:
+            catalog_fpath = default_catalog_fpath(images_fpath)
+        self.catalog_fpath = catalog_fpath
+        self.supported_formats = supported_formats
+        self.records = {}
+        self._folder_mtime = None
+
+        if os.path.exists(self.catalog_fpath):
+            with open(self.catalog_fpath, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == CATALOG_VERSION:
+                self.records = data["records"]
+                self._folder_mtime = data["folder_mtime"]
+
+    def _supported(self, name):
+        return any(name.endswith(f".{format}") for format in self.supported_formats)
+
+    @staticmethod
+    def read_record(fpath: str, stat: os.stat_result) -> dict:
+        """Reads the header and hash of a single image."""
+        with Image.open(fpath) as img:
+            width, height = img.size
+            orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+
+        return {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": file_hash(fpath),
+            "width": width,
+            "height": height,
+            "orientation": orientation
+        }
+
+    def refresh(self, full: bool = False, verify: bool = False):
+        """
+        Updates the catalog with the folder contents. The folder is only listed if its
+        modification time changed, which happens when images are added, removed or renamed.
+        Otherwise the stored records are trusted as they are.
+        full: Always list the folder, e.g. on storage with coarse modification times.
+        verify: Also stat every cataloged image to pick up images modified in place.
+        """
+        folder_mtime = os.stat(self.images_fpath).st_mtime_ns
+        if folder_mtime == self._folder_mtime and not full:
+            if not verify:
+                return self
+            entries = [(n, os.path.join(self.images_fpath, n)) for n in self.records]
+        else:
+            with os.scandir(self.images_fpath) as it:
+                entries = [(e.name, e.path) for e in it if e.is_file() and self._supported(e.name)]
+
+        records = {}
+        changed = False
+        for name, fpath in entries:
+            try:
+                stat = os.stat(fpath)
+            except FileNotFoundError:
+                changed = True
+                continue
+
+            record = self.records.get(name)
+            if record is None or record["size"] != stat.st_size or record["mtime"] != stat.st_mtime_ns:
+                record = self.read_record(fpath, stat)
+                changed = True
+            records[name] = record
+
+        changed = changed or len(records) != len(self.records) or folder_mtime != self._folder_mtime
+        self.records = records
+        self._folder_mtime = folder_mtime
+        if changed:
+            self.save()
+        return self
+
+    def save(self):
+        # Write then replace so readers never see a partial catalog
+        os.makedirs(os.path.dirname(os.path.abspath(self.catalog_fpath)), exist_ok=True)
+        tmp_fpath = self.catalog_fpath + ".tmp"
+        with open(tmp_fpath, "w", encoding="utf-8") as f:
+            json.dump({"version": CATALOG_VERSION, "folder_mtime": self._folder_mtime, "records": self.records}, f)
+        os.replace(tmp_fpath, self.catalog_fpath)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, name):
+        return os.path.split(name)[1] in self.records
+
+    def names(self):
+        """Sorted image file names."""
+        return sorted(self.records.keys())
+
+    def image_fpaths(self):
+        """Sorted image paths, same as utils.load_image_names."""
+        return [os.path.join(self.images_fpath, n) for n in self.names()]
+
+    def get(self, name: str) -> dict:
+        return self.records[os.path.split(name)[1]]
+
+    def oriented_size(self, name: str) -> tuple:
+        """Pixel dimensions after the EXIF orientation is applied."""
+        record = self.get(name)
+        if record["orientation"] in (5, 6, 7, 8):
+            return (record["height"], record["width"])
+        return (record["width"], record["height"])
@@ -0,0 +1,153 @@
+"""
+Perceptual hash index grouping near-duplicate backgrounds.
+"""
+
+import os
+import json
+
+from typing import Dict, List
+
+# numpy
+import numpy as np
+
+# Pillow
+from PIL import Image, ImageOps
+
+INDEX_VERSION = 1
+HASH_SIZE = 8
+DEFAULT_HASH_METHOD = "phash"
+DEFAULT_MAX_DISTANCE = 6
+
+# pHash keeps the lowest 8x8 frequencies of a 32x32 thumbnail
+PHASH_SIZE = HASH_SIZE * 4
+
+# Bits set in every byte value, for vectorised Hamming distances
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Distances are computed in blocks of at most this many pairs to bound memory
+DISTANCE_BLOCK = 2**22
+
+def thumbnails(image_fpaths: List[str], size: tuple) -> np.ndarray:
+    """Grayscale thumbnails of every image as an array of shape (n, height, width)."""
+    pixels = np.empty((len(image_fpaths), size[1], size[0]), dtype=np.float32)
+    for i, fpath in enumerate(image_fpaths):
+        with Image.open(fpath) as img:
+            # JPEGs are decoded at their smallest scale above the thumbnail
+            img.draft("L", (size[0] * 4, size[1] * 4))
+            img = ImageOps.exif_transpose(img).convert("L")
+            pixels[i] = np.asarray(img.resize(size, resample=Image.LANCZOS), dtype=np.float32)
+    return pixels
+
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    """Packs boolean hashes of shape (n, 8, 8) into one uint64 per hash."""
+    return np.packbits(bits.reshape(len(bits), -1), axis=1).view(">u8").ravel().astype(np.uint64)
+
+def dhash(pixels: np.ndarray) -> np.ndarray:
+    """Difference hashes of (n, 8, 9) thumbnails, set where a pixel is brighter than its left neighbour."""
+    return pack_bits(pixels[:, :, 1:] > pixels[:, :, :-1])
+
+def phash(pixels: np.ndarray) -> np.ndarray:
+    """
+    Perceptual hashes of (n, 32, 32) thumbnails, set where a low frequency DCT
+    coefficient is above the median of the lowest 8x8 frequencies.
+    """
+    n = pixels.shape[1]
+    dct = np.cos(np.pi * np.outer(np.arange(HASH_SIZE), 2 * np.arange(n) + 1) / (2 * n)).astype(np.float32)
+    low = np.einsum("ij,njk,lk->nil", dct, pixels, dct)
+    median = np.median(low.reshape(len(low), -1), axis=1)
+    return pack_bits(low > median[:, None, None])
+
+HASH_METHODS = {
+    "dhash": (dhash, (HASH_SIZE + 1, HASH_SIZE)),
+    "phash": (phash, (PHASH_SIZE, PHASH_SIZE))
+}
+
+def hash_images(image_fpaths: List[str], method: str = DEFAULT_HASH_METHOD) -> np.ndarray:
+    assert method in HASH_METHODS, f"Hash method must be one of: {list(HASH_METHODS.keys())}"
+    fn, size = HASH_METHODS[method]
+    return fn(thumbnails(image_fpaths, size))
+
+def hamming_distances(hashes: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """Number of differing bits between every pair, of shape (len(hashes), len(others))."""
+    xor = hashes[:, None] ^ others[None, :]
+    return POPCOUNT[xor.view(np.uint8)].reshape(xor.shape + (8, )).sum(axis=-1, dtype=np.uint8)
+
+class DuplicateIndex:
+    """
+    Perceptual hashes of a background library, grouping images whose hashes
+    differ in at most max_distance bits, such as resized copies and re-exports.
+    Groups are transitive, an image joins a group if it is close to any member.
+    Every group is represented by its first name, images are looked up by file name.
+    """
+
+    def __init__(self, hashes: Dict[str, int], method: str = DEFAULT_HASH_METHOD, max_distance: int = DEFAULT_MAX_DISTANCE):
+        self.method = method
+        self.max_distance = max_distance
+        self.hashes = hashes
+
+        names = sorted(hashes.keys())
+        values = np.array([hashes[n] for n in names], dtype=np.uint64)
+
+        # Union-find over every pair within max_distance, in blocks of rows
+        parents = np.arange(len(names))
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        block = max(1, DISTANCE_BLOCK // max(1, len(names)))
+        for start in range(0, len(names), block):
+            distances = hamming_distances(values[start:start + block], values)
+            for i, j in zip(*np.nonzero(distances <= max_distance)):
+                a, b = find(start + i), find(j)
+                if a != b:
+                    parents[max(a, b)] = min(a, b)
+
+        # Roots are the smallest index of their group, so the first name represents it
+        self._representatives = {n: names[find(i)] for i, n in enumerate(names)}
+
+    @staticmethod
+    def build(image_fpaths: List[str], method: str = DEFAULT_HASH_METHOD, max_distance: int = DEFAULT_MAX_DISTANCE):
+        hashes = hash_images(image_fpaths, method)
+        return DuplicateIndex({os.path.split(f)[1]: int(h) for f, h in zip(image_fpaths, hashes)}, method, max_distance)
+
+    @staticmethod
+    def load(fpath: str, max_distance: int = None):
+        """Loads a saved index, optionally regrouped with another max_distance."""
+        with open(fpath, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        assert data["version"] == INDEX_VERSION, f"Unsupported duplicate index version: {data['version']}"
+        return DuplicateIndex({n: int(h, 16) for n, h in data["hashes"].items()},
+                              data["method"],
+                              data["max_distance"] if max_distance is None else max_distance)
+
+    def save(self, fpath: str):
+        with open(fpath, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": INDEX_VERSION,
+                "method": self.method,
+                "max_distance": self.max_distance,
+                "hashes": {n: f"{h:016x}" for n, h in sorted(self.hashes.items())}
+            }, f)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, name):
+        return os.path.split(name)[1] in self.hashes
+
+    def representative(self, name: str) -> str:
+        """Name representing the group of an image. Images not in the index represent themselves."""
+        name = os.path.split(name)[1]
+        return self._representatives.get(name, name)
+
+    def representatives(self) -> List[str]:
+        return sorted(set(self._representatives.values()))
+
+    def groups(self) -> List[List[str]]:
+        """Every group with more than one image, sorted by name."""
+        groups = {}
+        for name, representative in sorted(self._representatives.items()):
+            groups.setdefault(representative, []).append(name)
+        return [g for _, g in sorted(groups.items()) if len(g) > 1]
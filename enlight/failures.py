@@ -0,0 +1,68 @@
+"""
+Record of rows that failed to render.
+"""
+
+import os
+
+# pandas
+import pandas as pd
+
+DEFAULT_FAILURES_FPATH = "failures.csv"
+FAILURE_COLUMNS = ["row", "output", "stage", "error"]
+
+# Stages a row can fail in, in render order
+FAILURE_STAGES = ["row", "exists", "decode", "style", "compose", "write"]
+
+class FailureLog:
+    """
+    Appends every failed output to a CSV as soon as it fails. The first four columns
+    are copied from the input row, so the file is itself a valid render input and
+    re-rendering it retries only the failed rows. The remaining columns hold the
+    row number in the input, the output name, the failed stage and the error.
+    Failures are written next to fpath and only replace it on close, so a retry
+    reading and writing the same file never loses the rows it has not reached.
+    """
+
+    def __init__(self, fpath: str, input_columns: list, escape_string: str = "\\"):
+        self.fpath = fpath
+        self.tmp_fpath = fpath + ".tmp"
+        self.escape_string = escape_string
+        self.columns = list(input_columns[:4]) + FAILURE_COLUMNS
+        self.count = 0
+
+        # Header first so an interrupted render still leaves a readable file
+        self._file = open(self.tmp_fpath, "w", encoding="utf-8", newline="")
+        pd.DataFrame(columns=self.columns).to_csv(self._file, index=False, escapechar=escape_string)
+        self._file.flush()
+
+    def record(self, row: int, input_row: pd.Series, output: str, stage: str, error: Exception):
+        assert stage in FAILURE_STAGES, f"Unknown stage: {stage}"
+        # Rows retried from a failures file keep their original row number
+        if "row" in input_row.index[4:]:
+            row = input_row["row"]
+        values = list(input_row.iloc[:4]) + [row, output, stage, f"{type(error).__name__}: {error}"]
+        pd.DataFrame([values], columns=self.columns).to_csv(self._file, index=False, header=False, escapechar=self.escape_string)
+        self._file.flush()
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def close(self, completed: bool = True):
+        """
+        Replaces fpath with the recorded failures. An interrupted render also keeps
+        every failure already in fpath, as its rows may not have been retried yet.
+        """
+        self._file.close()
+        if not completed and os.path.exists(self.fpath):
+            previous = pd.read_csv(self.fpath, escapechar=self.escape_string)
+            recorded = pd.read_csv(self.tmp_fpath, escapechar=self.escape_string)
+            merged = pd.concat([previous[previous.columns.intersection(self.columns)], recorded], ignore_index=True)
+            merged.drop_duplicates(subset=list(self.columns[:4]) + ["row"], keep="last") \
+                  .to_csv(self.tmp_fpath, index=False, escapechar=self.escape_string)
+        os.replace(self.tmp_fpath, self.fpath)
+
+def load_failures(fpath: str = DEFAULT_FAILURES_FPATH, escape_string: str = "\\") -> pd.DataFrame:
+    """Reads a failures file with one entry per failed row, ready to render again."""
+    failures = pd.read_csv(fpath, escapechar=escape_string)
+    return failures.drop_duplicates(subset=list(failures.columns[:4]) + ["row"]).reset_index(drop=True)
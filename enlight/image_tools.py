@@ -2,14 +2,23 @@
 Adds image helper tools.
 """
 
-from typing import List
+import os
+import math
+import threading
+
+from typing import List, Callable
+from functools import update_wrapper
+from collections import OrderedDict, namedtuple
 
 # enlight
 from enlight.utils import RENDER_STYLE
 import enlight.image_tools as itools
 
+# numpy
+import numpy as np
+
 # pillow
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageFont, ImageDraw, ImageOps
 
 class Box:
     """Helper class for drawing boxes."""
@@ -64,6 +73,71 @@ class Box:
 
         return (min_y, max_y)
 
+TEXT_MASK_CACHE_SIZE = 256
+# A short quote over a 6000x4000 background is a mask of a few MB
+TEXT_MASK_CACHE_BYTES = 64 * 2**20
+FONT_FIT_WINDOW = 4
+
+# Image loading helpers #
+def scaled_size(size: tuple, max_size: int = None) -> tuple:
+    """Size with the longest side scaled down to max_size, if larger."""
+    if max_size is None or max(size) <= max_size:
+        return tuple(size)
+    scale = max_size / max(size)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+def open_image(fpath: str, max_size: int = None) -> Image:
+    """
+    Opens an image with EXIF orientation applied. If max_size is given the longest
+    side is scaled down to it, JPEGs are decoded directly at a reduced scale.
+    """
+    img = Image.open(fpath)
+    if max_size is not None and max(img.size) > max_size:
+        target = scaled_size(img.size, max_size)
+
+        # draft picks the smallest JPEG decode scale still larger than target
+        exif = img.getexif()
+        img.draft("RGB", target)
+        img = img.resize(target, resample=Image.LANCZOS, reducing_gap=2.0)
+        img.info["exif"] = exif.tobytes()
+
+    return ImageOps.exif_transpose(img)
+
+def scaled_cache_fpath(images_fpath: str, max_size: int) -> str:
+    """Folder holding images_fpath variants scaled to max_size."""
+    return os.path.join(os.path.normpath(os.path.abspath(images_fpath)) + ".scaled", str(max_size))
+
+def cached_image_fpath(image_fpath: str, cache_fpath: str) -> str:
+    """Returns the scaled variant of image_fpath if it is up to date, otherwise image_fpath."""
+    variant = os.path.join(cache_fpath, os.path.split(image_fpath)[1])
+    try:
+        if os.stat(variant).st_mtime_ns >= os.stat(image_fpath).st_mtime_ns:
+            return variant
+    except OSError:
+        pass
+    return image_fpath
+
+def build_scaled_cache(image_fpaths: List[str], cache_fpath: str, max_size: int) -> List[str]:
+    """
+    Writes a variant of every image scaled to max_size with EXIF orientation applied.
+    Up to date variants are skipped. Returns the variants written.
+    """
+    os.makedirs(cache_fpath, exist_ok=True)
+
+    written = []
+    for fpath in image_fpaths:
+        if cached_image_fpath(fpath, cache_fpath) != fpath:
+            continue
+
+        variant = os.path.join(cache_fpath, os.path.split(fpath)[1])
+        img = open_image(fpath, max_size)
+        if variant.endswith(".jpg"):
+            img.convert("RGB").save(variant, quality=95)
+        else:
+            img.save(variant)
+        written.append(variant)
+    return written
+
 # Helpers to calculate box render regions #
 def calculate_margin_percentage(box: Box, percent: float) -> Box:
     assert percent >= 0 and percent <= 1.0
@@ -99,6 +173,55 @@ def calculate_margin_style(box: Box, style: List[str], percent: float) -> Box:
         box = calculate_margin_style(box, s, percent)
     return box
 
+def calculate_style_regions(box: Box, styles: List[str], percent: float) -> List[Box]:
+    """Calculates the overlay region of every style for the given box."""
+    return [calculate_margin_style(box, style, percent) for style in styles]
+
+# Region statistics #
+def integral_image(arr: np.ndarray) -> np.ndarray:
+    """Summed area table padded with a leading row and column of zeros."""
+    result = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1), dtype=np.float64)
+    result[1:, 1:] = arr.cumsum(axis=0).cumsum(axis=1)
+    return result
+
+def boxes_to_array(boxes: List[Box], shape: tuple) -> np.ndarray:
+    """Converts boxes to an (n, 4) int array of x, y, x2, y2 clipped to shape (h, w)."""
+    coords = np.array([(b.x, b.y, b.x2, b.y2) for b in boxes], dtype=np.float64)
+    coords = np.floor(coords).astype(np.int64)
+    coords[:, [0, 2]] = np.clip(coords[:, [0, 2]], 0, shape[1])
+    coords[:, [1, 3]] = np.clip(coords[:, [1, 3]], 0, shape[0])
+    return coords
+
+def region_sums(table: np.ndarray, coords: np.ndarray) -> np.ndarray:
+    """Sums every (x, y, x2, y2) region of coords using an integral image."""
+    x, y, x2, y2 = coords.T
+    return table[y2, x2] - table[y, x2] - table[y2, x] + table[y, x]
+
+def region_statistics(gray: np.ndarray, boxes: List[Box]) -> np.ndarray:
+    """
+    Calculates luminance mean, luminance variance and edge energy for each box
+    in a single pass. gray is a 2D array and boxes are in its coordinates.
+    Returns an array of shape (len(boxes), 3).
+    """
+    gray = np.asarray(gray, dtype=np.float64)
+
+    # Edge energy is the gradient magnitude, padded back to the image shape.
+    grad_x = np.zeros_like(gray)
+    grad_y = np.zeros_like(gray)
+    grad_x[:, 1:] = np.abs(np.diff(gray, axis=1))
+    grad_y[1:, :] = np.abs(np.diff(gray, axis=0))
+    edges = grad_x + grad_y
+
+    coords = boxes_to_array(boxes, gray.shape)
+    area = np.maximum((coords[:, 2] - coords[:, 0]) * (coords[:, 3] - coords[:, 1]), 1)
+
+    mean = region_sums(integral_image(gray), coords) / area
+    mean_sq = region_sums(integral_image(gray * gray), coords) / area
+    variance = np.maximum(mean_sq - mean * mean, 0.0)
+    edge_energy = region_sums(integral_image(edges), coords) / area
+
+    return np.stack([mean, variance, edge_energy], axis=1)
+
 # Draw helpers #
 def draw_rect(img: Image, box: Box, color: tuple, transparency: float):
     """Draws rect at specified location. Assumes img is RGBA."""
@@ -114,19 +237,28 @@ def draw_rect(img: Image, box: Box, color: tuple, transparency: float):
     overlay_draw.rectangle((box.x, box.y, box.x2, box.y2), fill=color + (opacity, ))
     return Image.alpha_composite(img, overlay)
 
-def draw_text_box(
-    img: Image,
-    box: Box,
+def blend_rect(img: Image, box: Box, color: tuple, transparency: float):
+    """
+    Blends a translucent rect into img in place. Unlike draw_rect this works on RGB
+    images and only touches the pixels inside the box, no full frame overlay is made.
+    """
+    assert transparency >= 0 and transparency <= 1.0
+    for i in color:
+        assert i >= 0 and i <= 255
+
+    opacity = int(255 * transparency)
+    ImageDraw.Draw(img, "RGBA").rectangle((box.x, box.y, box.x2, box.y2), fill=color + (opacity, ))
+    return img
+
+def layout_text(
+    box_width: float,
+    box_height: float,
     text: str,
     font_fpath: str,
     target_percentage: float = 0.034,
     tab_space: int = 4,
-    color: tuple = (255, 255, 255),
     font_range: tuple = (1,1000)):
-    """Draws text, as big as possible, in given textbox, unless font_size is specified."""
-
-    for i in color:
-        assert i >= 0 and i <= 255
+    """Fits and wraps text for a box of the given size. Returns (font, wrapped text)."""
 
     def _get_font_width_height(font, text):
         l, t, r, b = font.getbbox(text)
@@ -141,16 +273,35 @@ def draw_text_box(
                 maxv = i
         return maxv
 
-    def _calculate_target_font(line, target_percent=1.0):
-        target_font = None
-        for size in range(*font_range):
-            target_font = ImageFont.FreeTypeFont(font_fpath, size=size)
-            w, h = _get_font_width_height(target_font, line)
+    def _overflows(size, line, target_percent):
+        w, h = _get_font_width_height(ImageFont.FreeTypeFont(font_fpath, size=size), line)
+        return w > box_width * target_percent or h > box_height * target_percent
 
-            if w > box.width() * target_percent or h > box.height() * target_percent:
-                target_font = ImageFont.FreeTypeFont(font_fpath, size=(size-1))
-                break
-        return target_font
+    def _calculate_target_font(line, target_percent=1.0):
+        sizes = range(*font_range)
+        if len(sizes) == 0:
+            return None
+
+        # Text grows with the font size, so bisect for the first size that overflows
+        lo, hi = 0, len(sizes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _overflows(sizes[mid], line, target_percent):
+                hi = mid
+            else:
+                lo = mid + 1
+
+        # Glyph hinting can make growth uneven by a pixel, check just below like a linear scan would
+        first = lo
+        i = lo - 1
+        while i >= 0 and i >= first - FONT_FIT_WINDOW:
+            if _overflows(sizes[i], line, target_percent):
+                first = i
+            i -= 1
+
+        if first == len(sizes):
+            return ImageFont.FreeTypeFont(font_fpath, size=sizes[-1])
+        return ImageFont.FreeTypeFont(font_fpath, size=(sizes[first] - 1))
 
 
     # First calculate smaller box that adheres to width constraints as possible
@@ -169,7 +320,7 @@ def draw_text_box(
         new_word = words.pop(0)
         has_newline = "\n" in new_word
         new_buffer = buffer + " " + new_word
-        if (len(new_buffer) * w) > box.width() or has_newline:
+        if (len(new_buffer) * w) > box_width or has_newline:
             lines.append(buffer if has_newline else buffer + "\n")
             buffer = " " + new_word
         else:
@@ -181,6 +332,113 @@ def draw_text_box(
 
     # Finally render inside everything inside the box.
     font = _calculate_target_font(max_line, 1.0)
+    return font, modified_text
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize", "bytes", "max_bytes"])
+
+class BoundedCache:
+    """
+    Least recently used cache of a function's results, like functools.lru_cache,
+    bounded by both its number of entries and the total size of the results.
+    max_size and max_bytes may be changed at any time, None is unbounded.
+    """
+
+    def __init__(self, fn: Callable, max_size: int, max_bytes: int, sizeof: Callable):
+        update_wrapper(self, fn)
+        self.fn = fn
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, *args):
+        with self._lock:
+            if args in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(args)
+                return self._entries[args][0]
+            self.misses += 1
+
+        # Computed outside the lock, concurrent misses of one key may both compute it
+        result = self.fn(*args)
+        size = self.sizeof(result)
+        with self._lock:
+            if args not in self._entries:
+                self._entries[args] = (result, size)
+                self._bytes += size
+            self._evict()
+        return result
+
+    def _evict(self):
+        while len(self._entries) != 0 and (
+                (self.max_size is not None and len(self._entries) > self.max_size) or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.max_size, len(self._entries), self._bytes, self.max_bytes)
+
+    def cache_clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+def bounded_cache(max_size: int, max_bytes: int, sizeof: Callable):
+    """Decorator caching results in a BoundedCache."""
+    return lambda fn: BoundedCache(fn, max_size, max_bytes, sizeof)
+
+# L mode masks take a byte per pixel
+@bounded_cache(TEXT_MASK_CACHE_SIZE, TEXT_MASK_CACHE_BYTES, lambda result: result[0].size[0] * result[0].size[1])
+def text_mask(
+    text: str,
+    font_fpath: str,
+    box_width: float,
+    box_height: float,
+    target_percentage: float = 0.034,
+    tab_space: int = 4,
+    font_range: tuple = (1,1000),
+    subpixel: tuple = (0, 0)):
+    """
+    Renders fitted text into an alpha mask. Cached so font fitting, wrapping and
+    glyph rasterization happen once per unique layout, up to TEXT_MASK_CACHE_SIZE
+    masks of at most TEXT_MASK_CACHE_BYTES together, see text_mask.max_size/max_bytes.
+    subpixel: Fractional part of the box center, glyphs are placed at sub-pixel offsets.
+    Returns (mask, (x, y)) where (x, y) is the mask offset from the whole pixel box center.
+    """
+    font, modified_text = layout_text(box_width, box_height, text, font_fpath, target_percentage, tab_space, font_range)
+
+    l, t, r, b = ImageDraw.Draw(Image.new("L", (1, 1))).multiline_textbbox(subpixel, modified_text, font=font, anchor="mm")
+    l, t, r, b = math.floor(l), math.floor(t), math.ceil(r), math.ceil(b)
+    mask = Image.new("L", (max(r - l, 1), max(b - t, 1)), 0)
+    ImageDraw.Draw(mask).text((subpixel[0] - l, subpixel[1] - t), modified_text, fill=255, anchor="mm", font=font)
+    return mask, (l, t)
+
+def draw_text_box(
+    img: Image,
+    box: Box,
+    text: str,
+    font_fpath: str,
+    target_percentage: float = 0.034,
+    tab_space: int = 4,
+    color: tuple = (255, 255, 255),
+    font_range: tuple = (1,1000)):
+    """Draws text, as big as possible, in given textbox, unless font_size is specified."""
+
+    for i in color:
+        assert i >= 0 and i <= 255
+
+    center_x, center_y = box.center()
+    subpixel = (center_x - math.floor(center_x), center_y - math.floor(center_y))
+    mask, (l, t) = text_mask(text, font_fpath, box.width(), box.height(), target_percentage, tab_space, tuple(font_range), subpixel)
 
-    d = ImageDraw.Draw(img)
-    d.text(box.center(), modified_text, fill=color, anchor="mm", font=font)
+    x = math.floor(center_x) + l
+    y = math.floor(center_y) + t
+    img.paste(color, (x, y, x + mask.size[0], y + mask.size[1]), mask)
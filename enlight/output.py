@@ -0,0 +1,404 @@
+"""
+Destinations rendered images are written to.
+"""
+
+import io
+import os
+import hmac
+import json
+import time
+import hashlib
+import tarfile
+import zipfile
+import warnings
+import threading
+
+from abc import ABC, abstractmethod
+from typing import List
+from urllib.parse import quote, urlencode, urlparse
+from xml.etree import ElementTree
+
+# Pillow
+from PIL import Image
+
+# urllib3
+import urllib3
+
+SHARD_WIDTH = 2
+PACK_INDEX_SUFFIX = ".index.jsonl"
+DEFAULT_UPLOAD_CONNECTIONS = 16
+DEFAULT_UPLOAD_RETRIES = 5
+
+def encode_image(img: Image, name: str) -> bytes:
+    """Encodes img in the format given by the extension of name."""
+    buffer = io.BytesIO()
+    img.save(buffer, format=Image.registered_extensions()[os.path.splitext(name)[1].lower()])
+    return buffer.getvalue()
+
+class OutputSink(ABC):
+    """
+    Where outputs are written, by file name. Writes may come from several
+    threads at once. Writing a name again replaces it, the latest write wins.
+    """
+
+    # Existence of many outputs is checked with one names() listing instead of exists() each
+    list_existing = False
+
+    @abstractmethod
+    def exists(self, name: str) -> bool:
+        """Whether an output with this file name was written."""
+
+    @abstractmethod
+    def write(self, name: str, img: Image) -> str:
+        """Encodes and writes img as name. Returns where it was written."""
+
+    @abstractmethod
+    def names(self) -> List[str]:
+        """Sorted file names of every output."""
+
+    @abstractmethod
+    def read(self, name: str) -> bytes:
+        """Encoded bytes of an output."""
+
+    def open(self, name: str) -> Image:
+        return Image.open(io.BytesIO(self.read(name)))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class FolderSink(OutputSink):
+    """
+    One file per output. With shard_depth > 0 outputs are spread over nested
+    folders named after the leading characters of their name, md5 names
+    give 256 evenly filled folders per level.
+    """
+
+    def __init__(self, output_fpath: str, shard_depth: int = 0):
+        assert shard_depth >= 0, "Shard depth must not be negative."
+        self.output_fpath = output_fpath
+        self.shard_depth = shard_depth
+        os.makedirs(output_fpath, exist_ok=True)
+
+    def fpath(self, name: str) -> str:
+        shards = [name[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(self.shard_depth)]
+        return os.path.join(self.output_fpath, *shards, name)
+
+    def exists(self, name):
+        return os.path.exists(self.fpath(name))
+
+    def write(self, name, img):
+        fpath = self.fpath(name)
+        if self.shard_depth > 0:
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        img.save(fpath)
+        return fpath
+
+    def names(self):
+        names = []
+        for root, folders, files in os.walk(self.output_fpath):
+            depth = len(os.path.relpath(root, self.output_fpath).split(os.sep)) if root != self.output_fpath else 0
+            if depth == self.shard_depth:
+                folders.clear()
+                names += [f for f in files if f.endswith(".jpg")]
+        return sorted(names)
+
+    def read(self, name):
+        with open(self.fpath(name), "rb") as f:
+            return f.read()
+
+    def open(self, name):
+        return Image.open(self.fpath(name))
+
+class TarSink(OutputSink):
+    """Streams outputs into an uncompressed tar, appending if it already exists."""
+
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+        self._lock = threading.Lock()
+        self._tar = tarfile.open(fpath, "a" if os.path.exists(fpath) else "w")
+        self._members = {m.name: (m.offset_data, m.size) for m in self._tar.getmembers()}
+
+    def exists(self, name):
+        return name in self._members
+
+    def write(self, name, img):
+        data = encode_image(img, name)
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        with self._lock:
+            header = info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors)
+            self._members[name] = (self._tar.offset + len(header), len(data))
+            self._tar.addfile(info, io.BytesIO(data))
+        return name
+
+    def names(self):
+        return sorted(self._members.keys())
+
+    def read(self, name):
+        with self._lock:
+            self._tar.fileobj.flush()
+            offset, length = self._members[name]
+        with open(self.fpath, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def close(self):
+        self._tar.close()
+
+class ZipSink(OutputSink):
+    """Streams outputs into a zip, appending if it already exists. JPEGs are stored uncompressed."""
+
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+        self._lock = threading.Lock()
+        self._zip = zipfile.ZipFile(fpath, "a" if os.path.exists(fpath) else "w", compression=zipfile.ZIP_STORED)
+        self._names = {i.filename: i for i in self._zip.infolist()}
+
+    def exists(self, name):
+        return name in self._names
+
+    def write(self, name, img):
+        data = encode_image(img, name)
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        with self._lock, warnings.catch_warnings():
+            # Zip allows duplicate entries, readers take the last one
+            warnings.simplefilter("ignore", UserWarning)
+            self._zip.writestr(info, data)
+            self._names[name] = self._zip.infolist()[-1]
+        return name
+
+    def names(self):
+        return sorted(self._names.keys())
+
+    def read(self, name):
+        with self._lock:
+            return self._zip.read(self._names[name])
+
+    def close(self):
+        self._zip.close()
+
+class PackSink(OutputSink):
+    """
+    Outputs appended back to back to a single pack file. Each output is written
+    and flushed before its (name, offset, length) line is appended to the index,
+    so a crash never leaves the index pointing at a partial image.
+    """
+
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+        self.index_fpath = fpath + PACK_INDEX_SUFFIX
+        self._lock = threading.Lock()
+        self.index = {}
+        if os.path.exists(self.index_fpath):
+            valid_length = 0
+            with open(self.index_fpath, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    entry = json.loads(line)
+                    self.index[entry["name"]] = (entry["offset"], entry["length"])
+                    valid_length += len(line)
+
+            # Drop a partially written last line so new entries start on their own line
+            if valid_length != os.path.getsize(self.index_fpath):
+                os.truncate(self.index_fpath, valid_length)
+
+        self._file = open(fpath, "ab")
+        self._index_file = open(self.index_fpath, "a", encoding="utf-8")
+
+    def exists(self, name):
+        return name in self.index
+
+    def write(self, name, img):
+        data = encode_image(img, name)
+        with self._lock:
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self._file.flush()
+            self._index_file.write(json.dumps({"name": name, "offset": offset, "length": len(data)}) + "\n")
+            self._index_file.flush()
+            self.index[name] = (offset, len(data))
+        return name
+
+    def names(self):
+        return sorted(self.index.keys())
+
+    def read(self, name):
+        offset, length = self.index[name]
+        with open(self.fpath, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def close(self):
+        self._file.close()
+        self._index_file.close()
+
+def sign_v4(
+    method: str,
+    host: str,
+    uri: str,
+    query: dict,
+    headers: dict,
+    payload_hash: str,
+    access_key: str,
+    secret_key: str,
+    region: str,
+    amz_date: str,
+    service: str = "s3") -> str:
+    """
+    AWS Signature Version 4 of a request. headers must include every header to sign
+    except host. uri must already be URI encoded. Returns the Authorization header.
+    """
+    signed_headers = {k.lower(): str(v).strip() for k, v in headers.items()}
+    signed_headers["host"] = host
+    names = sorted(signed_headers.keys())
+
+    canonical_query = "&".join(f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}" for k, v in sorted(query.items()))
+    canonical_request = "\n".join([
+        method,
+        uri,
+        canonical_query,
+        "".join(f"{k}:{signed_headers[k]}\n" for k in names),
+        ";".join(names),
+        payload_hash
+    ])
+
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+
+    key = ("AWS4" + secret_key).encode()
+    for part in [amz_date[:8], region, service, "aws4_request"]:
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    return f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, SignedHeaders={';'.join(names)}, Signature={signature}"
+
+class S3Sink(OutputSink):
+    """
+    Uploads encoded outputs from memory to an S3 compatible object store, using
+    path style addressing so it also works with local stand-ins like MinIO.
+    Requests share a pool of keep-alive connections and are retried with backoff
+    on connection errors, throttling and server errors. Credentials and endpoint
+    default to the usual AWS environment variables. Requests are unsigned without
+    credentials.
+    """
+
+    list_existing = True
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: str = None,
+        access_key: str = None,
+        secret_key: str = None,
+        region: str = None,
+        max_connections: int = DEFAULT_UPLOAD_CONNECTIONS,
+        retries: int = DEFAULT_UPLOAD_RETRIES):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.endpoint_url = (endpoint_url or os.environ.get("AWS_ENDPOINT_URL", "https://s3.amazonaws.com")).rstrip("/")
+        self.access_key = access_key or os.environ.get("AWS_ACCESS_KEY_ID")
+        self.secret_key = secret_key or os.environ.get("AWS_SECRET_ACCESS_KEY")
+        self.region = region or os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION", "us-east-1"))
+        self.host = urlparse(self.endpoint_url).netloc
+
+        # Blocks rather than opening extra connections when every pooled connection is busy
+        self.pool = urllib3.PoolManager(
+            num_pools=1,
+            maxsize=max_connections,
+            block=True,
+            retries=urllib3.Retry(
+                total=retries,
+                backoff_factor=0.1,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["HEAD", "GET", "PUT"],
+                raise_on_status=False
+            )
+        )
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}/{name}" if self.prefix != "" else name
+
+    def request(self, method: str, key: str = "", query: dict = None, body: bytes = b"", headers: dict = None):
+        query = query if query is not None else {}
+        headers = dict(headers) if headers is not None else {}
+        uri = "/" + quote(self.bucket, safe="-_.~") + ("/" + quote(key, safe="/-_.~") if key != "" else "")
+        payload_hash = hashlib.sha256(body).hexdigest()
+        headers["x-amz-content-sha256"] = payload_hash
+        headers["x-amz-date"] = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        if self.access_key is not None:
+            headers["Authorization"] = sign_v4(method, self.host, uri, query, headers, payload_hash,
+                                               self.access_key, self.secret_key, self.region, headers["x-amz-date"])
+
+        url = self.endpoint_url + uri
+        if len(query) != 0:
+            url += "?" + urlencode(sorted(query.items()), quote_via=quote, safe="-_.~")
+        return self.pool.request(method, url, body=body if method == "PUT" else None, headers=headers)
+
+    def _check(self, response, expected=(200, )):
+        if response.status not in expected:
+            raise RuntimeError(f"Object store returned {response.status}: {response.data[:200]}")
+        return response
+
+    def exists(self, name):
+        response = self.request("HEAD", self.key(name))
+        return self._check(response, (200, 404)).status == 200
+
+    def write(self, name, img):
+        data = encode_image(img, name)
+        self._check(self.request("PUT", self.key(name), body=data, headers={
+            "Content-Type": Image.MIME[Image.registered_extensions()[os.path.splitext(name)[1].lower()]],
+            "Content-Length": str(len(data))
+        }))
+        return f"s3://{self.bucket}/{self.key(name)}"
+
+    def names(self):
+        names = []
+        query = {"list-type": "2", "prefix": self.key("")}
+        while True:
+            root = ElementTree.fromstring(self._check(self.request("GET", query=query)).data)
+            namespace = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+            for content in root.iter(f"{namespace}Contents"):
+                names.append(content.find(f"{namespace}Key").text[len(query["prefix"]):])
+
+            token = root.find(f"{namespace}NextContinuationToken")
+            if token is None or token.text is None:
+                break
+            query["continuation-token"] = token.text
+        return sorted(names)
+
+    def read(self, name):
+        return self._check(self.request("GET", self.key(name))).data
+
+    def close(self):
+        self.pool.clear()
+
+ARCHIVE_SINKS = {
+    ".tar": TarSink,
+    ".zip": ZipSink,
+    ".pack": PackSink
+}
+
+def is_archive(fpath: str) -> bool:
+    return os.path.splitext(fpath)[1].lower() in ARCHIVE_SINKS
+
+def open_sink(fpath: str, shard_depth: int = 0) -> OutputSink:
+    """
+    Opens an S3Sink for s3://bucket/prefix, an archive sink by extension
+    (.tar, .zip, .pack), otherwise a folder.
+    """
+    if fpath.startswith("s3://"):
+        assert shard_depth == 0, "Object stores are not sharded."
+        bucket, _, prefix = fpath[len("s3://"):].partition("/")
+        return S3Sink(bucket, prefix)
+    if is_archive(fpath):
+        assert shard_depth == 0, "Archives are not sharded."
+        return ARCHIVE_SINKS[os.path.splitext(fpath)[1].lower()](fpath)
+    return FolderSink(fpath, shard_depth)
@@ -0,0 +1,139 @@
+"""
+Dry run of render(), laying out every output without drawing it.
+"""
+
+import os
+import json
+
+from random import randint
+from typing import List
+
+# Pillow
+from PIL import Image, ImageDraw, ImageOps
+
+# pandas
+import pandas as pd
+
+# enlight
+import enlight.utils as utils
+import enlight.image_tools as itools
+
+from enlight.render import (
+    DEFAULT_FONT, FALLBACK_STYLES, TEXT_TARGET_PERCENTAGE, background_size, layout_regions, check_variants,
+    load_image_fpaths, load_font_fpath, load_input_data, iter_jobs, missing_style
+)
+from enlight.ai.saliency import SaliencyStyleSelector
+from enlight.catalog import ImageCatalog
+from enlight.background_store import BackgroundStore
+
+DEFAULT_MIN_FONT_SIZE = 12
+PLAN_FORMATS = [".json", ".csv"]
+
+# Saliency only looks at a small thumbnail, JPEGs are decoded at their smallest scale above this
+SALIENCY_DRAFT_SIZE = (256, 256)
+
+def box_to_list(box: itools.Box) -> list:
+    return [box.x, box.y, box.x2, box.y2]
+
+def iter_plan(
+    images_fpath: str,
+    fonts_fpath: str,
+    input_csv: str,
+    render_style: str = "auto",
+    escape_string: str = "\\",
+    font: str = DEFAULT_FONT,
+    font_size: int = 200,
+    tab_width: int = 4,
+    df: pd.DataFrame = None,
+    fallback_style: str = "saliency",
+    verbose: bool = True,
+    catalog: ImageCatalog = None,
+    max_output_size: int = None,
+    background_store: BackgroundStore = None,
+    variant_styles: List[str] = None,
+    variant_images: List[str] = None,
+    min_font_size: int = DEFAULT_MIN_FONT_SIZE
+):
+    """
+    Plans every output render() would write with the same arguments, yielding a dict
+    per output with its background, style, overlay and text boxes, fitted font size
+    and line breaks. Backgrounds are only read for their headers and text is only
+    measured, nothing is rasterized.
+
+    Rows without a style are planned with the fallback style. The saliency selector
+    looks at a reduced decode of the background, when rendering an AI model may pick
+    another style.
+    min_font_size: Outputs with a smaller fitted font are flagged as too_small.
+    """
+    check_variants(variant_styles, variant_images)
+    image_names = load_image_fpaths(images_fpath, catalog, verbose)
+    font_fpath = load_font_fpath(fonts_fpath, font)
+    assert fallback_style in FALLBACK_STYLES, f"Fallback style must be one of: {FALLBACK_STYLES}"
+    input_data = load_input_data(input_csv, df, escape_string, verbose)
+
+    s_selector = None
+    measure = ImageDraw.Draw(Image.new("L", (1, 1)))
+    for row, quote, source, image_fpath, outputs in iter_jobs(input_data, image_names, images_fpath,
+                                                              render_style, variant_styles, variant_images, verbose):
+        size = background_size(image_fpath, catalog, max_output_size, background_store)
+        for style, output_name in outputs:
+            style_source = "variant" if variant_styles is not None else ("csv" if render_style == "auto" else "render_style")
+            if missing_style(style):
+                style_source = fallback_style
+                if fallback_style == "saliency":
+                    if s_selector is None:
+                        s_selector = SaliencyStyleSelector(utils.RENDER_STYLE[:-1])
+                    if background_store is not None and image_fpath in background_store:
+                        thumbnail = background_store.get(image_fpath)
+                    else:
+                        thumbnail = Image.open(image_fpath)
+                        thumbnail.draft("RGB", SALIENCY_DRAFT_SIZE)
+                        thumbnail = ImageOps.exif_transpose(thumbnail)
+                    style = s_selector.select(thumbnail)
+                else:
+                    style = utils.RENDER_STYLE[:-1][randint(0, len(utils.RENDER_STYLE[:-1]) - 1)]
+
+            overlay_region, text_region = layout_regions(size, style)
+            fitted_font, text = itools.layout_text(text_region.width(),
+                                                   text_region.height(),
+                                                   quote + " \n\n" + source,
+                                                   font_fpath,
+                                                   TEXT_TARGET_PERCENTAGE,
+                                                   tab_width,
+                                                   (0, font_size))
+            text_bbox = measure.multiline_textbbox(text_region.center(), text, font=fitted_font, anchor="mm")
+
+            yield {
+                "row": row,
+                "output": output_name,
+                "image": image_fpath,
+                "width": size[0],
+                "height": size[1],
+                "style": style,
+                "style_source": style_source,
+                "overlay_box": box_to_list(overlay_region),
+                "text_box": box_to_list(text_region),
+                "font_size": fitted_font.size,
+                "lines": text.split("\n"),
+                "text_bbox": list(text_bbox),
+                "too_small": fitted_font.size < min_font_size,
+                "overflow": text_bbox[2] - text_bbox[0] > text_region.width() or text_bbox[3] - text_bbox[1] > text_region.height()
+            }
+
+def plan(*args, **kwargs) -> List[dict]:
+    """Plans every output, see iter_plan."""
+    return list(iter_plan(*args, **kwargs))
+
+def write_plan(plans: List[dict], fpath: str):
+    """Writes plans as a JSON list, or a CSV with list fields stored as JSON."""
+    extension = os.path.splitext(fpath)[1].lower()
+    assert extension in PLAN_FORMATS, f"Plan files must be one of: {PLAN_FORMATS}"
+
+    if extension == ".json":
+        with open(fpath, "w", encoding="utf-8") as f:
+            json.dump(plans, f, indent=2)
+    else:
+        df = pd.DataFrame(plans)
+        for column in ["overlay_box", "text_box", "lines", "text_bbox"]:
+            df[column] = df[column].map(json.dumps)
+        df.to_csv(fpath, index=False)
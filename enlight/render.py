@@ -2,10 +2,12 @@
 
 import os
 import glob
-import pickle
 
 from hashlib import md5
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from random import randint
+from typing import List
 
 
 # Pillow
@@ -21,11 +23,19 @@ from tqdm import tqdm
 import enlight.utils as utils
 import enlight.image_tools as itools
 
-from enlight.ai.infer import StyleInferer
+from enlight.ai.infer import StyleInferer, ModelWatcher
+from enlight.ai.saliency import SaliencyStyleSelector
+from enlight.catalog import ImageCatalog, EXIF_ORIENTATION
+from enlight.background_store import BackgroundStore
+from enlight.output import OutputSink, open_sink
+from enlight.duplicates import DuplicateIndex
+from enlight.failures import FailureLog
 
 SUPPORTED_IMAGE_FORMATS = ["jpg", "png"]
 SUPPORTED_FONT_FORMATS = ["ttf"]
+FALLBACK_STYLES = ["saliency", "random"]
 DEFAULT_FONT = "ArchivoBlack-Regular.ttf"
+TEXT_TARGET_PERCENTAGE = 0.025
 
 def create_folder_or_get_path(fpath):
     if not os.path.exists(fpath):
@@ -39,34 +49,91 @@ def load_fonts(font_fpath, supported_formats=SUPPORTED_FONT_FORMATS):
         results += list(glob.glob(os.path.join(font_fpath, f"*.{format}")))
     return results
 
-def render(
-    images_fpath: str,
-    output_fpath: str,
-    fonts_fpath: str,
-    input_csv: str,
-    ai_model_file: str,
-    render_style: str = "auto",
-    escape_string: str = "\\",
-    font: str = DEFAULT_FONT,
-    font_size: int = 200,
-    tab_width: int = 4,
-    force: bool = False,
-    df: pd.DataFrame = None
-):
+def load_background(
+    image_fpath: str,
+    catalog: ImageCatalog = None,
+    max_output_size: int = None,
+    scaled_cache: str = None,
+    background_store: BackgroundStore = None) -> Image:
+    """Loads an upright RGB background from the fastest available source."""
+    if background_store is not None and image_fpath in background_store:
+        img = background_store.get(image_fpath)
+    elif max_output_size is not None:
+        img = itools.open_image(itools.cached_image_fpath(image_fpath, scaled_cache), max_output_size)
+    else:
+        img = Image.open(image_fpath)
+        if catalog is None or image_fpath not in catalog or catalog.get(image_fpath)["orientation"] != 1:
+            img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB":
+        return img.convert("RGB")
+
+    # Decode now, on the calling thread, rather than on first use
+    img.load()
+    return img
+
+def background_size(
+    image_fpath: str,
+    catalog: ImageCatalog = None,
+    max_output_size: int = None,
+    background_store: BackgroundStore = None) -> tuple:
+    """Size of the background load_background returns, read from image headers only."""
+    if background_store is not None and image_fpath in background_store:
+        entry = background_store.index[os.path.split(image_fpath)[1]]
+        return (entry["width"], entry["height"])
+
+    if catalog is not None and image_fpath in catalog:
+        size = catalog.oriented_size(image_fpath)
+    else:
+        with Image.open(image_fpath) as img:
+            size = img.size
+            if img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+                size = (size[1], size[0])
+    return itools.scaled_size(size, max_output_size)
+
+def layout_regions(size: tuple, style: str) -> tuple:
+    """Returns the (overlay, text) boxes of a style on a background of the given size."""
+    overlay_region = itools.calculate_margin_style(itools.Box(0, 0, size[0], size[1]), style, 0.05)
+    return overlay_region, itools.calculate_margin_percentage(overlay_region, 0.1)
+
+def compose(img: Image, style: str, text: str, font_fpath: str, font_size: int = 200, tab_width: int = 4) -> Image:
+    """
+    Draws the overlay and text of a style onto a RGB background in place. Only the
+    overlay region is modified, the image is ready to be encoded as is.
+    """
+    overlay_region, text_region = layout_regions(img.size, style)
+
+    # Generate transparent overlay
+    itools.blend_rect(img, overlay_region, color=(0, 0, 0), transparency=0.45)
+
+    # Generate text
+    itools.draw_text_box(img,
+                         text_region,
+                         text,
+                         font_fpath,
+                         target_percentage=TEXT_TARGET_PERCENTAGE,
+                         tab_space = tab_width,
+                         font_range=(0, font_size))
+
+    return img
+
+def load_image_fpaths(images_fpath: str, catalog: ImageCatalog = None, verbose: bool = True) -> List[str]:
     # Generate folder if not already
     create_folder_or_get_path(images_fpath)
-    create_folder_or_get_path(output_fpath)
-    create_folder_or_get_path(fonts_fpath)
 
-    # Image loading
-    image_names = utils.load_image_names(images_fpath)
-    print(f"Images detected {len(image_names)}")
+    if catalog is not None:
+        image_names = catalog.refresh().image_fpaths()
+    else:
+        image_names = utils.load_image_names(images_fpath)
+    if verbose:
+        print(f"Images detected {len(image_names)}")
 
     if len(image_names) == 0:
         print(f"Unable to find supported images. Image files supported: {SUPPORTED_IMAGE_FORMATS}")
         raise RuntimeError(f"No images loaded in: {images_fpath}")
+    return image_names
 
-    # Font loading
+def load_font_fpath(fonts_fpath: str, font: str) -> str:
+    create_folder_or_get_path(fonts_fpath)
     fonts = load_fonts(fonts_fpath)
 
     if len(fonts) == 0:
@@ -75,8 +142,9 @@ def render(
 
     if not any(font == os.path.split(f)[1] for f in fonts):
         raise RuntimeError(f"No specified font in font path: {font}")
+    return os.path.join(fonts_fpath, font)
 
-    # Load CSV file
+def load_input_data(input_csv: str, df: pd.DataFrame = None, escape_string: str = "\\", verbose: bool = True) -> pd.DataFrame:
     assert (df is not None) ^ (input_csv is not None), "One must be given"
     input_data = None
     if df is not None:
@@ -84,80 +152,353 @@ def render(
     else:
         input_data = pd.read_csv(input_csv, escapechar=escape_string)
 
-    print("Loaded CSV file:")
-    print(input_data)
+    if verbose:
+        print("Loaded CSV file:")
+        print(input_data)
 
     if len(input_data) == 0:
         raise RuntimeError(f"No valid CSV loaded in: {input_csv}")
+    return input_data
 
-    ai_model = None
-    try:
-        with open(ai_model_file, "r+b") as f:
-            ai_model = pickle.load(f)
-    except Exception as e:
-        print(f"Unable to load AI model: {str(e)}")
+def check_variants(variant_styles: List[str] = None, variant_images: List[str] = None):
+    if variant_styles is not None:
+        assert len(variant_styles) > 0, "At least one variant style is required."
+        for s in variant_styles:
+            assert s in utils.RENDER_STYLE[:-1], f"Variant styles must be in: {utils.RENDER_STYLE[:-1]}"
+    if variant_images is not None:
+        assert len(variant_images) > 0, "At least one variant image is required."
+
+def missing_style(style) -> bool:
+    return style is None or str(style) == "nan" or len(style) == 0
+
+def output_uid(source: str) -> str:
+    """Start of the output names of a row, outputs are named after their quote source."""
+    return md5(source.encode()).hexdigest()
 
-    # Generate the image
+def iter_jobs(
+    input_data: pd.DataFrame,
+    image_names: List[str],
+    images_fpath: str,
+    render_style: str = "auto",
+    variant_styles: List[str] = None,
+    variant_images: List[str] = None,
+    verbose: bool = True,
+    on_error = None):
+    """
+    Expands CSV rows into one job per background.
+    Yields (row, quote, source, background fpath, [(style, output name)]) in row order.
+    on_error: Called with (row, exception) for rows that can not be read, which are
+    then skipped. Exceptions are raised if not given.
+    """
     style_column = 3
     quotes_column = 2
     source_column = 1
     image_column = 0
-    font_fpath = os.path.join(fonts_fpath, font)
-
-    output_names = []
-    s_infer = StyleInferer(utils.RENDER_STYLE[:-1])
-    progress_bar = tqdm(range(input_data.shape[0]))
-    for _, (_, row) in zip(progress_bar, input_data.iterrows()):
-        quote = row[quotes_column].replace("\\n", "\n")
-        source = row[source_column]
-        style = row[style_column] if render_style == "auto" else render_style
-        image_fpath = str(row[image_column])
-
-        # Sanitize and use random otherwise
-        if image_fpath is None or str(image_fpath) == "nan" or len(image_fpath) == 0:
-            image_fpath = image_names[randint(0, len(image_names) - 1)]
-        else:
-            image_fpath = os.path.join(images_fpath, image_fpath)
 
-        img = Image.open(image_fpath)
-        img = ImageOps.exif_transpose(img)
-        img = img.convert("RGBA")
-        img_size = img.size
-        img_box = itools.Box(0, 0, img_size[0], img_size[1])
-
-        # Generate unique output fpath
-        uid = md5(source.encode()).hexdigest()
-        output_fpath_mod = os.path.join(output_fpath, uid + ".jpg")
-        if os.path.exists(output_fpath_mod) and not force:
-            raise RuntimeError(f"Output already exists for {output_fpath_mod}. Consider use --force to overwrite.")
-
-        # Use AI if applicable!
-        if style is None or str(style) == "nan" or len(style) == 0:
-            # Generated image may have filename removed. Custom set for cache to work.
-            if ai_model is not None:
-                setattr(img, "filename", uid + ".jpg")
-                style = utils.RENDER_STYLE[s_infer.infer([img], [source], [quote], ai_model)[0][0]]
+    progress_bar = tqdm(range(input_data.shape[0]), disable=not verbose)
+    for i, (_, row) in zip(progress_bar, input_data.iterrows()):
+        try:
+            quote = row[quotes_column].replace("\\n", "\n")
+            source = row[source_column]
+            style = row[style_column] if render_style == "auto" else render_style
+            image_fpath = str(row[image_column])
+
+            # Sanitize and use random otherwise
+            if image_fpath is None or str(image_fpath) == "nan" or len(image_fpath) == 0:
+                image_fpath = image_names[randint(0, len(image_names) - 1)]
             else:
-                print("Unable to load AI model. Have you downloaded the model? See README for instructions.")
-                print("Falling back to random styles.")
-                style = utils.RENDER_STYLE[:-1][randint(0, len(utils.RENDER_STYLE[:-1]) - 1)]
-
-        # Generate transparent overlay
-        overlay_region = itools.calculate_margin_style(img_box, style, 0.05)
-        img = itools.draw_rect(img, overlay_region, color=(0, 0, 0), transparency=0.45)
-
-        # Generate text
-        text_region = itools.calculate_margin_percentage(overlay_region, 0.1)
-        itools.draw_text_box(img,
-                             text_region,
-                             quote + " \n\n" + source,
-                             font_fpath,
-                             target_percentage=0.025,
-                             tab_space = tab_width,
-                             font_range=(0, font_size))
-
-        # Save final result
-        img = img.convert("RGB")
-        img.save(output_fpath_mod)
-        output_names.append(output_fpath_mod)
-    return output_names
+                image_fpath = os.path.join(images_fpath, image_fpath)
+
+            # Generate unique output fpath
+            uid = output_uid(source)
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(i, e)
+            continue
+
+        row_images = [os.path.join(images_fpath, i) for i in variant_images] if variant_images is not None else [image_fpath]
+        row_styles = variant_styles if variant_styles is not None else [style]
+
+        for image_fpath in row_images:
+            image_stem = os.path.splitext(os.path.split(image_fpath)[1])[0]
+            outputs = []
+            for style in row_styles:
+                name = [uid]
+                if variant_images is not None:
+                    name.append(image_stem)
+                if variant_styles is not None:
+                    name.append(style)
+                outputs.append((style, "_".join(name) + ".jpg"))
+
+            yield i, quote, source, image_fpath, outputs
+
+class InlineExecutor(Executor):
+    """Runs submitted calls immediately on the calling thread."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def prefetch(pool: ThreadPoolExecutor, fn, items, depth: int):
+    """
+    Maps fn over items on the pool, keeping at most depth results in flight.
+    Yields (item, result) in order. Runs inline if pool is None.
+    """
+    pending = deque()
+    for item in items:
+        if pool is None:
+            yield item, fn(item)
+            continue
+
+        pending.append((item, pool.submit(fn, item)))
+        if len(pending) >= depth:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+    while len(pending) != 0:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+def render(*args, **kwargs):
+    """Renders every row of the CSV and returns the output file names."""
+    return list(iter_render(*args, **kwargs))
+
+def iter_render(
+    images_fpath: str,
+    output_fpath: str,
+    fonts_fpath: str,
+    input_csv: str,
+    ai_model_file: str,
+    render_style: str = "auto",
+    escape_string: str = "\\",
+    font: str = DEFAULT_FONT,
+    font_size: int = 200,
+    tab_width: int = 4,
+    force: bool = False,
+    df: pd.DataFrame = None,
+    ai_backbone: str = "beit",
+    fallback_style: str = "saliency",
+    ai_backbone_fpath: str = None,
+    verbose: bool = True,
+    reload_ai_model: bool = False,
+    catalog: ImageCatalog = None,
+    max_output_size: int = None,
+    background_store: BackgroundStore = None,
+    variant_styles: List[str] = None,
+    variant_images: List[str] = None,
+    io_workers: int = 0,
+    pipeline_depth: int = 4,
+    output_shard_depth: int = 0,
+    failures_fpath: str = None,
+    output_sink: OutputSink = None,
+    duplicates: DuplicateIndex = None,
+    feature_cache_size: int = None,
+    style_inferer: StyleInferer = None
+):
+    """
+    Renders every row of the CSV, yielding each output file name
+    as soon as the row is saved. Takes the same arguments as render().
+    variant_styles: Render each row in every one of these styles.
+    variant_images: Render each row over every one of these backgrounds, relative to images_fpath.
+    Variants are saved as <uid>_<image>_<style>.jpg, naming only what is varied, and
+    share the decoded background and fitted text layouts.
+    io_workers: Threads decoding backgrounds ahead of and encoding outputs behind the
+    compositing loop. 0 does everything in order on the calling thread.
+    pipeline_depth: Max backgrounds decoded ahead and outputs waiting to be written.
+    output_shard_depth: Nest outputs in this many levels of folders named after the start of their name.
+    output_fpath may also be a .tar, .zip or .pack file which outputs are streamed into,
+    see enlight.output. Archive outputs are yielded by name instead of path. s3://bucket/prefix
+    uploads outputs straight from memory to an object store, see enlight.output.S3Sink.
+    failures_fpath: Keep going when a row fails and record it in this CSV instead, see
+    enlight.failures.FailureLog. Rendering the file again retries only the failed rows.
+    output_sink: Write into this sink instead of opening output_fpath. It is left open.
+    duplicates: Rows over near-duplicate backgrounds share one inferred or saliency style
+    per group, and the AI model one feature vector, see enlight.duplicates.
+    feature_cache_size: Max AI feature vectors of backgrounds kept in memory. None keeps every one.
+    style_inferer: Infer styles with this StyleInferer, keeping its feature cache across renders,
+    instead of creating one per render. ai_backbone, ai_backbone_fpath and feature_cache_size are then unused.
+    """
+    check_variants(variant_styles, variant_images)
+    assert io_workers >= 0, "IO workers must not be negative."
+    assert pipeline_depth > 0, "Pipeline depth must be positive."
+
+    image_names = load_image_fpaths(images_fpath, catalog, verbose)
+    font_fpath = load_font_fpath(fonts_fpath, font)
+    assert fallback_style in FALLBACK_STYLES, f"Fallback style must be one of: {FALLBACK_STYLES}"
+    input_data = load_input_data(input_csv, df, escape_string, verbose)
+
+    # Pre-scaled variants from build_scaled_cache are used when up to date
+    scaled_cache = None
+    if max_output_size is not None:
+        assert max_output_size > 0, "Max output size must be positive."
+        scaled_cache = itools.scaled_cache_fpath(images_fpath, max_output_size)
+
+    ai_model = None
+    ai_model_watcher = None
+    try:
+        ai_model_watcher = ModelWatcher(ai_model_file)
+        ai_model = ai_model_watcher.model
+    except Exception as e:
+        if verbose:
+            print(f"Unable to load AI model: {str(e)}")
+
+    failures = FailureLog(failures_fpath, input_data.columns, escape_string) if failures_fpath is not None else None
+
+    def record(row, outputs, stage, e):
+        # Index labels are the row numbers of the full CSV, also for slices of it
+        for _, output_name in outputs:
+            failures.record(input_data.index[row], input_data.iloc[row], output_name, stage, e)
+
+    def checked_jobs():
+        on_error = (lambda row, e: record(row, [(None, None)], "row", e)) if failures is not None else None
+
+        # Outputs of this render, so rows sharing an output name are caught before either is written
+        scheduled = set()
+        # Object stores are listed once, they would otherwise answer a request per output
+        listed = None
+        listing_error = None
+        if not force and sink.list_existing:
+            try:
+                listed = set(sink.names())
+            except Exception as e:
+                if failures is None:
+                    raise
+                listing_error = e
+
+        for job in iter_jobs(input_data, image_names, images_fpath, render_style, variant_styles, variant_images, verbose, on_error):
+            outputs = []
+            for output in job[4]:
+                output_name = output[1]
+                if not force:
+                    try:
+                        if listing_error is not None:
+                            raise listing_error
+                        duplicate = output_name in scheduled
+                        exists = duplicate or (output_name in listed if listed is not None else sink.exists(output_name))
+                    except Exception as e:
+                        if failures is None:
+                            raise
+                        record(job[0], [output], "exists", e)
+                        continue
+
+                    if exists:
+                        e = RuntimeError(f"Output already exists for {output_name}. Consider use --force to overwrite.")
+                        if failures is None:
+                            raise e
+                        if duplicate:
+                            record(job[0], [output], "exists", e)
+                        # Resumed runs skip what is done, only outputs that fail are retried
+                        elif verbose:
+                            print(f"Skipping existing output {output_name}")
+                        continue
+
+                scheduled.add(output_name)
+                outputs.append(output)
+
+            if len(outputs) != 0:
+                yield job[:4] + (outputs, )
+
+    def decode(job):
+        try:
+            return load_background(job[3], catalog, max_output_size, scaled_cache, background_store)
+        except Exception as e:
+            if failures is None:
+                raise
+            return e
+
+    def written(entry):
+        """Result of a pending write, None if it failed and was recorded."""
+        row, output_name, future = entry
+        try:
+            return future.result()
+        except Exception as e:
+            if failures is None:
+                raise
+            record(row, [(None, output_name)], "write", e)
+
+    s_infer = style_inferer
+    s_selector = None
+    group_styles = {}
+    sink = output_sink if output_sink is not None else open_sink(output_fpath, output_shard_depth)
+    pool = ThreadPoolExecutor(max_workers=io_workers) if io_workers > 0 else InlineExecutor()
+    pending_saves = deque()
+    completed = False
+    try:
+        # Decoded once, every variant is composited over the same background
+        for (row, quote, source, image_fpath, outputs), img in prefetch(pool if io_workers > 0 else None, decode, checked_jobs(), pipeline_depth):
+            if isinstance(img, Exception):
+                record(row, outputs, "decode", img)
+                continue
+
+            for i, (style, output_name) in enumerate(outputs):
+                stage = "style"
+                try:
+                    # Use AI if applicable!
+                    if missing_style(style):
+                        group = duplicates.representative(image_fpath) if duplicates is not None else None
+                        if ai_model is not None and reload_ai_model:
+                            reloaded = ai_model_watcher.get()
+                            if reloaded is not ai_model:
+                                group_styles.clear()
+                            ai_model = reloaded
+
+                        if group in group_styles:
+                            style = group_styles[group]
+                        elif ai_model is not None:
+                            if s_infer is None:
+                                s_infer = StyleInferer(utils.RENDER_STYLE[:-1], backbone=ai_backbone, backbone_fpath=ai_backbone_fpath,
+                                                       duplicates=duplicates, max_cache_size=feature_cache_size)
+                            # Features only depend on the background, rows sharing it hit the cache
+                            setattr(img, "filename", image_fpath)
+                            style = utils.RENDER_STYLE[s_infer.infer([img], [source], [quote], ai_model)[0][0]]
+                        elif fallback_style == "saliency":
+                            if s_selector is None:
+                                if verbose:
+                                    print("Unable to load AI model. Falling back to saliency based styles.")
+                                s_selector = SaliencyStyleSelector(utils.RENDER_STYLE[:-1])
+                            style = s_selector.select(img)
+                        else:
+                            print("Unable to load AI model. Have you downloaded the model? See README for instructions.")
+                            print("Falling back to random styles.")
+                            style = utils.RENDER_STYLE[:-1][randint(0, len(utils.RENDER_STYLE[:-1]) - 1)]
+
+                        # Styles only depend on the background, near-duplicates reuse them
+                        if group is not None and (ai_model is not None or fallback_style == "saliency"):
+                            group_styles[group] = style
+
+                    # Save final result
+                    # The last variant draws over the background itself
+                    stage = "compose"
+                    final = img.copy() if i < len(outputs) - 1 else img
+                    compose(final, style, quote + " \n\n" + source, font_fpath, font_size, tab_width)
+                except Exception as e:
+                    if failures is None:
+                        raise
+                    record(row, [(style, output_name)], stage, e)
+                    continue
+
+                # Encoded and written on the pool, yielded in order once saved
+                pending_saves.append((row, output_name, pool.submit(sink.write, output_name, final)))
+                while len(pending_saves) > (pipeline_depth if io_workers > 0 else 0):
+                    output = written(pending_saves.popleft())
+                    if output is not None:
+                        yield output
+
+        while len(pending_saves) != 0:
+            output = written(pending_saves.popleft())
+            if output is not None:
+                yield output
+        completed = True
+    finally:
+        pool.shutdown(wait=True)
+        if output_sink is None:
+            sink.close()
+        if failures is not None:
+            failures.close(completed)
+            if verbose and len(failures) != 0:
+                print(f"{len(failures)} outputs failed, see {failures_fpath}")
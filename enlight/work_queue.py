@@ -0,0 +1,210 @@
+"""
+Shared queue of CSV row ranges for rendering across machines, backed by SQLite.
+"""
+
+import os
+import time
+import socket
+import sqlite3
+
+from typing import Callable, Iterable, List
+
+# pandas
+import pandas as pd
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_POLL_SECONDS = 5
+DEFAULT_MAX_ATTEMPTS = 3
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class WorkQueue:
+    """
+    A coordinator publishes row ranges, workers on any machine that can reach the
+    queue file claim a range under a lease, render it and report its outputs. A
+    range whose lease runs out before it is completed, e.g. a worker died, is
+    handed to the next worker that asks, until it was claimed max_attempts times.
+    It is then marked failed, so a range that always crashes its worker does not
+    hold up the job. The queue file must be on storage where
+    every worker can lock it, such as a local disk or a network share with working locks.
+    """
+
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+        # Transactions are managed explicitly, claims need an immediate write lock
+        self.connection = sqlite3.connect(fpath, timeout=60, isolation_level=None)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS ranges (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                start INTEGER NOT NULL,
+                stop INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS outputs (
+                range_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                output TEXT NOT NULL,
+                PRIMARY KEY (range_id, position)
+            )""")
+
+    def publish(self, row_count: int, range_size: int) -> int:
+        """
+        Splits row_count rows into ranges of range_size. Publishing to a queue that
+        already has ranges does nothing, so a restarted coordinator resumes the job.
+        Returns the number of ranges in the queue.
+        """
+        assert range_size > 0, "Range size must be positive."
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self.connection.execute("SELECT COUNT(*) FROM ranges").fetchone()[0] == 0:
+                self.connection.executemany(
+                    "INSERT INTO ranges (start, stop) VALUES (?, ?)",
+                    [(start, min(start + range_size, row_count)) for start in range(0, row_count, range_size)]
+                )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return len(self)
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM ranges").fetchone()[0]
+
+    def claim(self, worker: str, lease_seconds: float = DEFAULT_LEASE_SECONDS, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        """
+        Leases the next pending or expired range to worker. Expired ranges already
+        claimed max_attempts times are marked failed instead.
+        Returns (range id, start, stop, attempt) or None if nothing is claimable.
+        """
+        assert max_attempts > 0, "Max attempts must be positive."
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("""
+                UPDATE ranges SET state = 'failed', lease_expires = NULL
+                WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?""", (now, max_attempts))
+            row = self.connection.execute("""
+                SELECT id, start, stop, attempts FROM ranges
+                WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)
+                ORDER BY id LIMIT 1""", (now, )).fetchone()
+            if row is not None:
+                self.connection.execute(
+                    "UPDATE ranges SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                    (worker, now + lease_seconds, row[0])
+                )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        return row[0], row[1], row[2], row[3] + 1
+
+    def renew(self, range_id: int, worker: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        """Extends a lease. Returns False if the lease was lost to another worker."""
+        cursor = self.connection.execute(
+            "UPDATE ranges SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + lease_seconds, range_id, worker)
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, range_id: int, worker: str, outputs: List[str]) -> bool:
+        """
+        Records the outputs of a range and marks it done. Returns False, recording
+        nothing, if the lease was lost and the range belongs to another worker.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.connection.execute(
+                "UPDATE ranges SET state = 'done', lease_expires = NULL WHERE id = ? AND worker = ? AND state = 'leased'",
+                (range_id, worker)
+            )
+            if cursor.rowcount == 1:
+                self.connection.execute("DELETE FROM outputs WHERE range_id = ?", (range_id, ))
+                self.connection.executemany(
+                    "INSERT INTO outputs (range_id, position, output) VALUES (?, ?, ?)",
+                    [(range_id, i, o) for i, o in enumerate(outputs)]
+                )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def progress(self) -> dict:
+        """Number of ranges in each state."""
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM ranges GROUP BY state").fetchall())
+
+    def finished(self) -> bool:
+        """True once every range is done or failed."""
+        progress = self.progress()
+        return len(self) != 0 and progress.get("done", 0) + progress.get("failed", 0) == len(self)
+
+    def manifest(self) -> pd.DataFrame:
+        """
+        Every output of the completed ranges in row order, with their range state.
+        Failed ranges are listed once without an output.
+        """
+        return pd.read_sql_query("""
+            SELECT ranges.start, ranges.stop, outputs.output, ranges.state FROM ranges
+            LEFT JOIN outputs ON ranges.id = outputs.range_id
+            WHERE outputs.output IS NOT NULL OR ranges.state = 'failed'
+            ORDER BY ranges.start, outputs.position""", self.connection)
+
+    def wait(self, poll_seconds: float = DEFAULT_POLL_SECONDS, verbose: bool = True):
+        """Blocks until every range is done or failed."""
+        while not self.finished():
+            if verbose:
+                print(f"Ranges: {self.progress()}")
+            time.sleep(poll_seconds)
+
+    def close(self):
+        self.connection.close()
+
+def run_worker(
+    queue: WorkQueue,
+    render_range: Callable[[int, int, bool], Iterable[str]],
+    worker: str = None,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    poll_seconds: float = DEFAULT_POLL_SECONDS,
+    max_ranges: int = None,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> int:
+    """
+    Claims and renders ranges until the queue is finished. render_range(start, stop, force)
+    renders the rows [start, stop) and yields their outputs. force is set when the range was
+    claimed before, as a previous worker may have written some of its outputs. The lease is
+    renewed as outputs are yielded. Ranges claimed max_attempts times without being completed
+    are marked failed. Returns the number of ranges completed.
+    """
+    worker = worker if worker is not None else default_worker_id()
+    completed = 0
+    while max_ranges is None or completed < max_ranges:
+        claimed = queue.claim(worker, lease_seconds, max_attempts)
+        if claimed is None:
+            if queue.finished():
+                break
+
+            # Ranges are still leased by other workers, wait for them to finish or expire
+            time.sleep(poll_seconds)
+            continue
+
+        range_id, start, stop, attempt = claimed
+        outputs = []
+        renewed = time.time()
+        for output in render_range(start, stop, attempt > 1):
+            outputs.append(output)
+            if time.time() - renewed > lease_seconds / 3:
+                # Another worker took over the range, stop rendering it
+                if not queue.renew(range_id, worker, lease_seconds):
+                    break
+                renewed = time.time()
+
+        if queue.complete(range_id, worker, outputs):
+            completed += 1
+    return completed
@@ -3,20 +3,30 @@ Enlightening, an inspirational quote generator.
 """
 # std
 import os
-import glob
 import math
 import random
 import argparse
 
 # enlight
 import enlight.utils as utils
+import enlight.image_tools as itools
 
-from enlight.image_tools import Box
-from enlight.render import render
+from enlight.catalog import ImageCatalog
+from enlight.background_store import BackgroundStore
+from enlight.duplicates import DuplicateIndex, HASH_METHODS, DEFAULT_HASH_METHOD, DEFAULT_MAX_DISTANCE
+from enlight.output import S3Sink, OutputSink, open_sink, is_archive, DEFAULT_UPLOAD_CONNECTIONS
+from enlight.render import render, iter_render, FALLBACK_STYLES
+from enlight.failures import load_failures, DEFAULT_FAILURES_FPATH
+from enlight.plan import plan, write_plan, DEFAULT_MIN_FONT_SIZE
+from enlight.work_queue import WorkQueue, run_worker, DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS
+from enlight.ai.infer import BACKBONES
 
 # PIL
 from PIL import Image
 
+# pandas
+import pandas as pd
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Generates quotes to images.")
 
@@ -26,9 +36,69 @@ def parse_args():
 
     # Folders
     parser.add_argument("--fonts-fpath", default="fonts", help="Folder container valid fonts.")
-    parser.add_argument("--output-fpath", default="output", help="Output folder.")
+    parser.add_argument("--output-fpath", default="output", help="Output folder, a .tar, .zip or .pack file to stream outputs into, or s3://bucket/prefix to upload them to.")
+    parser.add_argument("--output-shard-depth",
+                        default=0,
+                        help="Levels of hash prefix folders outputs are nested in. 0 writes a flat folder.",
+                        type=int)
+    parser.add_argument("--s3-endpoint-url",
+                        default=None,
+                        help="Object store endpoint for s3:// outputs. Defaults to AWS_ENDPOINT_URL, then AWS S3.")
+    parser.add_argument("--upload-connections",
+                        default=DEFAULT_UPLOAD_CONNECTIONS,
+                        help="Pooled connections uploads to s3:// outputs share.",
+                        type=int)
     parser.add_argument("--images-fpath", default="images", help="Default images folder.")
 
+    # Catalog
+    parser.add_argument("--image-catalog",
+                        action="store_true",
+                        default=False,
+                        help="Keep a catalog of image folders in the user cache folder to avoid rescanning and re-reading image headers.")
+    parser.add_argument("--image-catalog-fpath",
+                        default=None,
+                        help="Keep the --image-catalog of --images-fpath in this file instead.")
+    parser.add_argument("--verify-image-catalog",
+                        action="store_true",
+                        default=False,
+                        help="Stat every cataloged image once at startup to pick up images edited in place.")
+
+    # Output size
+    parser.add_argument("--max-output-size",
+                        default=None,
+                        help="Longest side of output images. Backgrounds are decoded at reduced scale.",
+                        type=int)
+    parser.add_argument("--build-scaled-cache",
+                        action="store_true",
+                        default=False,
+                        help="Build backgrounds scaled to --max-output-size next to the images folder, then exit.")
+
+    # Background store
+    parser.add_argument("--background-store",
+                        default=None,
+                        help="Packed store of pre-decoded backgrounds shared by render processes.")
+    parser.add_argument("--build-background-store",
+                        action="store_true",
+                        default=False,
+                        help="Build --background-store from the images folder, scaled to --max-output-size if given, then exit.")
+
+    # Duplicates
+    parser.add_argument("--duplicate-index",
+                        default=None,
+                        help="Perceptual hash index of the images folder. Near-duplicate backgrounds share AI features and styles.")
+    parser.add_argument("--build-duplicate-index",
+                        action="store_true",
+                        default=False,
+                        help="Hash the images folder into --duplicate-index, then exit.")
+    parser.add_argument("--duplicate-hash",
+                        default=DEFAULT_HASH_METHOD,
+                        choices=list(HASH_METHODS.keys()),
+                        help="Perceptual hash used when building --duplicate-index.")
+    parser.add_argument("--duplicate-distance",
+                        default=None,
+                        help=f"Max differing hash bits between near-duplicates. Defaults to the index's, or {DEFAULT_MAX_DISTANCE} when building.",
+                        type=int)
+
     # Files
     parser.add_argument("--input-csv", "-i", default="input.csv", help="Input CSV to generate file.")
     parser.add_argument("--escape-string", "-x", default="\\", help="CSV file valid escape character.")
@@ -49,25 +119,123 @@ def parse_args():
                         help="Type of render style. Auto defaults to csv encoding, otherwise uses AI.",
                         choices=utils.RENDER_STYLE)
 
+    # Pipeline
+    parser.add_argument("--io-workers",
+                        default=0,
+                        help="Threads decoding backgrounds and writing outputs alongside compositing. 0 renders sequentially.",
+                        type=int)
+    parser.add_argument("--pipeline-depth",
+                        default=4,
+                        help="Max backgrounds decoded ahead and outputs waiting to be written with --io-workers.",
+                        type=int)
+
+    # Failures
+    parser.add_argument("--continue-on-error",
+                        action="store_true",
+                        default=False,
+                        help="Record rows that fail to --failures-fpath and keep rendering.")
+    parser.add_argument("--failures-fpath",
+                        default=DEFAULT_FAILURES_FPATH,
+                        help="CSV of failed rows with the stage and error they failed with.")
+    parser.add_argument("--retry-failures",
+                        action="store_true",
+                        default=False,
+                        help="Render only the rows in --failures-fpath again, leaving the rows that still fail in it.")
+
+    # Dry run
+    parser.add_argument("--plan-only",
+                        default=None,
+                        help="Write the layout of every output to this .json or .csv file without rendering, then exit.")
+    parser.add_argument("--min-font-size",
+                        default=DEFAULT_MIN_FONT_SIZE,
+                        help="Outputs planned with a smaller font are flagged as too small.",
+                        type=int)
+
+    # Distributed rendering
+    parser.add_argument("--work-queue",
+                        default=None,
+                        help="SQLite file shared by the coordinator and workers, reachable from every node.")
+    parser.add_argument("--coordinator",
+                        action="store_true",
+                        default=False,
+                        help="Publish the input CSV rows to --work-queue, wait for workers and write the manifest.")
+    parser.add_argument("--worker",
+                        action="store_true",
+                        default=False,
+                        help="Render row ranges claimed from --work-queue until every range is done.")
+    parser.add_argument("--range-size", default=1000, help="Rows per range published by the coordinator.", type=int)
+    parser.add_argument("--lease-timeout",
+                        default=DEFAULT_LEASE_SECONDS,
+                        help="Seconds without progress before a worker's range is handed to another worker.",
+                        type=float)
+    parser.add_argument("--max-attempts",
+                        default=DEFAULT_MAX_ATTEMPTS,
+                        help="Times a range is claimed before it is marked failed instead of handed out again.",
+                        type=int)
+    parser.add_argument("--manifest", default=None, help="Output manifest CSV. Defaults to <work queue>.manifest.csv.")
+
+    # Variants
+    parser.add_argument("--variant-styles",
+                        nargs="+",
+                        default=None,
+                        help="Render every quote in each of these styles. Use 'all' for every style.",
+                        choices=utils.RENDER_STYLE[:-1] + ["all"])
+    parser.add_argument("--variant-images",
+                        nargs="+",
+                        default=None,
+                        help="Render every quote over each of these images from the images folder.")
+
     # AI files
     parser.add_argument("--ai-model-file",
                         default="models/svm_linear_train_in_group_only.pickle",
                         help="The model used for AI inference.")
+    parser.add_argument("--ai-backbone",
+                        default="beit",
+                        help="Feature extractor the AI model was trained with.",
+                        choices=list(BACKBONES.keys()))
+    parser.add_argument("--ai-backbone-fpath",
+                        default=None,
+                        help="Local model folder or archive for the backbone. Loaded without network access.")
+    parser.add_argument("--reload-ai-model",
+                        action="store_true",
+                        default=False,
+                        help="Reload --ai-model-file whenever it changes while rendering.")
+    parser.add_argument("--feature-cache-size",
+                        default=None,
+                        help="Max AI feature vectors of backgrounds kept in memory. Unbounded by default.",
+                        type=int)
+    parser.add_argument("--fallback-style",
+                        default="saliency",
+                        help="How styles are picked when no AI model can be loaded.",
+                        choices=FALLBACK_STYLES)
 
     return parser.parse_args()
 
-def collage(output_fpath, scale=0.2):
-    """A quick and dirty way to build a collage. Useful for gauging how the AI is doing."""
+def collage(output_fpath, scale=0.2, catalog: ImageCatalog = None, shard_depth: int = 0, sink: OutputSink = None):
+    """
+    A quick and dirty way to build a collage. Useful for gauging how the AI is doing.
+    Outputs written to an archive get their collage saved next to the archive.
+    Outputs in a given sink, e.g. an object store, are read from and collaged into it.
+    """
     filename = "collage.jpg"
 
-    generated_images = list(glob.glob(os.path.join(output_fpath, "*.jpg")))
-    generated_images = [g for g in generated_images if filename not in g]
-    load_images = [Image.open(i) for i in generated_images]
-    image_sizes = [i.size for i in load_images]
+    if sink is not None:
+        generated_images = [sink.open(n) for n in sink.names() if n != filename]
+        image_sizes = [i.size for i in generated_images]
+    elif catalog is not None and shard_depth == 0 and not is_archive(output_fpath):
+        catalog.refresh()
+        generated_images = [f for f in catalog.image_fpaths() if f.endswith(".jpg")]
+        generated_images = [g for g in generated_images if filename not in g]
+        image_sizes = [catalog.oriented_size(g) for g in generated_images]
+        generated_images = [Image.open(i) for i in generated_images]
+    else:
+        with open_sink(output_fpath, shard_depth) as output_sink:
+            generated_images = [output_sink.open(n) for n in output_sink.names() if n != filename]
+        image_sizes = [i.size for i in generated_images]
 
     # Calculate nearest square
     square_sizes = int(max([max(*s) for s in image_sizes]) * scale)
-    resized_images = [i.resize((square_sizes, square_sizes), resample=Image.NEAREST) for i in load_images]
+    resized_images = [i.resize((square_sizes, square_sizes), resample=Image.NEAREST) for i in generated_images]
 
     # Shuffle to make it more spicy
     random.shuffle(resized_images)
@@ -88,24 +256,172 @@ def collage(output_fpath, scale=0.2):
         if leave_loop:
             break
 
-    final_image.convert("RGB").save(os.path.join(output_fpath, filename))
+    if sink is not None:
+        return sink.write(filename, final_image.convert("RGB"))
+    if is_archive(output_fpath):
+        collage_fpath = os.path.splitext(output_fpath)[0] + "." + filename
+    else:
+        collage_fpath = os.path.join(output_fpath, filename)
+    final_image.convert("RGB").save(collage_fpath)
+    return collage_fpath
+
+def build_scaled_cache(images_fpath, max_output_size, catalog: ImageCatalog = None):
+    """Pre-scales every background so renders using max_output_size skip large decodes."""
+    assert max_output_size is not None, "--max-output-size is required to build the scaled cache."
+    image_names = catalog.refresh().image_fpaths() if catalog is not None else utils.load_image_names(images_fpath)
+    cache_fpath = itools.scaled_cache_fpath(images_fpath, max_output_size)
+    written = itools.build_scaled_cache(image_names, cache_fpath, max_output_size)
+    print(f"Scaled {len(written)} of {len(image_names)} images into {cache_fpath}")
 
 if __name__ == '__main__':
     args = parse_args()
-    render(
-        args.images_fpath,
-        args.output_fpath,
-        args.fonts_fpath,
-        args.input_csv,
-        args.ai_model_file,
-        args.render_style,
-        args.escape_string,
-        args.font,
-        args.font_size,
-        args.tab_width,
-        args.force,
-        None
+    catalog = ImageCatalog(args.images_fpath, args.image_catalog_fpath) if args.image_catalog else None
+    if catalog is not None and args.verify_image_catalog:
+        catalog.refresh(verify=True)
+
+    if args.build_scaled_cache:
+        build_scaled_cache(args.images_fpath, args.max_output_size, catalog)
+        exit()
+
+    if args.build_background_store:
+        assert args.background_store is not None, "--background-store is required to build a store."
+        image_names = catalog.refresh().image_fpaths() if catalog is not None else utils.load_image_names(args.images_fpath)
+        store = BackgroundStore.build(image_names, args.background_store, args.max_output_size)
+        print(f"Packed {len(store)} images into {args.background_store}")
+        exit()
+
+    if args.build_duplicate_index:
+        assert args.duplicate_index is not None, "--duplicate-index is required to build an index."
+        image_names = catalog.refresh().image_fpaths() if catalog is not None else utils.load_image_names(args.images_fpath)
+        duplicates = DuplicateIndex.build(image_names,
+                                          args.duplicate_hash,
+                                          args.duplicate_distance if args.duplicate_distance is not None else DEFAULT_MAX_DISTANCE)
+        duplicates.save(args.duplicate_index)
+        print(f"Hashed {len(duplicates)} images into {args.duplicate_index}, {len(duplicates.groups())} groups of near-duplicates")
+        exit()
+
+    variant_styles = args.variant_styles
+    if variant_styles is not None and "all" in variant_styles:
+        variant_styles = utils.RENDER_STYLE[:-1]
+
+    if args.plan_only is not None:
+        plans = plan(
+            args.images_fpath,
+            args.fonts_fpath,
+            args.input_csv,
+            args.render_style,
+            args.escape_string,
+            args.font,
+            args.font_size,
+            args.tab_width,
+            fallback_style=args.fallback_style,
+            catalog=catalog,
+            max_output_size=args.max_output_size,
+            background_store=BackgroundStore(args.background_store) if args.background_store is not None else None,
+            variant_styles=variant_styles,
+            variant_images=args.variant_images,
+            min_font_size=args.min_font_size
+        )
+        write_plan(plans, args.plan_only)
+        print(f"Planned {len(plans)} outputs into {args.plan_only}")
+        print(f"Fonts below {args.min_font_size}: {sum(p['too_small'] for p in plans)}, overflowing text: {sum(p['overflow'] for p in plans)}")
+        exit()
+
+    output_sink = None
+    if args.output_fpath.startswith("s3://"):
+        bucket, _, prefix = args.output_fpath[len("s3://"):].partition("/")
+        output_sink = S3Sink(bucket, prefix, args.s3_endpoint_url, max_connections=args.upload_connections)
+
+    render_kwargs = dict(
+        render_style=args.render_style,
+        escape_string=args.escape_string,
+        font=args.font,
+        font_size=args.font_size,
+        tab_width=args.tab_width,
+        ai_backbone=args.ai_backbone,
+        fallback_style=args.fallback_style,
+        ai_backbone_fpath=args.ai_backbone_fpath,
+        reload_ai_model=args.reload_ai_model,
+        catalog=catalog,
+        max_output_size=args.max_output_size,
+        background_store=BackgroundStore(args.background_store) if args.background_store is not None else None,
+        variant_styles=variant_styles,
+        variant_images=args.variant_images,
+        io_workers=args.io_workers,
+        pipeline_depth=args.pipeline_depth,
+        output_shard_depth=args.output_shard_depth,
+        output_sink=output_sink,
+        duplicates=DuplicateIndex.load(args.duplicate_index, args.duplicate_distance) if args.duplicate_index is not None else None,
+        feature_cache_size=args.feature_cache_size
     )
+    failures_fpath = args.failures_fpath if args.continue_on_error or args.retry_failures else None
+
+    if args.coordinator or args.worker:
+        assert args.work_queue is not None, "--work-queue is required for --coordinator and --worker."
+        queue = WorkQueue(args.work_queue)
+        input_data = pd.read_csv(args.input_csv, escapechar=args.escape_string)
+
+        if args.coordinator:
+            print(f"Published {queue.publish(len(input_data), args.range_size)} ranges to {args.work_queue}")
+
+        if args.worker:
+            assert not is_archive(args.output_fpath), "Workers must write to a folder, archives can not be shared."
+            assert not args.retry_failures, "Retry failures of each range without --worker."
+            failures_root, failures_extension = os.path.splitext(failures_fpath) if failures_fpath is not None else (None, None)
+            render_range = lambda start, stop, force: iter_render(
+                args.images_fpath,
+                args.output_fpath,
+                args.fonts_fpath,
+                None,
+                args.ai_model_file,
+                force=args.force or force,
+                df=input_data.iloc[start:stop],
+                verbose=False,
+                failures_fpath=f"{failures_root}.{start}-{stop}{failures_extension}" if failures_fpath is not None else None,
+                **render_kwargs
+            )
+            print(f"Rendered {run_worker(queue, render_range, lease_seconds=args.lease_timeout, max_attempts=args.max_attempts)} ranges")
+
+        if args.coordinator:
+            queue.wait()
+            manifest_fpath = args.manifest if args.manifest is not None else args.work_queue + ".manifest.csv"
+            manifest = queue.manifest()
+            manifest.to_csv(manifest_fpath, index=False)
+            failed = queue.progress().get("failed", 0)
+            print(f"{len(queue) - failed} of {len(queue)} ranges done, {manifest['output'].count()} outputs listed in {manifest_fpath}")
+            if failed != 0:
+                print(f"{failed} ranges failed after {args.max_attempts} attempts, listed without outputs")
+    elif args.retry_failures:
+        # Outputs of failed rows may be partly written, so they are overwritten
+        render(
+            args.images_fpath,
+            args.output_fpath,
+            args.fonts_fpath,
+            None,
+            args.ai_model_file,
+            force=True,
+            df=load_failures(args.failures_fpath, args.escape_string),
+            failures_fpath=failures_fpath,
+            **render_kwargs
+        )
+    else:
+        render(
+            args.images_fpath,
+            args.output_fpath,
+            args.fonts_fpath,
+            args.input_csv,
+            args.ai_model_file,
+            force=args.force,
+            failures_fpath=failures_fpath,
+            **render_kwargs
+        )
 
     if args.collage:
-        collage(args.output_fpath, args.collage_scale)
+        collage(args.output_fpath,
+                args.collage_scale,
+                ImageCatalog(args.output_fpath) if args.image_catalog and not is_archive(args.output_fpath) and output_sink is None else None,
+                args.output_shard_depth,
+                output_sink)
+
+    if output_sink is not None:
+        output_sink.close()
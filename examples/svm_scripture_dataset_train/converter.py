@@ -5,9 +5,12 @@ Converts bible source csv to enlighten csv.
 import re
 import os
 import sys
+import json
+import shlex
 import argparse
 
 from subprocess import run, PIPE
+from concurrent.futures import ThreadPoolExecutor
 
 # pandas
 import pandas as pd
@@ -20,11 +23,23 @@ import bible
 
 RE_FORMAT = r"(.+) \((\w+)\)"
 ENLIGHT_COLUMNS = ["image", "quote_source", "quote", "style"]
+DEFAULT_VERSE_SOURCE = ["python", os.path.join("bible-fetch", "bible")]
+FALLBACK_TRANSLATION = "ESV"
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Converts the a list of Scripture references to Scripture qutoes.")
     parser.add_argument("--output-csv", help="Output to enlighten csv file.", default="enlighten.csv")
     parser.add_argument("--input-csv", help="Input to scripture csv file.", default="input.csv")
+    parser.add_argument("--cache-fpath", help="Cache of fetched verses.", default="verse_cache.json")
+    parser.add_argument("--workers", help="Number of concurrent fetches.", default=8, type=int)
+    parser.add_argument("--batch-size", help="References fetched before the cache is saved.", default=64, type=int)
+    parser.add_argument("--verse-source",
+                        help="Command used to fetch a verse, called with '<reference> --version <translation> --ascii'.",
+                        default=None)
+    parser.add_argument("--batch-verse-source",
+                        action="store_true",
+                        default=False,
+                        help="Fetch each batch in one --verse-source call, see VerseFetcher.fetch_batch.")
     return parser.parse_args()
 
 def sanitize_output(v):
@@ -33,19 +48,107 @@ def sanitize_output(v):
     v = re.sub(";\w+", "; ", v)
     return v
 
-def fetch_verse(verse: bible.Verse):
-    passage_formatted = verse.format("B C:V")
-    cmd = [
-        "python",
-        os.path.join("bible-fetch", "bible"),
-        f"{passage_formatted}",
-        "--version",
-        verse.translation,
-        "--ascii"
-    ]
-    return run(cmd, stdout=PIPE, cwd=SAMPLE_DIR).stdout
-
-def convert(input_fpath: str, output_fpath: str) -> pd.DataFrame:
+class VerseFetcher:
+    """
+    Fetches verses concurrently using a bounded pool. Results are cached
+    on disk keyed by (reference, translation) so each verse is fetched once.
+    """
+
+    def __init__(self, cache_fpath="verse_cache.json", workers=8, batch_size=64, verse_source=None, batch_source=False):
+        """
+        cache_fpath: JSON file to cache verses in. None disables the disk cache.
+        workers: Max number of concurrent fetches.
+        batch_size: Number of references fetched before the cache is saved.
+        verse_source: Command list used to fetch a verse. Defaults to bible-fetch.
+        batch_source: The verse source fetches a whole batch per call, see fetch_batch.
+        Otherwise it is called once per reference, as bible-fetch only takes one.
+        """
+        self.cache_fpath = cache_fpath
+        self.workers = workers
+        self.batch_size = batch_size
+        self.verse_source = DEFAULT_VERSE_SOURCE if verse_source is None else verse_source
+        self.batch_source = batch_source
+
+        self.cache = {}
+        if cache_fpath is not None and os.path.exists(cache_fpath):
+            with open(cache_fpath, "r", encoding="utf-8") as f:
+                self.cache = json.load(f)
+
+    @staticmethod
+    def cache_key(reference, translation):
+        return f"{reference}|{translation}"
+
+    def fetch_uncached(self, reference, translation):
+        cmd = [
+            *self.verse_source,
+            reference,
+            "--version",
+            translation,
+            "--ascii"
+        ]
+        return run(cmd, stdout=PIPE, cwd=SAMPLE_DIR).stdout.decode("utf-8").replace("\r\n", "\n")
+
+    def fetch_batch(self, references):
+        """
+        Fetches (reference, translation) tuples in a single verse source call. It is given
+        '--batch --ascii', reads '<reference>|<translation>' lines from stdin and prints
+        a JSON list of the verses in the same order, empty for missing verses.
+        """
+        cmd = [*self.verse_source, "--batch", "--ascii"]
+        stdin = "".join(f"{reference}|{translation}\n" for reference, translation in references)
+        result = run(cmd, input=stdin.encode("utf-8"), stdout=PIPE, cwd=SAMPLE_DIR)
+        try:
+            verses = json.loads(result.stdout.decode("utf-8"))
+        except ValueError:
+            verses = []
+        # A failed call fetches nothing, its references are retried on the next run
+        if len(verses) != len(references):
+            return [""] * len(references)
+        return [v.replace("\r\n", "\n") for v in verses]
+
+    def save(self):
+        if self.cache_fpath is None:
+            return
+
+        # Write then replace so an interrupted save keeps the old cache
+        tmp_fpath = self.cache_fpath + ".tmp"
+        with open(tmp_fpath, "w", encoding="utf-8") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp_fpath, self.cache_fpath)
+
+    def fetch_all(self, references):
+        """
+        Fetches a list of (reference, translation) tuples. Returns the verses
+        in the same order. Empty strings are returned for missing verses.
+        """
+        # Insertion ordered, so verses are fetched in input order
+        missing = {}
+        for reference, translation in references:
+            key = self.cache_key(reference, translation)
+            if key not in self.cache:
+                missing[key] = (reference, translation)
+
+        keys = list(missing.keys())
+        batches = [keys[start:start + self.batch_size] for start in range(0, len(keys), self.batch_size)]
+
+        print(f"Fetching {len(missing)} uncached verses.")
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            if self.batch_source:
+                # One call per batch, batches are fetched concurrently
+                fetched = pool.map(lambda b: self.fetch_batch([missing[k] for k in b]), batches)
+            else:
+                fetched = (list(pool.map(lambda k: self.fetch_uncached(*missing[k]), b)) for b in batches)
+
+            for batch, results in zip(batches, fetched):
+                for key, result in zip(batch, results):
+                    # Do not cache failures, they are retried on the next run
+                    if len(result.strip()) != 0:
+                        self.cache[key] = result
+                self.save()
+
+        return [self.cache.get(self.cache_key(*r), "") for r in references]
+
+def convert(input_fpath: str, output_fpath: str, fetcher: VerseFetcher = None) -> pd.DataFrame:
     """
     Converts a csv file of "image", "verse", and "style" to
     a csv that enlighten can parse. Uses APIs to fetch verses.
@@ -54,10 +157,13 @@ def convert(input_fpath: str, output_fpath: str) -> pd.DataFrame:
         print("Converted file already exists. Remove to re-fetch.")
         return pd.read_csv(output_fpath)[ENLIGHT_COLUMNS]
 
+    if fetcher is None:
+        fetcher = VerseFetcher()
+
     bible_csv = pd.read_csv(input_fpath)
 
     verse_column = 1
-    bible_passage = []
+    references = []
     for _, row in bible_csv.iterrows():
         passage = row[verse_column]
         parsed = re.match(RE_FORMAT, passage)
@@ -66,19 +172,19 @@ def convert(input_fpath: str, output_fpath: str) -> pd.DataFrame:
         assert len(parsed.group(2)) > 0, "Must have valid translation."
 
         verse_format = bible.Verse(parsed.group(1))
-        verse_format.translation = parsed.group(2)
-
-        print(f"Fetching: {verse_format.format('B C:V')}")
-        result = fetch_verse(verse_format)
+        references.append((verse_format.format("B C:V"), parsed.group(2)))
 
+    bible_passage = fetcher.fetch_all(references)
 
-        if len(result.strip()) == 0:
-            print(f"Translation does not exist? {verse_format.translation}")
-            verse_format.translation = "ESV"
-            result = fetch_verse(verse_format)
-            assert len(result.strip()) != 0, "Invalid passage given."
+    # Retry missing translations in a single fallback batch
+    missing = [i for i, result in enumerate(bible_passage) if len(result.strip()) == 0]
+    for i in missing:
+        print(f"Translation does not exist? {references[i][1]}")
 
-        bible_passage.append(result.decode("utf-8").replace("\r\n", "\n"))
+    fallback = fetcher.fetch_all([(references[i][0], FALLBACK_TRANSLATION) for i in missing])
+    for i, result in zip(missing, fallback):
+        assert len(result.strip()) != 0, f"Invalid passage given: {references[i][0]}"
+        bible_passage[i] = result
 
     bible_csv.loc[:, "quote"] =  bible_passage
     bible_csv.rename(columns={"verse": "quote_source"}, inplace=True)
@@ -91,7 +197,14 @@ def convert(input_fpath: str, output_fpath: str) -> pd.DataFrame:
 def main():
     """Saves unsantized result to output_csv but returns a sanitized df."""
     args = parse_args()
-    df = convert(args.input_csv, args.output_csv)
+    fetcher = VerseFetcher(
+        args.cache_fpath,
+        args.workers,
+        args.batch_size,
+        None if args.verse_source is None else shlex.split(args.verse_source),
+        args.batch_verse_source
+    )
+    df = convert(args.input_csv, args.output_csv, fetcher)
     df["quote"] = df["quote"].map(sanitize_output)
 
     return df
@@ -11,18 +11,32 @@ import sys
 import re
 import pickle
 import random
+import shutil
 import argparse
 import tempfile
 
+from contextlib import ExitStack, closing
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 # faker
 from faker import Faker
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(ROOT_DIR, os.pardir, os.pardir))
 
+# PIL
+from PIL import Image
+
 # enlighten
-from enlight.render import render
+from enlight.render import iter_render, output_uid
+from enlight.failures import load_failures
 from enlight.ai.data_generator import PseudoRandomImageCSVDataGenerator
+from enlight.ai.infer import StyleInferer, BACKBONES, save_model
+from enlight.utils import RENDER_STYLE
+
+# labels
+from label_store import LabelStore, image_hash, DEFAULT_LABEL_STORE, LEGACY_LOOK_UP_TABLE
 
 # pandas
 import pandas as pd
@@ -34,6 +48,13 @@ def parse_args():
     parser.add_argument("--fonts-fpath", default="fonts", help="Folder container valid fonts.")
 
     parser.add_argument("--batch-size", "-b", default=256, help="Size of labels to generate at once.", type=int)
+    parser.add_argument("--render-workers", default=os.cpu_count(), help="Background render workers.", type=int)
+    parser.add_argument("--ai-model-file", default=None, help="Current model. Enables uncertainty ranked batches.")
+    parser.add_argument("--backbone", default="beit", help="Feature extractor of the model.", choices=list(BACKBONES.keys()))
+    parser.add_argument("--backbone-fpath", default=None, help="Local model folder or archive for the backbone.")
+    parser.add_argument("--candidate-factor", default=8, help="Candidates scored per rendered image when ranking.", type=int)
+    parser.add_argument("--feature-cache-size", default=1024, help="Max image features kept in memory between batches.", type=int)
+    parser.add_argument("--label-store", default=DEFAULT_LABEL_STORE, help="SQLite file labels are appended to.")
 
     return parser.parse_args()
 
@@ -62,23 +83,102 @@ def random_pick_from_csv(csv_path, batch):
             yield (row["quote_source"], row["quote"])
     return _impl
 
+def failures_fpath(review_dir, worker):
+    return os.path.join(os.path.dirname(review_dir), f"failures.{worker}.csv")
+
+def stream_render(args, df, review_dir, pool):
+    """
+    Renders rows on background workers. Each finished image is moved
+    into review_dir as it completes, in order of the given DataFrame.
+    Rows that fail are skipped and recorded in failures_fpath(review_dir, worker)
+    instead of aborting the batch, see load_render_failures.
+    Returns a future per worker of (index, filename) pairs.
+    """
+    def _worker(worker, worker_df):
+        # Outputs are named after the quote source, rows are matched back in order
+        rows = defaultdict(deque)
+        for idx, source in zip(worker_df.index, worker_df["quote_source"]):
+            rows[output_uid(source) + ".jpg"].append(idx)
+
+        rendered = []
+        # Each worker renders to its own staging folder so partial files are never reviewed
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(review_dir)) as staging_dir:
+            names = iter_render(
+                args.images_fpath,
+                staging_dir,
+                args.fonts_fpath,
+                None,
+                None,
+                df=worker_df,
+                force=True, # incase there is collision
+                verbose=False,
+                failures_fpath=failures_fpath(review_dir, worker)
+            )
+            for name in names:
+                filename = os.path.split(name)[1]
+                shutil.move(name, os.path.join(review_dir, filename))
+                rendered.append((rows[filename].popleft(), filename))
+        return rendered
+
+    if df.shape[0] == 0:
+        return []
+
+    # Interleave rows so every worker starts with the first rows
+    workers = max(1, min(args.render_workers, df.shape[0]))
+    return [pool.submit(_worker, i, df.iloc[i::workers]) for i in range(workers)]
+
+def load_render_failures(review_dir, workers):
+    """Rows of every stream_render worker that failed to render."""
+    failures = [load_failures(failures_fpath(review_dir, i)) for i in range(workers)
+                if os.path.exists(failures_fpath(review_dir, i))]
+    return pd.concat(failures, ignore_index=True) if len(failures) != 0 else pd.DataFrame()
+
+def image_area(images_fpath, image_name):
+    """Pixel count from the image header."""
+    with Image.open(os.path.join(images_fpath, image_name)) as img:
+        return img.size[0] * img.size[1]
+
+def select_uncertain(args, inferer, model, df, k):
+    """
+    Ranks (image, style) candidates by the model's uncertainty and keeps the top k,
+    most uncertain first. Image features are cached by the inferer across rounds.
+    """
+    # Closed, not just exited, once their features are extracted so their pixels are freed
+    with ExitStack() as stack:
+        imgs = {n: stack.enter_context(closing(Image.open(os.path.join(args.images_fpath, n)))) for n in df["image"].unique()}
+        uncertainty = inferer.uncertainty([imgs[n] for n in df["image"]], list(df["style"]), model)
+    return df.assign(uncertainty=uncertainty).sort_values("uncertainty", kind="stable").head(k)
+
 def main():
     args = parse_args()
 
     # Start interactive session and train
     batch = args.batch_size
 
-    look_up_table = None
-    if os.path.exists("look_table.pickle"):
-        with open("look_table.pickle", "r+b") as f:
-            look_up_table = pickle.load(f)
-            print(f"Lookup table loaded: {len(look_up_table)}")
-    else:
-        print("New lookup table.")
-        look_up_table = {}
+    store = LabelStore(args.label_store)
+    if len(store) == 0 and os.path.exists(LEGACY_LOOK_UP_TABLE):
+        print(f"Imported {store.import_look_up_table(LEGACY_LOOK_UP_TABLE, args.images_fpath)} labels from {LEGACY_LOOK_UP_TABLE}")
+    print(f"Label store loaded: {len(store)}")
+
+    # Image hashes are only calculated once per session
+    image_hashes = {}
+    def _image_hash(image_name):
+        if image_name not in image_hashes:
+            image_hashes[image_name] = image_hash(os.path.join(args.images_fpath, image_name))
+        return image_hashes[image_name]
+
+    # Active learning renders only the candidates the model is least sure of
+    inferer = None
+    model = None
+    if args.ai_model_file is not None:
+        with open(args.ai_model_file, "r+b") as f:
+            model = pickle.load(f)
+        inferer = StyleInferer(RENDER_STYLE[:-1], args.backbone, args.backbone_fpath, max_cache_size=args.feature_cache_size)
+        print(f"Ranking {batch * args.candidate_factor} candidates per batch by uncertainty.")
+        if not hasattr(model, "partial_fit"):
+            print("Model does not support incremental updates. Retrain with train.py to fold in new labels.")
 
     # generate a folder with all the temp values
-    feature_cache = {}
     while True:
         seed = int(random.random() * 10**32)
 
@@ -88,18 +188,27 @@ def main():
         else:
             text_gen = fake_text(batch, 3, seed)
 
-        generator = PseudoRandomImageCSVDataGenerator(int(random.random() * 10**32), text_gen, args.images_fpath, batch - 1)
-        generator._feature_cache = feature_cache
+        candidates = batch if model is None else batch * args.candidate_factor
+        generator = PseudoRandomImageCSVDataGenerator(int(random.random() * 10**32), text_gen, args.images_fpath, candidates - 1)
         data_df = generator.generate()
 
         with tempfile.TemporaryDirectory() as temp_dir:
             # Render
             # Remove any we know to be valid
+            look_up_table = store.latest()
             data_df["drop"] = data_df["image"] + data_df["style"]
-            not_sure_df = data_df[data_df["drop"].map(lambda v: v not in look_up_table or random.randint(0, 100) < 98)]
+            data_df["known"] = [look_up_table.get(k) for k in zip(data_df["image"], data_df["style"])]
+            if model is None:
+                not_sure_df = data_df[data_df["known"].map(lambda v: v is None or random.randint(0, 100) < 98)]
+            else:
+                # Known pairs are never re-checked, only unknown pairs are ranked
+                data_df = data_df.drop_duplicates(["image", "style"])
+                unknown_df = data_df[data_df["known"].map(lambda v: v is None)]
+                not_sure_df = select_uncertain(args, inferer, model, unknown_df, batch)
+                data_df = pd.concat([not_sure_df, data_df[data_df["known"].map(lambda v: v is not None)]])
             sure_df = data_df[~data_df["drop"].isin(not_sure_df["drop"])]
-            sure_no_df = sure_df[sure_df["drop"].map(lambda v: not look_up_table[v])]
-            sure_yes_df = sure_df[sure_df["drop"].map(lambda v: look_up_table[v])]
+            sure_no_df = sure_df[sure_df["known"].map(lambda v: not v)]
+            sure_yes_df = sure_df[sure_df["known"].map(lambda v: v)]
 
             print("Cache has eliminated: {}".format(sure_df.shape[0]))
             print(sure_no_df.shape[0])
@@ -108,39 +217,64 @@ def main():
             print(data_df.shape[0])
             assert sure_no_df.shape[0] + sure_yes_df.shape[0] + not_sure_df.shape[0] == data_df.shape[0]
 
-            names = render(
-                args.images_fpath,
-                temp_dir,
-                args.fonts_fpath,
-                None,
-                None,
-                df=not_sure_df,
-                force=True # incase there is collision
-            )
-
-            filenames = [os.path.split(n)[1] for n in names]
-            not_sure_df.loc[:, "filenames"] = filenames
-
-            print("A list of images have been generated at:")
-            print(temp_dir)
-            print("Delete the ones you don't want.")
-
-            confirm = None
-            while confirm != "y":
-                confirm = input("Type y, e to exit: ")
-                if confirm == "e":
-                    exit()
-
-            new_files = os.listdir(temp_dir)
+            # Show the most uncertain images first, otherwise the smallest which render fastest
+            if model is None:
+                areas = {n: image_area(args.images_fpath, n) for n in not_sure_df["image"].unique()}
+                not_sure_df = not_sure_df.assign(area=not_sure_df["image"].map(areas)).sort_values("area", kind="stable")
+
+            review_dir = os.path.join(temp_dir, "review")
+            os.mkdir(review_dir)
+            with ThreadPoolExecutor(max_workers=max(1, args.render_workers)) as pool:
+                futures = stream_render(args, not_sure_df, review_dir, pool)
+
+                print("A list of images are being generated at:")
+                print(review_dir)
+                print("Delete the ones you don't want.")
+
+                confirm = None
+                while True:
+                    confirm = input("Type y, e to exit: ")
+                    if confirm == "e":
+                        exit()
+
+                    remaining = sum(not f.done() for f in futures)
+                    if confirm == "y" and remaining == 0:
+                        break
+                    if confirm == "y":
+                        print(f"{remaining} workers are still rendering. Review the remaining images then type y again.")
+
+                # A worker that fails as a whole loses only its own rows
+                rendered = []
+                for f in futures:
+                    try:
+                        rendered += f.result()
+                    except Exception as e:
+                        print(f"Render worker failed: {e}")
+
+            failures = load_render_failures(review_dir, len(futures))
+            if failures.shape[0] != 0:
+                print(f"{failures.shape[0]} rows failed to render and are left unlabeled:")
+                print(failures[["image", "stage", "error"]])
+
+            not_sure_df = not_sure_df.loc[[idx for idx, _ in rendered]]
+            not_sure_df.loc[:, "filenames"] = [filename for _, filename in rendered]
+
+            new_files = os.listdir(review_dir)
             new_sure_df = not_sure_df[not_sure_df["filenames"].isin(new_files)]
             removed_not_sure_df = not_sure_df[~not_sure_df["drop"].isin(new_sure_df["drop"])]
 
-            # Update lookup
-            for _, row in new_sure_df.iterrows():
-                look_up_table[row["drop"]] = True
+            # Append new labels
+            records = [(_image_hash(row["image"]), row["image"], row["style"], True) for _, row in new_sure_df.iterrows()]
+            records += [(_image_hash(row["image"]), row["image"], row["style"], False) for _, row in removed_not_sure_df.iterrows()]
+            store.add_many(records)
 
-            for _, row in removed_not_sure_df.iterrows():
-                look_up_table[row["drop"]] = False
+            # Fold accepted labels into the model, renders using --reload-ai-model pick it up
+            if model is not None and hasattr(model, "partial_fit") and new_sure_df.shape[0] != 0:
+                with ExitStack() as stack:
+                    imgs = [stack.enter_context(closing(Image.open(os.path.join(args.images_fpath, n)))) for n in new_sure_df["image"]]
+                    model = inferer.partial_train(imgs, [], [], list(new_sure_df["style"]), model)
+                save_model(model, args.ai_model_file)
+                print(f"Updated model with {new_sure_df.shape[0]} labels.")
 
             data_df = pd.merge(new_sure_df, sure_df, how="outer")
 
@@ -149,18 +283,7 @@ def main():
             print(data_df)
             print()
 
-            # Cannot train if only two result output for multiclass, must have atleast 3
-            if data_df.size <= 2:
-                continue
-
-            # Write snapshot
-            with open("look_table.pickle", "w+b") as f:
-                pickle.dump(look_up_table, f)
-
             print("SAVED TRAINING DATA")
 
-            # Save feature cache across sessions
-            feature_cache = generator._feature_cache
-
 if __name__ == "__main__":
     main()
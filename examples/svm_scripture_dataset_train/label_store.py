@@ -0,0 +1,97 @@
+"""
+Append-only store of image style labels backed by SQLite.
+"""
+
+import os
+import pickle
+import sqlite3
+import hashlib
+
+# pandas
+import pandas as pd
+
+DEFAULT_LABEL_STORE = "labels.sqlite"
+LEGACY_LOOK_UP_TABLE = "look_table.pickle"
+LABEL_COLUMNS = ["image_hash", "image", "style", "in"]
+
+def image_hash(fpath: str) -> str:
+    """Content hash of an image file."""
+    h = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class LabelStore:
+    """
+    Every verdict is appended as a new record, the latest verdict
+    for an (image, style) pair wins. Writes never rewrite old labels
+    so a crash loses at most the batch being written.
+    """
+
+    def __init__(self, fpath: str = DEFAULT_LABEL_STORE):
+        self.fpath = fpath
+        self.connection = sqlite3.connect(fpath)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS labels (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                image_hash TEXT,
+                image_name TEXT NOT NULL,
+                style TEXT NOT NULL,
+                verdict INTEGER NOT NULL
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS labels_pair ON labels (image_name, style, id)")
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(DISTINCT image_name || '/' || style) FROM labels").fetchone()[0]
+
+    def add_many(self, records):
+        """Appends (image_hash, image_name, style, verdict) records in one transaction."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO labels (image_hash, image_name, style, verdict) VALUES (?, ?, ?, ?)",
+                [(h, name, style, int(bool(verdict))) for h, name, style, verdict in records]
+            )
+
+    def add(self, image_hash, image_name, style, verdict):
+        self.add_many([(image_hash, image_name, style, verdict)])
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Bulk reads the latest verdict for every (image, style) pair."""
+        df = pd.read_sql_query("""
+            SELECT image_hash, image_name, style, verdict FROM labels
+            WHERE id IN (SELECT MAX(id) FROM labels GROUP BY image_name, style)
+            ORDER BY id""", self.connection)
+        df.columns = LABEL_COLUMNS
+        df["in"] = df["in"].astype(bool)
+        return df
+
+    def latest(self) -> dict:
+        """Returns {(image, style): verdict} of the latest verdicts."""
+        df = self.to_dataframe()
+        return dict(zip(zip(df["image"], df["style"]), df["in"]))
+
+    def import_look_up_table(self, fpath: str = LEGACY_LOOK_UP_TABLE, images_fpath: str = None):
+        """
+        Imports a legacy look_table.pickle keyed by image name + style.
+        Hashes are only recorded if images_fpath is given and the image exists.
+        """
+        with open(fpath, "r+b") as f:
+            look_up_table = pickle.load(f)
+
+        records = []
+        for k, v in look_up_table.items():
+            image_name, style = k.split(".jpg")
+            image_name += ".jpg"
+
+            h = None
+            if images_fpath is not None and os.path.exists(os.path.join(images_fpath, image_name)):
+                h = image_hash(os.path.join(images_fpath, image_name))
+            records.append((h, image_name, style, v))
+        self.add_many(records)
+        return len(records)
+
+    def close(self):
+        self.connection.close()
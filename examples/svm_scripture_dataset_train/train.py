@@ -17,9 +17,12 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(ROOT_DIR, os.pardir, os.pardir))
 
 # enlighten
-from enlight.ai.infer import StyleInferer
+from enlight.ai.infer import StyleInferer, BACKBONES
 from enlight.utils import RENDER_STYLE
 
+# labels
+from label_store import LabelStore, DEFAULT_LABEL_STORE
+
 # sklearn
 from sklearn import svm
 from sklearn.multioutput import MultiOutputClassifier
@@ -29,6 +32,8 @@ def parse_args():
     parser.add_argument("--output-fpath", default="output", help="Output folder.")
     parser.add_argument("--images-fpath", help="Default images folder", default="images")
     parser.add_argument("--test-data-csv", default="enlighten.csv", help="CSV containing test data.")
+    parser.add_argument("--label-store", default=DEFAULT_LABEL_STORE, help="SQLite label store from generate_data.py.")
+    parser.add_argument("--backbone", default="beit", help="Feature extractor to train with.", choices=list(BACKBONES.keys()))
     return parser.parse_args()
 
 def load_images(args, data):
@@ -143,6 +148,14 @@ def svm_poly_train_full_group(args, inferer, train_data, test_data):
     calculate_accuracy(predictions, test_data)
     return model
 
+@model_function("sgd_train_in_group_only")
+def sgd_train_in_group_only(args, inferer, train_data, test_data):
+    """Online linear model which generate_data.py can update incrementally."""
+    model = inferer.partial_train(load_images(args, train_data), [], [], list(train_data["style"]))
+    predictions = inferer.infer(load_images(args, test_data), [], [], model)
+    calculate_accuracy(predictions, test_data)
+    return model
+
 @model_function("svm_train_full_group")
 def svm_train_full_group(args, inferer, train_data, test_data):
     clf = svm.SVC(decision_function_shape="ovo", kernel="poly")
@@ -158,33 +171,29 @@ def svm_train_full_group(args, inferer, train_data, test_data):
 def main():
     args = parse_args()
 
-    training_data = {}
-    with open("look_table.pickle", "r+b") as f:
-        training_data = pickle.load(f)
-
-    expanded = [(*k.split(".jpg"), v) for k, v in training_data.items()]
-    expanded = [(e[0] + ".jpg", *e[1:]) for e in expanded]
-
     test_data = pd.read_csv(args.test_data_csv)
-    df = pd.DataFrame.from_records(expanded, columns=["image", "style", "in"])
+    df = LabelStore(args.label_store).to_dataframe()[["image", "style", "in"]]
 
     # Positive only
     df = df[df["in"]]
 
     # linear techs
-    svm_linear_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1]), df.copy(), test_data)
-    svm_ovr_linear_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1]), df.copy(), test_data)
-    svm_linear_train_full_group(args, StyleInferer(RENDER_STYLE[:-1]), df.copy(), test_data)
+    svm_linear_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
+    svm_ovr_linear_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
+    svm_linear_train_full_group(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
+
+    # online techs
+    sgd_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
 
     # rbf techs
-    svm_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1]), df.copy(), test_data)
-    svm_ovr_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1]), df.copy(), test_data)
-    svm_poly_train_full_group(args, StyleInferer(RENDER_STYLE[:-1]), df.copy(), test_data)
+    svm_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
+    svm_ovr_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
+    svm_poly_train_full_group(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
 
     # Poly techs
-    svm_poly_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1]), df.copy(), test_data)
-    svm_ovr_poly_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1]), df.copy(), test_data)
-    svm_train_full_group(args, StyleInferer(RENDER_STYLE[:-1]), df.copy(), test_data)
+    svm_poly_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
+    svm_ovr_poly_train_in_group_only(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
+    svm_train_full_group(args, StyleInferer(RENDER_STYLE[:-1], args.backbone), df.copy(), test_data)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+"""
+Benchmarks the AI style path offline with a tiny randomly initialised BEiT and
+an SVM trained on it. Runs without network access or the full model.
+
+    python tests/benchmark_ai.py --images 32 --rows 256
+"""
+
+# std
+import os
+import sys
+import time
+import argparse
+
+from tempfile import TemporaryDirectory
+
+# numpy
+import numpy as np
+
+# Pillow
+from PIL import Image
+
+# pandas
+import pandas as pd
+
+# Setup import path
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TEST_DIR, os.pardir))
+
+from conftest import generate_perlin_image, save_tiny_beit, train_tiny_svm, GENERATE_IMG_RESOLUTION
+
+# enlight
+import enlight.render as render_module
+
+from enlight.utils import RENDER_STYLE, load_image_names
+from enlight.ai.infer import StyleInferer, ModelWatcher
+
+DEFAULT_BATCH_SIZES = [1, 4, 16, 64]
+
+def benchmark_features(inferer: StyleInferer, imgs: list) -> dict:
+    """Cold feature extraction throughput over every image."""
+    inferer.clear_cache()
+    start = time.perf_counter()
+    inferer.feature_vectors(imgs)
+    elapsed = time.perf_counter() - start
+    return {"images": len(imgs), "seconds": elapsed, "images_per_second": len(imgs) / elapsed}
+
+def benchmark_predict(inferer: StyleInferer, imgs: list, model, repeats: int = 100) -> dict:
+    """Latency of predicting a single cached image, as render does per row."""
+    inferer.feature_vectors(imgs)
+    latencies = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        inferer.infer([imgs[i % len(imgs)]], [], [], model)
+        latencies.append(time.perf_counter() - start)
+    return {"median_ms": np.median(latencies) * 1000, "p95_ms": np.percentile(latencies, 95) * 1000}
+
+def benchmark_batches(inferer: StyleInferer, imgs: list, model, batch_sizes: list = DEFAULT_BATCH_SIZES) -> list:
+    """Cold infer() time per image for each feature batch size."""
+    results = []
+    for batch_size in batch_sizes:
+        inferer.batch_size = batch_size
+        inferer.clear_cache()
+        start = time.perf_counter()
+        inferer.infer(imgs, [], [], model)
+        elapsed = time.perf_counter() - start
+        results.append({"batch_size": batch_size, "ms_per_image": elapsed / len(imgs) * 1000})
+    return results
+
+def benchmark_render(images_fpath, fonts_fpath, output_fpath, ai_model_file, backbone_fpath, rows: int) -> dict:
+    """Renders rows over random backgrounds with the AI model, reporting the feature cache hit rate."""
+    inferers = []
+    class RecordingInferer(StyleInferer):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            inferers.append(self)
+
+    names = [os.path.split(f)[1] for f in load_image_names(images_fpath)]
+    df = pd.DataFrame.from_records(
+        [(names[i % len(names)], f"Source {i}", f"Quote number {i} with a few words.", "") for i in range(rows)],
+        columns=["image", "quote_source", "quote", "style"]
+    )
+
+    render_module.StyleInferer = RecordingInferer
+    try:
+        start = time.perf_counter()
+        render_module.render(images_fpath, output_fpath, fonts_fpath, None, ai_model_file,
+                             df=df, ai_backbone_fpath=backbone_fpath, verbose=False, force=True)
+        elapsed = time.perf_counter() - start
+    finally:
+        render_module.StyleInferer = StyleInferer
+
+    inferer = inferers[0]
+    lookups = inferer.cache_hits + inferer.cache_misses
+    return {
+        "rows": rows,
+        "rows_per_second": rows / elapsed,
+        "cache_hits": inferer.cache_hits,
+        "cache_misses": inferer.cache_misses,
+        "hit_rate": inferer.cache_hits / lookups if lookups != 0 else 0.0
+    }
+
+def run_benchmark(workspace_fpath, fonts_fpath, image_count: int = 16, rows: int = 64,
+                  batch_sizes: list = DEFAULT_BATCH_SIZES) -> dict:
+    images_fpath = os.path.join(workspace_fpath, "benchmark_images")
+    os.makedirs(images_fpath, exist_ok=True)
+    for i in range(image_count):
+        generate_perlin_image(*GENERATE_IMG_RESOLUTION).save(os.path.join(images_fpath, f"{i}.jpg"))
+    image_fpaths = load_image_names(images_fpath)
+
+    backbone_fpath = save_tiny_beit(os.path.join(workspace_fpath, "benchmark_beit"))
+    ai_model_file = train_tiny_svm(backbone_fpath, image_fpaths, os.path.join(workspace_fpath, "benchmark_svm.pickle"))
+
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="beit", backbone_fpath=backbone_fpath)
+    model = ModelWatcher(ai_model_file).model
+    imgs = [Image.open(f) for f in image_fpaths]
+
+    return {
+        "features": benchmark_features(inferer, imgs),
+        "predict": benchmark_predict(inferer, imgs, model),
+        "batches": benchmark_batches(inferer, imgs, model, batch_sizes),
+        "render": benchmark_render(images_fpath, fonts_fpath, os.path.join(workspace_fpath, "benchmark_output"),
+                                   ai_model_file, backbone_fpath, rows)
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of the AI style path.")
+    parser.add_argument("--images", default=32, help="Random backgrounds to generate.", type=int)
+    parser.add_argument("--rows", default=256, help="Rows rendered through render().", type=int)
+    parser.add_argument("--batch-sizes", default=DEFAULT_BATCH_SIZES, nargs="+", help="Feature batch sizes to time.", type=int)
+    parser.add_argument("--fonts-fpath", default=os.path.join(TEST_DIR, os.pardir, "fonts"), help="Fonts folder.")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as workspace:
+        results = run_benchmark(workspace, args.fonts_fpath, args.images, args.rows, args.batch_sizes)
+
+    features, predict, render = results["features"], results["predict"], results["render"]
+    print(f"Feature extraction: {features['images_per_second']:.1f} images/s over {features['images']} images")
+    print(f"Predict latency: {predict['median_ms']:.2f} ms median, {predict['p95_ms']:.2f} ms p95")
+    for batch in results["batches"]:
+        print(f"Batch size {batch['batch_size']}: {batch['ms_per_image']:.2f} ms/image")
+    print(f"Render: {render['rows_per_second']:.1f} rows/s, feature cache hit rate {render['hit_rate']:.0%} "
+          f"({render['cache_hits']} hits, {render['cache_misses']} misses)")
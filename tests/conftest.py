@@ -27,11 +27,17 @@ import pytest
 TEST_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(TEST_DIR, os.pardir))
 
+# hugging_face
+from transformers import BeitConfig, BeitFeatureExtractor, BeitModel
+
 # enlight
 from enlight.render import render
+from enlight.utils import RENDER_STYLE, load_image_names
+from enlight.ai.infer import StyleInferer, save_model
 
 GENERATE_IMAGE_COUNT = 5
 GENERATE_IMG_RESOLUTION = (300, 400)
+TINY_BEIT_IMAGE_SIZE = 32
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -98,8 +104,44 @@ def fonts_folder(workspace_fpath):
     copytree(os.path.join(TEST_DIR, os.pardir, "fonts"), dest)
     return dest
 
+def save_tiny_beit(dest):
+    """Saves a small randomly initialised BEiT model to dest."""
+    config = BeitConfig(
+        image_size=TINY_BEIT_IMAGE_SIZE,
+        patch_size=16,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64
+    )
+    feature_extractor = BeitFeatureExtractor(size=TINY_BEIT_IMAGE_SIZE, crop_size=TINY_BEIT_IMAGE_SIZE)
+    feature_extractor.save_pretrained(dest)
+    BeitModel(config).save_pretrained(dest)
+    return dest
+
+def train_tiny_svm(backbone_fpath, image_fpaths, model_fpath):
+    """Trains and saves an SVM over the tiny BEiT features of image_fpaths, cycling through styles."""
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="beit", backbone_fpath=backbone_fpath)
+    imgs = [Image.open(f) for f in image_fpaths]
+    save_model(inferer.train(imgs, [], [], [RENDER_STYLE[i % 3] for i in range(len(imgs))]), model_fpath)
+    return model_fpath
+
+@pytest.fixture(scope="session")
+def tiny_beit_folder(workspace_fpath):
+    """
+    A small randomly initialised BEiT model saved locally so the AI path
+    can run without any downloads.
+    """
+    return save_tiny_beit(os.path.join(workspace_fpath, "tiny_beit"))
+
+@pytest.fixture(scope="session")
+def ai_model_file(ai_model_folder, tiny_beit_folder, image_folder):
+    """An SVM trained on the tiny BEiT, so render() takes the AI path."""
+    os.makedirs(ai_model_folder, exist_ok=True)
+    return train_tiny_svm(tiny_beit_folder, load_image_names(image_folder), os.path.join(ai_model_folder, "svm.pickle"))
+
 @pytest.fixture(scope="session")
-def enlighten_render_csv(image_folder, fonts_folder, ai_model_folder):
+def enlighten_render_csv(image_folder, fonts_folder, ai_model_file, tiny_beit_folder):
     """
     Helper wrapper function to wrap around render function.
     """
@@ -109,7 +151,8 @@ def enlighten_render_csv(image_folder, fonts_folder, ai_model_folder):
             output_folder,
             fonts_folder,
             input_csv,
-            os.path.join(ai_model_folder, "svm.pickle")
+            ai_model_file,
+            ai_backbone_fpath=tiny_beit_folder
         )
 
     return _render
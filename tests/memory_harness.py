@@ -0,0 +1,178 @@
+"""
+Drives render() and StyleInferer for many iterations and reports memory growth per
+iteration, from tracemalloc snapshots and RSS samples. Exits with an error when
+growth is over budget. Renders share one long-lived StyleInferer, as a long labeling
+or serving session does, so its bounded feature cache is exercised across renders.
+
+    python tests/memory_harness.py --iterations 2000 --budget-bytes 512
+"""
+
+# std
+import gc
+import os
+import sys
+import argparse
+import tracemalloc
+
+from tempfile import TemporaryDirectory
+from typing import Callable
+
+# numpy
+import numpy as np
+
+# Pillow
+from PIL import Image
+
+# pandas
+import pandas as pd
+
+# psutil is optional, RSS is not sampled without it
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Setup import path
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TEST_DIR, os.pardir))
+
+# enlight
+from enlight.render import render
+from enlight.image_tools import text_mask
+from enlight.utils import RENDER_STYLE, load_image_names
+from enlight.ai.infer import StyleInferer, save_model
+
+DEFAULT_BUDGET_BYTES = 512
+RSS_SAMPLES = 20
+
+# Masks the text mask cache holds in the render loop, which cycles through more quotes than that
+DEFAULT_TEXT_MASK_CACHE_SIZE = 16
+QUOTES_PER_CACHED_MASK = 4
+
+def rss():
+    return psutil.Process().memory_info().rss if psutil is not None else None
+
+def measure_growth(step: Callable[[int], None], iterations: int, warmup: int = None) -> dict:
+    """
+    Calls step(i) warmup times to fill caches, then iterations times between two
+    tracemalloc snapshots. RSS growth per iteration is the slope of RSS samples
+    taken across the measured iterations.
+    """
+    warmup = warmup if warmup is not None else max(1, iterations // 10)
+
+    # Traced from the start, so memory the warmup allocates and a later iteration frees is subtracted
+    tracemalloc.start()
+    for i in range(warmup):
+        step(i)
+
+    gc.collect()
+    start = tracemalloc.take_snapshot()
+    samples = []
+    every = max(1, iterations // RSS_SAMPLES)
+    for i in range(iterations):
+        step(warmup + i)
+        if psutil is not None and (i + 1) % every == 0:
+            samples.append((i + 1, rss()))
+
+    gc.collect()
+    stats = tracemalloc.take_snapshot().compare_to(start, "lineno")
+    tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "traced_growth_per_iteration": sum(s.size_diff for s in stats) / iterations,
+        "rss_growth_per_iteration": np.polyfit(*zip(*samples), 1)[0] if len(samples) > 1 else None,
+        "top": [str(s) for s in stats[:5]]
+    }
+
+def check_budget(result: dict, budget_bytes: float, rss_budget_bytes: float = None):
+    """Fails when traced, or given a budget RSS, growth per iteration is over budget."""
+    report = "\n".join([f"Traced growth: {result['traced_growth_per_iteration']:.1f} B/iteration"] + result["top"])
+    assert result["traced_growth_per_iteration"] <= budget_bytes, f"Memory growth over {budget_bytes} B/iteration.\n{report}"
+    if rss_budget_bytes is not None and result["rss_growth_per_iteration"] is not None:
+        assert result["rss_growth_per_iteration"] <= rss_budget_bytes, \
+            f"RSS growth of {result['rss_growth_per_iteration']:.1f} B/iteration over {rss_budget_bytes}.\n{report}"
+
+def inferer_step(inferer: StyleInferer, size: tuple = (32, 32)) -> Callable[[int], None]:
+    """Extracts features of a new image every iteration, as a long labeling session does."""
+    def _step(i):
+        img = Image.new("RGB", size, (i % 256, (i // 256) % 256, 0))
+        img.filename = f"image_{i}.jpg"
+        inferer.feature_vectors([img])
+    return _step
+
+def render_step(images_fpath: str, fonts_fpath: str, output_fpath: str, ai_model_file: str = None,
+                rows: int = 2, quotes: int = None, feature_cache_size: int = None, **kwargs) -> Callable[[int], None]:
+    """
+    Renders a few rows over the same backgrounds every iteration, as generate_data.py does,
+    with one StyleInferer keeping at most feature_cache_size feature vectors across every render.
+    quotes: Cycle through this many quotes instead of new ones every iteration. With more
+    quotes than the text mask cache holds, masks are evicted and rendered again every
+    iteration, and the cache reaches its bound during a short warmup.
+    """
+    names = [os.path.split(f)[1] for f in load_image_names(images_fpath)]
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="region-stats", max_cache_size=feature_cache_size)
+    def _step(i):
+        q = i % quotes if quotes is not None else i
+        df = pd.DataFrame.from_records(
+            [(names[(i + r) % len(names)], f"Source {q}", f"Quote number {q} with a few words.", "") for r in range(rows)],
+            columns=["image", "quote_source", "quote", "style"]
+        )
+        render(images_fpath, output_fpath, fonts_fpath, None, ai_model_file, df=df, force=True, verbose=False,
+               style_inferer=inferer, **kwargs)
+    _step.inferer = inferer
+    return _step
+
+def train_region_stats_model(image_fpaths, model_fpath):
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="region-stats")
+    imgs = [Image.open(f) for f in image_fpaths]
+    save_model(inferer.train(imgs, [], [], [RENDER_STYLE[i % 3] for i in range(len(imgs))]), model_fpath)
+    return model_fpath
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory growth of long running render and inference loops.")
+    parser.add_argument("--iterations", default=2000, help="Measured iterations of each loop.", type=int)
+    parser.add_argument("--render-iterations", default=200, help="Measured iterations of the render loop.", type=int)
+    parser.add_argument("--budget-bytes", default=DEFAULT_BUDGET_BYTES, help="Max traced growth per iteration.", type=float)
+    parser.add_argument("--rss-budget-bytes", default=None, help="Max RSS growth per iteration. Reported only if not set.", type=float)
+    parser.add_argument("--feature-cache-size", default=None, help="StyleInferer max_cache_size. Unbounded if not set.", type=int)
+    parser.add_argument("--text-mask-cache-size",
+                        default=DEFAULT_TEXT_MASK_CACHE_SIZE,
+                        help="Masks the text mask cache holds, the render loop cycles through more quotes.",
+                        type=int)
+    parser.add_argument("--fonts-fpath", default=os.path.join(TEST_DIR, os.pardir, "fonts"), help="Fonts folder.")
+    args = parser.parse_args()
+
+    # Only needed standalone, the test suite imports this module without conftest
+    from conftest import generate_perlin_image
+
+    with TemporaryDirectory() as workspace:
+        images_fpath = os.path.join(workspace, "images")
+        os.mkdir(images_fpath)
+        for i in range(4):
+            generate_perlin_image(300, 400).save(os.path.join(images_fpath, f"{i}.jpg"))
+        ai_model_file = train_region_stats_model(load_image_names(images_fpath), os.path.join(workspace, "svm.pickle"))
+
+        # Renders warm up until the text mask cache is full
+        text_mask.max_size = args.text_mask_cache_size
+        quotes = args.text_mask_cache_size * QUOTES_PER_CACHED_MASK
+        loops = {
+            "StyleInferer": (inferer_step(StyleInferer(RENDER_STYLE[:-1], backbone="region-stats",
+                                                       max_cache_size=args.feature_cache_size)), args.iterations, None),
+            "render": (render_step(images_fpath, args.fonts_fpath, os.path.join(workspace, "output"), ai_model_file,
+                                   quotes=quotes, feature_cache_size=args.feature_cache_size), args.render_iterations, quotes + 1)
+        }
+
+        failed = False
+        for name, (step, iterations, warmup) in loops.items():
+            result = measure_growth(step, iterations, warmup)
+            rss_growth = result["rss_growth_per_iteration"]
+            print(f"{name}: {result['traced_growth_per_iteration']:.1f} B/iteration traced, "
+                  f"{'n/a' if rss_growth is None else f'{rss_growth:.1f}'} B/iteration RSS over {iterations} iterations")
+            try:
+                check_budget(result, args.budget_bytes, args.rss_budget_bytes)
+            except AssertionError as e:
+                print(e)
+                failed = True
+
+    sys.exit(1 if failed else 0)
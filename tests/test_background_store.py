@@ -0,0 +1,37 @@
+"""
+Tests the packed background store.
+"""
+
+import os
+
+# numpy
+import numpy as np
+
+# enlight
+import enlight.image_tools as itools
+
+from enlight.utils import load_image_names
+from enlight.render import render
+from enlight.background_store import BackgroundStore
+
+from test_render import make_df
+
+def test_background_store(image_folder, fonts_folder, workspace_fpath):
+    image_names = load_image_names(image_folder)
+    store_fpath = os.path.join(workspace_fpath, "backgrounds.bin")
+    built = BackgroundStore.build(image_names, store_fpath, max_size=320)
+    built.close()
+
+    store = BackgroundStore(store_fpath)
+    assert store.names() == sorted(os.path.split(n)[1] for n in image_names)
+    for name in image_names:
+        img = store.get(name)
+        assert img.readonly
+        assert max(img.size) == 320
+        expected = itools.open_image(name, 320).convert("RGBA")
+        assert np.array_equal(np.asarray(img), np.asarray(expected))
+
+    output_folder = os.path.join(workspace_fpath, "background_store_output")
+    names = render(image_folder, output_folder, fonts_folder, None, None,
+                   df=make_df(3), background_store=store, verbose=False)
+    assert len(names) == 3
@@ -0,0 +1,73 @@
+"""
+Tests the persistent image catalog.
+"""
+
+import os
+import shutil
+
+# Pillow
+from PIL import Image
+
+# enlight
+from enlight.utils import load_image_names
+from enlight.catalog import ImageCatalog, default_catalog_fpath
+from enlight.render import render
+from enlight.ai.data_generator import PseudoRandomImageCSVDataGenerator
+
+from test_render import make_df
+
+def test_catalog_refresh(image_folder, workspace_fpath):
+    folder = os.path.join(workspace_fpath, "catalog_images")
+    shutil.copytree(image_folder, folder)
+
+    catalog_fpath = os.path.join(workspace_fpath, "catalog_images.catalog.json")
+    catalog = ImageCatalog(folder, catalog_fpath).refresh()
+    assert catalog.image_fpaths() == sorted(load_image_names(folder))
+    assert os.path.exists(catalog_fpath)
+    for name in catalog.names():
+        with Image.open(os.path.join(folder, name)) as img:
+            assert catalog.oriented_size(name) == img.size
+        assert catalog.get(name)["orientation"] == 1
+
+    # Reloaded catalogs do not read unchanged images again
+    reloaded = ImageCatalog(folder, catalog_fpath)
+    reloaded.read_record = None
+    assert reloaded.refresh().records == catalog.records
+
+    # Images modified in place are only picked up when verified, the folder did not change
+    names = catalog.names()
+    folder_mtime = os.stat(folder).st_mtime_ns
+    Image.new("RGB", (30, 40)).save(os.path.join(folder, names[0]))
+    os.utime(folder, ns=(folder_mtime, folder_mtime))
+    assert ImageCatalog(folder, catalog_fpath).refresh().oriented_size(names[0]) != (30, 40)
+    assert ImageCatalog(folder, catalog_fpath).refresh(verify=True).oriented_size(names[0]) == (30, 40)
+
+    # New and removed images are picked up
+    Image.new("RGB", (20, 10)).save(os.path.join(folder, "new.png"))
+    os.remove(os.path.join(folder, names[1]))
+
+    refreshed = ImageCatalog(folder, catalog_fpath).refresh()
+    assert refreshed.image_fpaths() == sorted(load_image_names(folder))
+    assert refreshed.oriented_size("new.png") == (20, 10)
+    assert refreshed.oriented_size(names[0]) == (30, 40)
+    assert names[1] not in refreshed
+
+def test_catalog_render_and_generate(image_folder, fonts_folder, workspace_fpath):
+    catalog = ImageCatalog(image_folder, os.path.join(workspace_fpath, "images.catalog.json"))
+    output_folder = os.path.join(workspace_fpath, "catalog_output")
+    names = render(image_folder, output_folder, fonts_folder, None, None, df=make_df(3), verbose=False, catalog=catalog)
+    assert len(names) == 3
+
+    quotes = [("Source", "Quote")] * 4
+    generated = PseudoRandomImageCSVDataGenerator(1234, lambda: iter(quotes), image_folder, catalog=catalog).generate()
+    expected = PseudoRandomImageCSVDataGenerator(1234, lambda: iter(quotes), image_folder).generate()
+    assert generated.equals(expected)
+
+def test_default_catalog_location(image_folder, workspace_fpath, monkeypatch):
+    """Catalogs are kept in the user cache folder, never next to the image folder."""
+    monkeypatch.setenv("XDG_CACHE_HOME", os.path.join(workspace_fpath, "cache"))
+    catalog = ImageCatalog(image_folder).refresh()
+    assert catalog.catalog_fpath == default_catalog_fpath(image_folder)
+    assert os.path.exists(catalog.catalog_fpath)
+    assert catalog.catalog_fpath.startswith(os.path.join(workspace_fpath, "cache"))
+    assert not os.path.exists(os.path.normpath(os.path.abspath(image_folder)) + ".catalog.json")
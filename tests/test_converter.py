@@ -0,0 +1,70 @@
+"""
+Tests the verse fetcher of the scripture example against a stand-in verse source.
+"""
+
+import os
+import sys
+import json
+
+# pytest
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TEST_DIR, os.pardir, "examples", "svm_scripture_dataset_train"))
+
+from converter import VerseFetcher
+
+# Logs every call, prints nothing for references starting with "Missing"
+VERSE_SOURCE = """
+import sys, json
+with open(sys.argv[1], "a") as f:
+    f.write(" ".join(sys.argv[2:]) + "\\n")
+verse = lambda r, t: "" if r.startswith("Missing") else f"Text of {r} in {t}"
+if "--batch" in sys.argv:
+    print(json.dumps([verse(*line.split("|")) for line in sys.stdin.read().splitlines()]))
+else:
+    print(verse(sys.argv[2], sys.argv[4]), end="")
+"""
+
+def make_verse_source(folder):
+    """Stand-in verse source command and the file its calls are logged to."""
+    os.makedirs(folder)
+    script = os.path.join(folder, "verse_source.py")
+    with open(script, "w", encoding="utf-8") as f:
+        f.write(VERSE_SOURCE)
+    log = os.path.join(folder, "calls.log")
+    open(log, "w").close()
+    return [sys.executable, script, log], log
+
+def calls(log):
+    with open(log, "r", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+REFERENCES = [(f"John 3:{i}", "NIV") for i in range(5)] + [("John 3:0", "NIV"), ("Missing 1:1", "NIV")]
+
+@pytest.mark.parametrize("batch_source", [False, True])
+def test_fetch_all_caches_verses(workspace_fpath, batch_source):
+    folder = os.path.join(workspace_fpath, f"verse_source_{batch_source}")
+    command, log = make_verse_source(folder)
+    cache_fpath = os.path.join(folder, "verse_cache.json")
+    fetcher = VerseFetcher(cache_fpath, workers=2, batch_size=2, verse_source=command, batch_source=batch_source)
+
+    verses = fetcher.fetch_all(REFERENCES)
+    assert verses[:6] == [f"Text of John 3:{i} in NIV" for i in [0, 1, 2, 3, 4, 0]]
+    assert verses[6] == ""
+
+    # Duplicates are fetched once, in a call per batch of 2 or per reference
+    assert len(calls(log)) == (3 if batch_source else 6)
+    with open(cache_fpath, "r", encoding="utf-8") as f:
+        assert len(json.load(f)) == 5
+
+    # Cached verses are not fetched again, missing verses are retried
+    reloaded = VerseFetcher(cache_fpath, verse_source=command, batch_source=batch_source)
+    assert reloaded.fetch_all(REFERENCES) == verses
+    assert calls(log)[-1].startswith("--batch" if batch_source else "Missing 1:1")
+    assert len(calls(log)) == (4 if batch_source else 7)
+
+def test_failed_batch_is_not_cached():
+    fetcher = VerseFetcher(None, batch_size=4, verse_source=[sys.executable, "-c", "print('not json')"], batch_source=True)
+    assert fetcher.fetch_all(REFERENCES[:3]) == ["", "", ""]
+    assert fetcher.cache == {}
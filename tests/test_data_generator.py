@@ -6,6 +6,8 @@ render function.
 import os
 import random
 
+from concurrent.futures import ThreadPoolExecutor
+
 from conftest import GENERATE_IMAGE_COUNT
 
 # pytest
@@ -69,3 +71,37 @@ def test_pseudo_random_generator(enlighten_render_csv, basic_text_generator, wor
 
 def test_image_folder_count(image_folder):
     assert GENERATE_IMAGE_COUNT == len(os.listdir(image_folder))
+
+def test_chunked_generation(basic_text_generator, workspace_fpath, image_folder, seed):
+    """
+    Chunked and streamed CSV output should match a single generate() call.
+    """
+    expected = PseudoRandomImageCSVDataGenerator(seed, basic_text_generator(), image_folder).generate()
+
+    chunks = list(PseudoRandomImageCSVDataGenerator(seed, basic_text_generator(), image_folder).generate_chunks(2))
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    assert pd.concat(chunks, ignore_index=True).equals(expected)
+
+    output_fpath = os.path.join(workspace_fpath, "chunked.csv")
+    PseudoRandomImageCSVDataGenerator(seed, basic_text_generator(), image_folder).generate_csv(output_fpath, chunk_size=2)
+    assert pd.read_csv(output_fpath).equals(expected)
+
+def test_sharded_generation(basic_text_generator, image_folder, seed):
+    """
+    Row ranges generated concurrently should match a serial run and leave
+    global random state untouched.
+    """
+    # Faker shares its random state, so materialize quotes before using threads
+    quotes = list(basic_text_generator()())
+    text_generator = lambda: iter(quotes)
+
+    state = random.getstate()
+    expected = PseudoRandomImageCSVDataGenerator(seed, text_generator, image_folder).generate()
+    assert random.getstate() == state
+
+    generator = PseudoRandomImageCSVDataGenerator(seed, text_generator, image_folder)
+    ranges = [(0, 2), (2, 3), (3, None)]
+    with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        shards = list(pool.map(lambda r: generator.generate(*r), ranges))
+
+    assert pd.concat(shards, ignore_index=True).equals(expected)
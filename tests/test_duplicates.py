@@ -0,0 +1,93 @@
+"""
+Tests the perceptual hash index of near-duplicate backgrounds.
+"""
+
+import os
+
+# numpy
+import numpy as np
+
+# pytest
+import pytest
+
+# Pillow
+from PIL import Image
+
+# enlight
+from enlight.render import render
+from enlight.utils import RENDER_STYLE, load_image_names
+from enlight.ai.infer import StyleInferer, RegionStatsBackbone
+from enlight.ai.saliency import SaliencyStyleSelector
+from enlight.ai.data_generator import PseudoRandomImageCSVDataGenerator
+from enlight.duplicates import DuplicateIndex, hash_images, hamming_distances, HASH_METHODS
+
+from test_render import make_df
+
+@pytest.fixture(scope="module")
+def duplicate_folder(image_folder, workspace_fpath):
+    """The generated images plus a resized and a re-encoded copy of the first two."""
+    folder = os.path.join(workspace_fpath, "duplicate_images")
+    os.mkdir(folder)
+    for i, fpath in enumerate(sorted(load_image_names(image_folder))):
+        img = Image.open(fpath).convert("RGB")
+        img.save(os.path.join(folder, f"{i}.jpg"))
+        if i < 2:
+            img.resize((img.size[0] * 4 // 5, img.size[1] * 4 // 5)).save(os.path.join(folder, f"{i}_small.jpg"), quality=60)
+            img.save(os.path.join(folder, f"{i}_export.png"))
+    return folder
+
+@pytest.mark.parametrize("method", list(HASH_METHODS.keys()))
+def test_duplicate_groups(duplicate_folder, workspace_fpath, method):
+    duplicates = DuplicateIndex.build(load_image_names(duplicate_folder), method)
+    assert duplicates.groups() == [["0.jpg", "0_export.png", "0_small.jpg"], ["1.jpg", "1_export.png", "1_small.jpg"]]
+    assert duplicates.representative(os.path.join(duplicate_folder, "1_small.jpg")) == "1.jpg"
+    assert duplicates.representative("unknown.jpg") == "unknown.jpg"
+    assert len(duplicates.representatives()) == 5
+
+    fpath = os.path.join(workspace_fpath, f"duplicates.{method}.json")
+    duplicates.save(fpath)
+    loaded = DuplicateIndex.load(fpath)
+    assert loaded.hashes == duplicates.hashes
+    assert loaded.groups() == duplicates.groups()
+    assert DuplicateIndex.load(fpath, max_distance=-1).groups() == []
+
+def test_hamming_distances(duplicate_folder):
+    hashes = hash_images(load_image_names(duplicate_folder))
+    expected = [[bin(int(a) ^ int(b)).count("1") for b in hashes] for a in hashes]
+    assert np.array_equal(hamming_distances(hashes, hashes), expected)
+
+def test_inferer_shares_duplicate_features(duplicate_folder):
+    class CountingBackbone(RegionStatsBackbone):
+        calls = 0
+
+        def extract(self, img):
+            CountingBackbone.calls += 1
+            return super().extract(img)
+
+    img_names = load_image_names(duplicate_folder)
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone=CountingBackbone(), duplicates=DuplicateIndex.build(img_names))
+    imgs = [Image.open(f) for f in img_names]
+    model = inferer.train(imgs, [], [], [RENDER_STYLE[i % 3] for i in range(len(imgs))])
+    inferer.infer(imgs, [], [], model)
+    assert CountingBackbone.calls == len(inferer._feature_cache) == 5
+
+def test_render_shares_duplicate_styles(duplicate_folder, fonts_folder, workspace_fpath, monkeypatch):
+    calls = []
+    select = SaliencyStyleSelector.select
+    monkeypatch.setattr(SaliencyStyleSelector, "select", lambda self, img: calls.append(img) or select(self, img))
+
+    df = make_df(6)
+    df["image"] = ["0.jpg", "0_small.jpg", "0_export.png", "1_small.jpg", "1.jpg", "2.jpg"]
+    duplicates = DuplicateIndex.build(load_image_names(duplicate_folder))
+    render(duplicate_folder, os.path.join(workspace_fpath, "duplicate_output"), fonts_folder, None, None,
+           df=df, verbose=False, duplicates=duplicates)
+    assert len(calls) == 3
+
+def test_generator_skips_duplicates(duplicate_folder):
+    def text_generator():
+        for i in range(200):
+            yield (f"Source {i}", f"Quote {i}")
+
+    duplicates = DuplicateIndex.build(load_image_names(duplicate_folder))
+    df = PseudoRandomImageCSVDataGenerator(0, text_generator, duplicate_folder, 199, duplicates=duplicates).generate()
+    assert set(df["image"]) == set(duplicates.representatives())
@@ -0,0 +1,88 @@
+"""
+Tests the interactive labeling helpers of the scripture example.
+"""
+
+import os
+import sys
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TEST_DIR, os.pardir, "examples", "svm_scripture_dataset_train"))
+
+import generate_data
+
+from generate_data import stream_render, load_render_failures, select_uncertain
+
+# pytest
+import pytest
+
+# pandas
+import pandas as pd
+
+# Pillow
+from PIL import Image
+
+# enlight
+from enlight.render import output_uid
+from enlight.ai.infer import StyleInferer, ModelWatcher
+from enlight.utils import RENDER_STYLE, load_image_names
+
+from test_render import make_df
+from memory_harness import train_region_stats_model
+
+def test_stream_render(image_folder, fonts_folder, workspace_fpath):
+    """Outputs are moved into the review folder and mapped back to their rows, failed rows are recorded."""
+    review_dir = os.path.join(workspace_fpath, "stream_render", "review")
+    os.makedirs(review_dir)
+    args = argparse.Namespace(images_fpath=image_folder, fonts_fpath=fonts_folder, render_workers=2)
+
+    df = make_df(5, style="top")
+    df["image"] = [os.path.split(f)[1] for f in load_image_names(image_folder)][:5]
+    df.loc[3, "image"] = "missing.jpg"
+    df.index = [10, 11, 12, 13, 14]
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = stream_render(args, df, review_dir, pool)
+        results = [f.result() for f in futures]
+
+    # Workers take interleaved rows, each in order of the DataFrame
+    assert [[idx for idx, _ in r] for r in results] == [[10, 12, 14], [11]]
+    rendered = [r for result in results for r in result]
+    for idx, filename in rendered:
+        assert filename == output_uid(df.loc[idx, "quote_source"]) + ".jpg"
+    assert sorted(os.listdir(review_dir)) == sorted(filename for _, filename in rendered)
+
+    # Staging folders are removed, the failed row is left for the reviewer
+    assert sorted(os.listdir(os.path.dirname(review_dir))) == ["failures.0.csv", "failures.1.csv", "review"]
+    failures = load_render_failures(review_dir, len(futures))
+    assert (list(failures["row"]), list(failures["stage"])) == ([13], ["decode"])
+
+def test_select_uncertain(image_folder, workspace_fpath, monkeypatch):
+    """Candidates are ranked most uncertain first, and every image opened for it is closed."""
+    image_fpaths = load_image_names(image_folder)
+    model = ModelWatcher(train_region_stats_model(image_fpaths, os.path.join(workspace_fpath, "uncertain_svm.pickle"))).model
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="region-stats")
+
+    names = [os.path.split(f)[1] for f in image_fpaths]
+    candidates = pd.DataFrame([(n, s) for n in names for s in RENDER_STYLE[:3]], columns=["image", "style"])
+
+    opened = []
+    open_image = Image.open
+    monkeypatch.setattr(generate_data.Image, "open", lambda *a, **kw: opened.append(open_image(*a, **kw)) or opened[-1])
+    args = argparse.Namespace(images_fpath=image_folder)
+    selected = select_uncertain(args, inferer, model, candidates, 4)
+
+    assert len(selected) == 4
+    assert list(selected["uncertainty"]) == sorted(selected["uncertainty"])
+    with monkeypatch.context() as m:
+        m.setattr(generate_data.Image, "open", open_image)
+        expected = inferer.uncertainty([Image.open(os.path.join(image_folder, n)) for n in candidates["image"]],
+                                       list(candidates["style"]), model)
+    assert list(selected["uncertainty"]) == sorted(expected)[:4]
+
+    assert len(opened) == len(names)
+    for img in opened:
+        with pytest.raises(ValueError, match="closed"):
+            img.getpixel((0, 0))
@@ -0,0 +1,72 @@
+"""
+Tests the image helper tools.
+"""
+
+import os
+
+# numpy
+import numpy as np
+
+# Pillow
+from PIL import Image, ImageDraw
+
+# enlight
+import enlight.image_tools as itools
+
+TEXT = "Let love be sincere. Hate what is evil; cling to what is good. \n\nRomans 12:9 (NIV)"
+
+def test_cached_text_matches_direct_draw(fonts_folder):
+    """Cached text masks should be pixel identical to drawing text directly."""
+    font_fpath = os.path.join(fonts_folder, "ArchivoBlack-Regular.ttf")
+    background = Image.new("RGBA", (800, 600), (30, 60, 90, 255))
+    itools.text_mask.cache_clear()
+
+    for box in [itools.Box(40, 30, 760, 570), itools.Box(20.5, 300, 400, 580.5)]:
+        expected = background.copy()
+        font, text = itools.layout_text(box.width(), box.height(), TEXT, font_fpath, 0.025, 4, (1, 200))
+        ImageDraw.Draw(expected).text(box.center(), text, fill=(255, 255, 255), anchor="mm", font=font)
+
+        for _ in range(2):
+            result = background.copy()
+            itools.draw_text_box(result, box, TEXT, font_fpath, 0.025, 4, font_range=(1, 200))
+            assert np.array_equal(np.asarray(result), np.asarray(expected))
+
+    info = itools.text_mask.cache_info()
+    assert info.misses == 2
+    assert info.hits == 2
+
+def test_text_mask_cache_bounded_by_bytes(fonts_folder, monkeypatch):
+    """Masks are dropped least recently used first once their total size is over max_bytes."""
+    font_fpath = os.path.join(fonts_folder, "ArchivoBlack-Regular.ttf")
+    itools.text_mask.cache_clear()
+    masks = [itools.text_mask(f"Quote {i}", font_fpath, 400, 300) for i in range(3)]
+    sizes = [m.size[0] * m.size[1] for m, _ in masks]
+    assert itools.text_mask.cache_info().bytes == sum(sizes)
+
+    # Room for the last two masks only, the least recently used first one is dropped
+    itools.text_mask.cache_clear()
+    monkeypatch.setattr(itools.text_mask, "max_bytes", sum(sizes[1:]))
+    for i in range(3):
+        itools.text_mask(f"Quote {i}", font_fpath, 400, 300)
+    info = itools.text_mask.cache_info()
+    assert (info.currsize, info.bytes) == (2, sum(sizes[1:]))
+
+    itools.text_mask("Quote 0", font_fpath, 400, 300)
+    assert itools.text_mask.cache_info().misses == 4
+    itools.text_mask.cache_clear()
+
+def test_blend_rect_matches_draw_rect():
+    """Blending in place on RGB matches compositing a full RGBA overlay."""
+    rng = np.random.default_rng(0)
+    background = Image.fromarray(rng.integers(0, 256, (120, 160, 3), dtype=np.uint8), mode="RGB")
+    box = itools.Box(10, 20, 100, 90)
+
+    expected = itools.draw_rect(background.convert("RGBA"), box, color=(0, 0, 0), transparency=0.45).convert("RGB")
+    result = itools.blend_rect(background.copy(), box, color=(0, 0, 0), transparency=0.45)
+    assert result.mode == "RGB"
+    assert np.abs(np.asarray(result, dtype=np.int16) - np.asarray(expected, dtype=np.int16)).max() <= 1
+
+    # Pixels outside the box are untouched
+    outside = np.ones((120, 160), dtype=bool)
+    outside[20:91, 10:101] = False
+    assert np.array_equal(np.asarray(result)[outside], np.asarray(background)[outside])
@@ -0,0 +1,239 @@
+"""
+Tests the StyleInferer and its feature backbones.
+"""
+
+import os
+import time
+import shutil
+import socket
+import zipfile
+import tempfile
+
+# pytest
+import pytest
+
+# numpy
+import numpy as np
+
+# Pillow
+from PIL import Image
+
+# enlight
+import enlight.image_tools as itools
+import enlight.render as render_module
+
+from enlight.render import render
+from enlight.utils import RENDER_STYLE, load_image_names
+from enlight.ai.infer import (
+    StyleInferer, BeitBackbone, RegionStatsBackbone, ModelWatcher, save_model, unpack_model_archive
+)
+
+from test_render import make_df
+from memory_harness import measure_growth, check_budget, inferer_step
+from benchmark_ai import run_benchmark
+
+def test_region_statistics_matches_brute_force():
+    """Integral image statistics should match per-region numpy."""
+    rng = np.random.default_rng(0)
+    gray = rng.random((48, 64))
+    boxes = itools.calculate_style_regions(itools.Box(0, 0, 64, 48), RENDER_STYLE[:-1], 0.05)
+    stats = itools.region_statistics(gray, boxes)
+
+    grad_x = np.zeros_like(gray)
+    grad_y = np.zeros_like(gray)
+    grad_x[:, 1:] = np.abs(np.diff(gray, axis=1))
+    grad_y[1:, :] = np.abs(np.diff(gray, axis=0))
+    edges = grad_x + grad_y
+
+    for (x, y, x2, y2), row in zip(itools.boxes_to_array(boxes, gray.shape), stats):
+        region = gray[y:y2, x:x2]
+        assert np.isclose(row[0], region.mean())
+        assert np.isclose(row[1], region.var())
+        assert np.isclose(row[2], edges[y:y2, x:x2].mean())
+
+def test_region_stats_backbone(image_folder):
+    backbone = RegionStatsBackbone()
+    imgs = [Image.open(f) for f in load_image_names(image_folder)]
+    features = [backbone.extract(img) for img in imgs]
+    for f in features:
+        assert f.shape == (len(RENDER_STYLE[:-1]) * 3, )
+
+def test_style_inferer_region_stats(image_folder):
+    """Trains and infers a model end to end without any deep learning backbone."""
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="region-stats")
+    img_names = load_image_names(image_folder)
+    imgs = [Image.open(f) for f in img_names]
+    styles = [RENDER_STYLE[i % 3] for i in range(len(imgs))]
+
+    model = inferer.train(imgs, [], [], styles)
+    predictions = inferer.infer(imgs, [], [], model)
+
+    assert len(predictions) == len(imgs)
+    assert len(inferer._feature_cache) == len(set(img_names))
+    for p in predictions:
+        assert 0 <= p[0] < len(RENDER_STYLE[:-1])
+
+@pytest.fixture
+def no_network(monkeypatch):
+    """Fails any attempt to resolve or connect to a host."""
+    def _blocked(*args, **kwargs):
+        raise RuntimeError("Network access attempted.")
+
+    monkeypatch.setattr(socket, "getaddrinfo", _blocked)
+    monkeypatch.setattr(socket.socket, "connect", _blocked)
+
+def test_local_backbone_offline(no_network, tiny_beit_folder, image_folder):
+    """A local model folder loads and runs with networking disabled."""
+    start = time.perf_counter()
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="beit", backbone_fpath=tiny_beit_folder)
+    cold_start = time.perf_counter() - start
+    print(f"Cold start: {cold_start}s")
+    assert cold_start < 10
+
+    img = Image.open(load_image_names(image_folder)[0])
+    assert inferer.calculate_image_feature_vector(img).ndim == 1
+
+@pytest.mark.parametrize("archive_format", ["tar", "zip"])
+def test_local_backbone_archive_offline(no_network, tiny_beit_folder, workspace_fpath, monkeypatch, archive_format):
+    """A packed model archive is extracted once and reused."""
+    archive = shutil.make_archive(os.path.join(workspace_fpath, f"tiny_beit_{archive_format}"),
+                                  archive_format,
+                                  root_dir=tiny_beit_folder)
+    extract_fpath = os.path.join(workspace_fpath, f"tiny_beit_{archive_format}_extracted")
+
+    assert unpack_model_archive(archive, extract_fpath) == extract_fpath
+    assert sorted(os.listdir(extract_fpath)) == sorted(os.listdir(tiny_beit_folder))
+
+    # Extracted under the workspace rather than the system temp folder
+    monkeypatch.setattr(tempfile, "tempdir", os.path.join(workspace_fpath, f"tiny_beit_{archive_format}_tmp"))
+    os.makedirs(tempfile.tempdir, exist_ok=True)
+    backbone = BeitBackbone(model_fpath=archive)
+    assert backbone.model.config.hidden_size == 32
+    assert os.listdir(os.path.join(tempfile.tempdir, "enlight_models"))
+
+@pytest.mark.parametrize("member", ["../escaped.txt", "/escaped.txt", "model/../../escaped.txt"])
+def test_model_archive_rejects_unsafe_paths(workspace_fpath, member):
+    archive = os.path.join(workspace_fpath, "unsafe_model.zip")
+    with zipfile.ZipFile(archive, "w") as f:
+        f.writestr(member, "escaped")
+    extract_fpath = os.path.join(workspace_fpath, "unsafe_model", "extracted")
+    with pytest.raises(RuntimeError, match="Unsafe path"):
+        unpack_model_archive(archive, extract_fpath)
+    assert not os.path.exists(extract_fpath)
+    assert not os.path.exists(os.path.join(workspace_fpath, "escaped.txt"))
+
+def test_backbone_fpath_checks(no_network, tiny_beit_folder, workspace_fpath):
+    """A backbone fpath is only accepted by backbones loading a model, and must exist."""
+    with pytest.raises(AssertionError, match="does not load a model"):
+        StyleInferer(RENDER_STYLE[:-1], backbone="region-stats", backbone_fpath=tiny_beit_folder)
+    with pytest.raises(AssertionError, match="Model not found"):
+        StyleInferer(RENDER_STYLE[:-1], backbone="beit", backbone_fpath=os.path.join(workspace_fpath, "missing_beit"))
+
+def test_uncertainty(image_folder):
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="region-stats")
+    imgs = [Image.open(f) for f in load_image_names(image_folder)]
+    model = inferer.train(imgs, [], [], [RENDER_STYLE[i % 3] for i in range(len(imgs))])
+
+    scores = inferer.decision_scores(imgs, model)
+    assert scores.shape == (len(imgs), len(RENDER_STYLE[:-1]))
+    assert not np.isnan(scores[:, :3]).any()
+    assert np.isnan(scores[:, 3:]).all()
+
+    styles = [RENDER_STYLE[i % len(RENDER_STYLE[:-1])] for i in range(len(imgs))]
+    uncertainty = inferer.uncertainty(imgs, styles, model)
+    assert uncertainty.shape == (len(imgs), )
+    assert (uncertainty >= 0).all()
+
+    # Never trained styles are the most uncertain
+    for style, u in zip(styles, uncertainty):
+        if RENDER_STYLE.index(style) >= 3:
+            assert u == 0
+
+def test_partial_train_and_hot_swap(image_folder, workspace_fpath):
+    """Online models fold in new labels and watchers pick up saved updates."""
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="region-stats")
+    imgs = [Image.open(f) for f in load_image_names(image_folder)]
+
+    model = inferer.partial_train(imgs[:2], [], [], ["top", "bottom"])
+    model_fpath = os.path.join(workspace_fpath, "online.pickle")
+    save_model(model, model_fpath)
+    watcher = ModelWatcher(model_fpath)
+    assert watcher.get() is watcher.model
+
+    model = inferer.partial_train(imgs[2:], [], [], ["left"] * len(imgs[2:]), model)
+    save_model(model, model_fpath)
+    reloaded = watcher.get()
+    assert reloaded is not model
+    assert np.array_equal(reloaded.predict([inferer.calculate_image_feature_vector(i) for i in imgs]),
+                          inferer.infer(imgs, [], [], model))
+    assert inferer.decision_scores(imgs, reloaded).shape == (len(imgs), len(RENDER_STYLE[:-1]))
+
+def test_batched_features(tiny_beit_folder, image_folder):
+    """Batched extraction matches single images and every distinct image is only extracted once."""
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="beit", backbone_fpath=tiny_beit_folder, batch_size=2)
+    imgs = [Image.open(f) for f in load_image_names(image_folder)]
+
+    features = inferer.feature_vectors(imgs + imgs[:2])
+    assert (inferer.cache_misses, inferer.cache_hits) == (len(imgs), 2)
+    for img, f in zip(imgs, features):
+        assert np.allclose(inferer.backbone.extract(img), f, atol=1e-5)
+
+def test_render_ai_path(image_folder, fonts_folder, workspace_fpath, ai_model_file, tiny_beit_folder, monkeypatch):
+    """Renders with a trained SVM over the tiny BEiT, sharing features between rows of a background."""
+    inferers = []
+    class RecordingInferer(StyleInferer):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            inferers.append(self)
+    monkeypatch.setattr(render_module, "StyleInferer", RecordingInferer)
+
+    names = [os.path.split(f)[1] for f in load_image_names(image_folder)[:3]]
+    df = make_df(6)
+    df["image"] = names + names
+    outputs = render(image_folder, os.path.join(workspace_fpath, "ai_path_output"), fonts_folder, None, ai_model_file,
+                     df=df, ai_backbone_fpath=tiny_beit_folder, verbose=False)
+    assert len(outputs) == 6
+    assert len(inferers) == 1
+    assert (inferers[0].cache_misses, inferers[0].cache_hits) == (3, 3)
+
+    inferers[0].clear_cache()
+    assert (inferers[0].cache_misses, inferers[0].cache_hits, len(inferers[0]._feature_cache)) == (0, 0, 0)
+
+def test_bounded_feature_cache():
+    """The least recently used feature vectors are dropped first."""
+    inferer = StyleInferer(RENDER_STYLE[:-1], backbone="region-stats", max_cache_size=2)
+    imgs = []
+    for name in ["a", "b", "c", "d"]:
+        img = Image.new("RGB", (32, 32))
+        img.filename = name
+        imgs.append(img)
+
+    inferer.feature_vectors(imgs[:2])
+    inferer.feature_vectors(imgs[:1])
+    inferer.feature_vectors(imgs[2:3])
+    assert list(inferer._feature_cache.keys()) == ["a", "c"]
+    assert len(inferer.feature_vectors(imgs)) == 4
+    assert len(inferer._feature_cache) == 2
+
+def test_feature_cache_memory_budget():
+    """An unbounded cache grows with every new image, a bounded one stays flat."""
+    unbounded = measure_growth(inferer_step(StyleInferer(RENDER_STYLE[:-1], backbone="region-stats")), 500, 100)
+    with pytest.raises(AssertionError):
+        check_budget(unbounded, 128)
+
+    bounded = measure_growth(inferer_step(StyleInferer(RENDER_STYLE[:-1], backbone="region-stats", max_cache_size=64)), 500, 100)
+    check_budget(bounded, 128)
+
+def test_benchmark_smoke(no_network, fonts_folder, workspace_fpath):
+    """The offline benchmark runs end to end, timings are reported but not checked."""
+    results = run_benchmark(os.path.join(workspace_fpath, "ai_benchmark"), fonts_folder,
+                            image_count=2, rows=4, batch_sizes=[1, 2])
+    assert set(results) == {"features", "predict", "batches", "render"}
+    assert results["features"]["images"] == 2
+    assert [b["batch_size"] for b in results["batches"]] == [1, 2]
+
+    # Rows cycle over the 2 backgrounds, each is extracted once
+    render = results["render"]
+    assert render["rows"] == 4
+    assert (render["cache_misses"], render["cache_hits"]) == (2, 2)
+    assert render["hit_rate"] == 0.5
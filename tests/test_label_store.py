@@ -0,0 +1,49 @@
+"""
+Tests the label store of the scripture example.
+"""
+
+import os
+import sys
+import pickle
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TEST_DIR, os.pardir, "examples", "svm_scripture_dataset_train"))
+
+from label_store import LabelStore, LABEL_COLUMNS, image_hash
+
+def test_latest_verdict_wins(workspace_fpath):
+    store = LabelStore(os.path.join(workspace_fpath, "labels.sqlite"))
+    store.add_many([("h0", "0.jpg", "top", True), ("h0", "0.jpg", "bottom", False), ("h1", "1.jpg", "top", 1)])
+    store.add("h0", "0.jpg", "top", False)
+    assert len(store) == 3
+
+    df = store.to_dataframe()
+    assert list(df.columns) == LABEL_COLUMNS
+    # Ordered by their latest verdict
+    assert list(zip(df["image"], df["style"], df["in"])) == [
+        ("0.jpg", "bottom", False), ("1.jpg", "top", True), ("0.jpg", "top", False)
+    ]
+    assert store.latest() == {("0.jpg", "top"): False, ("0.jpg", "bottom"): False, ("1.jpg", "top"): True}
+    store.close()
+
+    # Labels are kept across sessions
+    reopened = LabelStore(os.path.join(workspace_fpath, "labels.sqlite"))
+    assert not reopened.latest()[("0.jpg", "top")]
+    reopened.close()
+
+def test_import_look_up_table(image_folder, workspace_fpath):
+    name = sorted(os.listdir(image_folder))[0]
+    table_fpath = os.path.join(workspace_fpath, "look_table.pickle")
+    with open(table_fpath, "wb") as f:
+        pickle.dump({f"{name}top": True, f"{name}bottom-left": False, "missing.jpgright": True}, f)
+
+    store = LabelStore(os.path.join(workspace_fpath, "imported_labels.sqlite"))
+    assert store.import_look_up_table(table_fpath, image_folder) == 3
+    assert store.latest() == {(name, "top"): True, (name, "bottom-left"): False, ("missing.jpg", "right"): True}
+
+    # Hashes are only recorded for images that exist
+    df = store.to_dataframe()
+    hashes = dict(zip(df["image"], df["image_hash"]))
+    assert hashes[name] == image_hash(os.path.join(image_folder, name))
+    assert hashes["missing.jpg"] is None
+    store.close()
@@ -0,0 +1,53 @@
+"""
+Tests planning renders without drawing them.
+"""
+
+import os
+import json
+import time
+
+# pandas
+import pandas as pd
+
+# enlight
+from enlight.utils import RENDER_STYLE
+from enlight.render import render
+from enlight.plan import plan, write_plan
+
+from test_render import make_df
+
+def test_plan(image_folder, fonts_folder, workspace_fpath):
+    df = make_df(4, style="bottom")
+    df.loc[3, "quote"] = " ".join(["word"] * 400)
+
+    start = time.perf_counter()
+    plans = plan(image_folder, fonts_folder, None, df=df, verbose=False, min_font_size=8)
+    plan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    names = render(image_folder, os.path.join(workspace_fpath, "plan_render"), fonts_folder, None, None, df=df, verbose=False)
+    print(f"Plan: {plan_time}s, render: {time.perf_counter() - start}s")
+
+    assert [p["output"] for p in plans] == [os.path.split(n)[1] for n in names]
+    for p in plans:
+        assert (p["width"], p["height"]) == (400, 300)
+        assert p["style"] == "bottom" and p["style_source"] == "csv"
+        assert p["overlay_box"][1] > 0 and p["text_box"][1] > p["overlay_box"][1]
+        assert "".join(p["lines"]).strip().startswith("Quote") or p["row"] == 3
+
+    # Only the very long quote falls below the minimum size
+    assert [p["too_small"] for p in plans] == [False, False, False, True]
+
+    write_plan(plans, os.path.join(workspace_fpath, "plan.json"))
+    with open(os.path.join(workspace_fpath, "plan.json")) as f:
+        assert json.load(f) == plans
+    write_plan(plans, os.path.join(workspace_fpath, "plan.csv"))
+    assert len(pd.read_csv(os.path.join(workspace_fpath, "plan.csv"))) == len(plans)
+
+def test_plan_variants_and_fallback(image_folder, fonts_folder):
+    plans = plan(image_folder, fonts_folder, None, df=make_df(2), verbose=False, max_output_size=320,
+                 variant_images=[os.path.split(f)[1] for f in os.listdir(image_folder)[:2]])
+    assert len(plans) == 4
+    for p in plans:
+        assert max(p["width"], p["height"]) == 320
+        assert p["style_source"] == "saliency" and p["style"] in RENDER_STYLE[:-1]
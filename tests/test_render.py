@@ -0,0 +1,264 @@
+"""
+Tests the render function and its options.
+"""
+
+import os
+import sys
+import random
+import subprocess
+
+from conftest import generate_perlin_image
+from memory_harness import measure_growth, check_budget, render_step, train_region_stats_model
+
+# pytest
+import pytest
+
+# numpy
+import numpy as np
+
+# pandas
+import pandas as pd
+
+# Pillow
+from PIL import Image
+
+# enlight
+import enlight.image_tools as itools
+
+from enlight.utils import RENDER_STYLE, load_image_names
+import enlight.render as render_module
+
+from enlight.render import render, iter_render
+from enlight.ai.infer import save_model
+from enlight.ai.saliency import SaliencyStyleSelector
+from enlight.failures import load_failures
+
+def make_df(count, style=""):
+    return pd.DataFrame.from_records(
+        [("", f"Source {i}", f"Quote number {i} with a few words.", style) for i in range(count)],
+        columns=["image", "quote_source", "quote", "style"]
+    )
+
+def test_iter_render_streams(image_folder, fonts_folder, workspace_fpath):
+    """Each output should exist as soon as its row is yielded."""
+    output_folder = os.path.join(workspace_fpath, "iter_render_output")
+    names = iter_render(image_folder, output_folder, fonts_folder, None, None, df=make_df(3), verbose=False)
+
+    first = next(names)
+    assert os.path.exists(first)
+    assert len(os.listdir(output_folder)) == 1
+
+    rest = list(names)
+    assert len(rest) == 2
+    assert sorted(os.listdir(output_folder)) == sorted(os.path.split(n)[1] for n in [first] + rest)
+
+class FixedStyleModel:
+    """Stub AI model predicting the same style for every image."""
+
+    def __init__(self, style):
+        self.style = style
+
+    def predict(self, X):
+        return np.full((len(X), 1), RENDER_STYLE.index(self.style))
+
+def test_render_ai_model_reload(image_folder, fonts_folder, workspace_fpath, monkeypatch):
+    """Renders with a model that is replaced mid-render, later rows use the new model."""
+    styles = []
+    compose = render_module.compose
+    monkeypatch.setattr(render_module, "compose", lambda img, style, *args: styles.append(style) or compose(img, style, *args))
+
+    model_fpath = os.path.join(workspace_fpath, "render_online.pickle")
+    save_model(FixedStyleModel("top"), model_fpath)
+
+    output_folder = os.path.join(workspace_fpath, "render_reload_output")
+    names = iter_render(image_folder, output_folder, fonts_folder, None, model_fpath,
+                        df=make_df(3), ai_backbone="region-stats", reload_ai_model=True, verbose=False)
+    assert os.path.exists(next(names))
+
+    save_model(FixedStyleModel("bottom"), model_fpath)
+    assert len(list(names)) == 2
+    assert styles == ["top", "bottom", "bottom"]
+
+def test_max_output_size(fonts_folder, workspace_fpath):
+    """Outputs are bounded by max_output_size with or without a scaled cache."""
+    images = os.path.join(workspace_fpath, "large_images")
+    os.mkdir(images)
+    generate_perlin_image(1200, 1600).save(os.path.join(images, "large.jpg"))
+
+    output_folder = os.path.join(workspace_fpath, "max_output_size")
+    for name in render(images, output_folder, fonts_folder, None, None, df=make_df(2), max_output_size=400, verbose=False):
+        with Image.open(name) as img:
+            assert img.size == (400, 300)
+
+    cache = itools.scaled_cache_fpath(images, 400)
+    assert itools.build_scaled_cache(load_image_names(images), cache, 400) == [os.path.join(cache, "large.jpg")]
+    assert itools.build_scaled_cache(load_image_names(images), cache, 400) == []
+    assert itools.cached_image_fpath(os.path.join(images, "large.jpg"), cache) == os.path.join(cache, "large.jpg")
+
+    for name in render(images, output_folder, fonts_folder, None, None, df=make_df(2), max_output_size=400, force=True, verbose=False):
+        with Image.open(name) as img:
+            assert img.size == (400, 300)
+
+def test_render_variants(image_folder, fonts_folder, workspace_fpath, monkeypatch):
+    """Each row expands across every style and background, decoding each background once."""
+    loads = []
+    load_background = render_module.load_background
+    monkeypatch.setattr(render_module, "load_background", lambda *args: loads.append(args[0]) or load_background(*args))
+
+    backgrounds = [os.path.split(f)[1] for f in load_image_names(image_folder)[:2]]
+    styles = ["top", "bottom", "left"]
+    output_folder = os.path.join(workspace_fpath, "variant_output")
+    names = render(image_folder, output_folder, fonts_folder, None, None, df=make_df(2), verbose=False,
+                   variant_styles=styles, variant_images=backgrounds)
+
+    assert len(names) == len(set(names)) == 2 * len(backgrounds) * len(styles)
+    assert len(loads) == 2 * len(backgrounds)
+    assert sorted(os.listdir(output_folder)) == sorted(os.path.split(n)[1] for n in names)
+    assert names[0].endswith(f"_{os.path.splitext(backgrounds[0])[0]}_top.jpg")
+
+    # Styles only keep the row background
+    names = render(image_folder, output_folder, fonts_folder, None, None, df=make_df(1), verbose=False,
+                   variant_styles=RENDER_STYLE[:-1], force=True)
+    assert [os.path.split(n)[1].split("_")[1][:-4] for n in names] == RENDER_STYLE[:-1]
+
+def test_render_variant_image_styles(image_folder, fonts_folder, workspace_fpath, monkeypatch):
+    """Rows without a style infer one for every variant background, not only the first."""
+    selected = []
+    monkeypatch.setattr(SaliencyStyleSelector, "select",
+                        lambda self, img: selected.append(RENDER_STYLE[len(selected) % 3]) or selected[-1])
+    composed = []
+    compose = render_module.compose
+    monkeypatch.setattr(render_module, "compose", lambda img, style, *args: composed.append(style) or compose(img, style, *args))
+
+    backgrounds = [os.path.split(f)[1] for f in load_image_names(image_folder)[:3]]
+    render(image_folder, os.path.join(workspace_fpath, "variant_style_output"), fonts_folder, None, None,
+           df=make_df(2), verbose=False, variant_images=backgrounds)
+    assert len(selected) == 2 * len(backgrounds)
+    assert composed == selected
+
+def test_render_io_workers(image_folder, fonts_folder, workspace_fpath):
+    """The threaded pipeline writes the same files, in the same order, as a sequential render."""
+    outputs = []
+    for io_workers in [0, 3]:
+        random.seed(1234)
+        output_folder = os.path.join(workspace_fpath, f"io_workers_{io_workers}")
+        names = render(image_folder, output_folder, fonts_folder, None, None, df=make_df(6), verbose=False,
+                       io_workers=io_workers, pipeline_depth=2)
+        outputs.append([(os.path.split(n)[1], open(n, "rb").read()) for n in names])
+
+    assert outputs[0] == outputs[1]
+
+COMPOSE_MEMORY_SCRIPT = """
+import os
+import sys
+import resource
+
+def peak_rss():
+    # ru_maxrss is kept across exec on Linux, the high water mark of the new process is not
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            return int(next(l for l in f if l.startswith("VmHWM")).split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+sys.path.insert(0, sys.argv[3])
+import enlight.image_tools as itools
+from enlight.render import compose
+from PIL import Image
+
+img = Image.new("RGB", (4000, 3000), (40, 80, 120))
+text = "Quote number 1 with a few words. \\n\\nSource 1"
+before = peak_rss()
+if sys.argv[1] == "legacy":
+    img = img.convert("RGBA")
+    overlay_region = itools.calculate_margin_style(itools.Box(0, 0, 4000, 3000), "top", 0.05)
+    img = itools.draw_rect(img, overlay_region, color=(0, 0, 0), transparency=0.45)
+    itools.draw_text_box(img, itools.calculate_margin_percentage(overlay_region, 0.1), text, sys.argv[2],
+                         target_percentage=0.025, tab_space=4, font_range=(0, 200))
+    img = img.convert("RGB")
+else:
+    compose(img, "top", text, sys.argv[2])
+print(peak_rss() - before)
+"""
+
+def test_compose_peak_memory(fonts_folder):
+    """Compositing in RGB should not allocate full frame copies, unlike the RGBA overlay path."""
+    pytest.importorskip("resource")
+    font_fpath = os.path.join(fonts_folder, "ArchivoBlack-Regular.ttf")
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+    peaks = {}
+    for path in ["legacy", "rgb"]:
+        result = subprocess.run([sys.executable, "-c", COMPOSE_MEMORY_SCRIPT, path, font_fpath, root],
+                                capture_output=True, text=True, check=True)
+        peaks[path] = int(result.stdout.strip().splitlines()[-1])
+    print(f"Peak RSS growth: {peaks}")
+
+    # A 4000x3000 frame is 48MB, the legacy path holds at least two extra frames at once
+    assert peaks["rgb"] * 2 < peaks["legacy"]
+
+def test_render_continue_on_error(image_folder, fonts_folder, workspace_fpath):
+    """Failed rows are recorded with their stage and can be retried on their own."""
+    images = os.path.join(workspace_fpath, "failure_images")
+    os.makedirs(images, exist_ok=True)
+    generate_perlin_image(300, 400).save(os.path.join(images, "present.jpg"))
+
+    df = make_df(5, style="top")
+    df.loc[1, "image"] = "missing.jpg"
+    df.loc[2, "style"] = "diagonal"
+    df.loc[3, "quote"] = None
+
+    output_folder = os.path.join(workspace_fpath, "failure_output")
+    failures_fpath = os.path.join(workspace_fpath, "failures.csv")
+    for io_workers in [0, 2]:
+        names = render(images, output_folder, fonts_folder, None, None, df=df, verbose=False, force=True,
+                       failures_fpath=failures_fpath, io_workers=io_workers)
+        assert len(names) == 2
+
+        # Rows are read ahead of decoding with io_workers, failures are recorded as they happen
+        failures = load_failures(failures_fpath).sort_values("row").reset_index(drop=True)
+        assert list(failures["row"]) == [1, 2, 3]
+        assert list(failures["stage"]) == ["decode", "compose", "row"]
+        assert failures["error"][0].startswith("FileNotFoundError")
+
+    # Existing outputs are skipped, not failures, when not forced
+    names = render(images, output_folder, fonts_folder, None, None, df=df, verbose=False, failures_fpath=failures_fpath)
+    assert len(names) == 0
+    assert list(load_failures(failures_fpath)["stage"]) == ["decode", "compose", "row"]
+
+    # Retrying leaves only the rows still failing, under their original row numbers
+    generate_perlin_image(300, 400).save(os.path.join(images, "missing.jpg"))
+    names = render(images, output_folder, fonts_folder, failures_fpath, None, verbose=False, force=True, failures_fpath=failures_fpath)
+    assert len(names) == 1
+    assert list(load_failures(failures_fpath)["row"]) == [2, 3]
+
+    # An interrupted retry keeps the failed rows it has not reached
+    df["image"] = "late.jpg"
+    render(images, output_folder, fonts_folder, None, None, df=df, verbose=False, force=True, failures_fpath=failures_fpath)
+    generate_perlin_image(300, 400).save(os.path.join(images, "late.jpg"))
+    outputs = iter_render(images, output_folder, fonts_folder, failures_fpath, None, verbose=False, force=True, failures_fpath=failures_fpath)
+    next(outputs)
+    outputs.close()
+    assert list(load_failures(failures_fpath)["row"]) == [0, 1, 2, 3, 4]
+    assert not os.path.exists(failures_fpath + ".tmp")
+
+# pytest keeps every captured warning, which would count as growth
+@pytest.mark.filterwarnings("ignore::FutureWarning")
+def test_render_loop_memory_budget(image_folder, fonts_folder, workspace_fpath, monkeypatch):
+    """
+    Repeated renders with an AI model should not keep anything of earlier renders,
+    with one inferer whose feature cache of 2 cycles through every background and
+    a text mask cache of 2 cycling through 4 quotes.
+    """
+    itools.text_mask.cache_clear()
+    monkeypatch.setattr(itools.text_mask, "max_size", 2)
+    model_fpath = train_region_stats_model(load_image_names(image_folder), os.path.join(workspace_fpath, "memory_svm.pickle"))
+    step = render_step(image_folder, fonts_folder, os.path.join(workspace_fpath, "memory_output"), model_fpath,
+                       quotes=4, feature_cache_size=2)
+    check_budget(measure_growth(step, 30, 10), 2048)
+
+    # Backgrounds evicted by later renders were extracted again
+    assert len(step.inferer._feature_cache) == 2
+    assert step.inferer.cache_misses > len(load_image_names(image_folder))
+    info = itools.text_mask.cache_info()
+    assert info.currsize == 2 and info.misses > 4
+    itools.text_mask.cache_clear()
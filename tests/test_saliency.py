@@ -0,0 +1,40 @@
+"""
+Tests the saliency based style selector.
+"""
+
+import time
+
+# numpy
+import numpy as np
+
+# Pillow
+from PIL import Image
+
+# enlight
+from enlight.utils import RENDER_STYLE
+from enlight.ai.saliency import SaliencyStyleSelector
+
+def test_selects_calm_region():
+    """A noisy top half and flat bottom half should pick a bottom style."""
+    rng = np.random.default_rng(0)
+    arr = np.full((400, 300), 90, dtype=np.uint8)
+    arr[:200, :] = rng.integers(0, 255, size=(200, 300), dtype=np.uint8)
+    img = Image.fromarray(arr, mode="L").convert("RGBA")
+
+    selector = SaliencyStyleSelector()
+    scores = selector.score(img)
+
+    assert scores.shape == (len(RENDER_STYLE[:-1]), )
+    assert selector.select(img) in ["bottom", "quarter-bottom-left", "quarter-bottom-right"]
+    assert scores[RENDER_STYLE.index("top")] > scores[RENDER_STYLE.index("bottom")]
+
+def test_select_is_fast():
+    img = Image.new("RGB", (3000, 2000), (20, 40, 60))
+    selector = SaliencyStyleSelector()
+
+    start = time.perf_counter()
+    for _ in range(10):
+        selector.select(img)
+    per_image = (time.perf_counter() - start) / 10
+
+    assert per_image < 0.1, f"Selection took {per_image}s per image."
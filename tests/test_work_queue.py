@@ -0,0 +1,80 @@
+"""
+Tests the shared work queue used for distributed rendering.
+"""
+
+import os
+import time
+import threading
+
+# enlight
+from enlight.render import iter_render
+from enlight.work_queue import WorkQueue, run_worker
+
+from test_render import make_df
+
+def test_workers_render_all_ranges(image_folder, fonts_folder, workspace_fpath):
+    queue_fpath = os.path.join(workspace_fpath, "render_queue.sqlite")
+    output_folder = os.path.join(workspace_fpath, "queue_output")
+    df = make_df(10)
+
+    coordinator = WorkQueue(queue_fpath)
+    assert coordinator.publish(len(df), 3) == 4
+    assert coordinator.publish(len(df), 3) == 4
+
+    def worker(worker_id):
+        queue = WorkQueue(queue_fpath)
+        render_range = lambda start, stop, force: iter_render(image_folder, output_folder, fonts_folder, None, None,
+                                                              df=df.iloc[start:stop], force=force, verbose=False)
+        run_worker(queue, render_range, worker_id, poll_seconds=0.01)
+        queue.close()
+
+    workers = [threading.Thread(target=worker, args=(f"worker-{i}", )) for i in range(2)]
+    for w in workers:
+        w.start()
+    coordinator.wait(poll_seconds=0.01, verbose=False)
+    for w in workers:
+        w.join()
+
+    manifest = coordinator.manifest()
+    assert list(manifest.columns) == ["start", "stop", "output", "state"]
+    assert len(manifest) == len(df)
+    assert sorted(os.path.split(o)[1] for o in manifest["output"]) == sorted(os.listdir(output_folder))
+    assert coordinator.progress() == {"done": 4}
+
+def test_expired_lease_is_reclaimed(workspace_fpath):
+    queue = WorkQueue(os.path.join(workspace_fpath, "lease_queue.sqlite"))
+    queue.publish(5, 5)
+
+    assert queue.claim("crashed", lease_seconds=0.05) == (1, 0, 5, 1)
+    assert queue.claim("other") is None
+    time.sleep(0.1)
+
+    # The range is handed over and rendered with force, the late worker's report is dropped
+    assert queue.claim("other") == (1, 0, 5, 2)
+    assert not queue.renew(1, "crashed")
+    assert not queue.complete(1, "crashed", ["late.jpg"])
+    assert queue.complete(1, "other", ["a.jpg", "b.jpg"])
+    assert queue.finished()
+    assert list(queue.manifest()["output"]) == ["a.jpg", "b.jpg"]
+
+def test_range_fails_after_max_attempts(workspace_fpath):
+    """A range that crashes every worker is marked failed instead of being claimed forever."""
+    queue = WorkQueue(os.path.join(workspace_fpath, "poison_queue.sqlite"))
+    queue.publish(6, 3)
+
+    for attempt in [1, 2]:
+        assert queue.claim("crashed", lease_seconds=0.05, max_attempts=2) == (1, 0, 3, attempt)
+        time.sleep(0.1)
+
+    def render_range(start, stop, force):
+        yield f"{start}.jpg"
+
+    # The poisoned range is skipped, the remaining range still renders and the queue finishes
+    assert run_worker(queue, render_range, "other", poll_seconds=0.01, max_attempts=2) == 1
+    assert queue.finished()
+    assert queue.progress() == {"done": 1, "failed": 1}
+    queue.wait(poll_seconds=0.01, verbose=False)
+
+    manifest = queue.manifest()
+    assert list(manifest["state"]) == ["failed", "done"]
+    assert list(manifest["output"].fillna("")) == ["", "3.jpg"]